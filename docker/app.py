@@ -1,17 +1,156 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify
+# REST server of sentence embeddings
+#
+# The encoder, the BPE or SPM model are loaded once at startup, and the
+# sentences of concurrent requests are encoded together (dynamic batching)
+# Configuration through environment variables:
+#   LASER_ENCODER        encoder (default: models/bilstm.93langs.2018-12-26.pt)
+#   LASER_BPE_CODES      BPE codes (default: models/93langs.fcodes)
+#   LASER_SPM_MODEL      SPM model, instead of Moses tokenization and BPE
+#   LASER_MAX_BATCH_SIZE maximal number of sentences encoded together (256)
+#   LASER_MAX_WAIT_MS    maximal wait for other requests to batch with (5)
+# The POST endpoints return the embeddings in the format given by the Accept
+# header (or the format parameter of the query):
+#   application/json                     {"embeddings": [[...], ...]} (default)
+#   application/octet-stream             raw little-endian matrix, float32 or
+#                                        float16 (dtype parameter of the query)
+#   application/x-npy                    .npy file
+#   application/vnd.apache.arrow.stream  Arrow stream with one fixed size list
+#                                        column "embedding" (requires pyarrow)
+from flask import Flask, request, jsonify, Response
+import io
 import os
+import re
+import sys
 import socket
-import tempfile
 from pathlib import Path
 import numpy as np
-from LASER.source.lib.text_processing import Token, BPEfastApply
-from LASER.source.embed import *
+
+os.environ.setdefault("LASER", str(Path(__file__).parent / "LASER"))
+sys.path.insert(0, os.path.join(os.environ["LASER"], "source"))
+from embed import load_model, LASER_EMBED_DIM
+from batching import DynamicBatcher
+from lib.text_processing import TokenSession, BPEfastApplyLines, SPMApplyLines
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
 
+# ISO 639 language codes, or '--' for no tokenization: the language is
+# passed to the tokenizer, which keeps one process per language
+LANG_RE = re.compile(r'[a-z]{2,3}|--')
+
+model_dir = Path(os.environ["LASER"]) / "models"
+encoder_path = os.getenv("LASER_ENCODER", str(model_dir / "bilstm.93langs.2018-12-26.pt"))
+spm_model_path = os.getenv("LASER_SPM_MODEL")
+bpe_codes_path = None if spm_model_path else os.getenv(
+    "LASER_BPE_CODES", str(model_dir / "93langs.fcodes"))
+
+print(f' - Encoder: loading {encoder_path}')
+encoder = load_model(encoder_path, spm_model_path, bpe_codes_path,
+                     max_sentences=None,
+                     max_tokens=12000,
+                     sort_kind='mergesort',
+                     cpu=True)
+if spm_model_path:
+    import sentencepiece
+    spm_model = sentencepiece.SentencePieceProcessor(model_file=spm_model_path)
+else:
+    import fastBPE
+    bpe = fastBPE.fastBPE(bpe_codes_path, bpe_codes_path.replace('fcodes', 'fvocab'))
+batcher = DynamicBatcher(encoder.encode_sentences,
+                         max_batch_size=int(os.getenv("LASER_MAX_BATCH_SIZE", 256)),
+                         max_wait=float(os.getenv("LASER_MAX_WAIT_MS", 5)) / 1000)
+
+
+def valid_lang(lang):
+    return isinstance(lang, str) and LANG_RE.fullmatch(lang) is not None
+
+
+def preprocess(sentences, lang):
+    sentences = [' '.join(s.split()) for s in sentences]
+    if spm_model_path:
+        return list(SPMApplyLines(sentences, spm_model, lang=lang if lang != '--' else 'en'))
+    if lang != '--':
+        # the tokenizer of each language is started once and reused
+        sentences = TokenSession(lang, romanize=True if lang == 'el' else False) \
+            .tokenize_many(sentences)
+    return list(BPEfastApplyLines(sentences, bpe))
+
+
+def embed(sentences, lang):
+    if len(sentences) == 0:
+        return np.zeros((0, LASER_EMBED_DIM), dtype=np.float32)
+    return np.asarray(batcher.encode_sentences(preprocess(sentences, lang)))
+
+
+def embed_multilingual(sentences, langs):
+    # preprocess the sentences of each language, and encode them together
+    if len(sentences) == 0:
+        return np.zeros((0, LASER_EMBED_DIM), dtype=np.float32)
+    order = []
+    lines = []
+    for lang in sorted(set(langs)):
+        idx = [i for i, l in enumerate(langs) if l == lang]
+        order.extend(idx)
+        lines.extend(preprocess([sentences[i] for i in idx], lang))
+    embeddings = np.asarray(batcher.encode_sentences(lines))
+    out = np.empty_like(embeddings)
+    out[order] = embeddings
+    return out
+
+
+FORMATS = {
+    'json': 'application/json',
+    'raw': 'application/octet-stream',
+    'npy': 'application/x-npy',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def response_format():
+    fmt = request.args.get('format')
+    if fmt:
+        return fmt if fmt in FORMATS else None
+    best = request.accept_mimetypes.best_match(list(FORMATS.values()), default='application/json')
+    return next(f for f, mimetype in FORMATS.items() if mimetype == best)
+
+
+def embeddings_response(embeddings):
+    fmt = response_format()
+    if fmt is None:
+        return jsonify({'error': 'unknown format, expected one of: ' + ', '.join(FORMATS)}), 406
+    dtypes = {'float32': np.dtype('<f4'), 'float16': np.dtype('<f2')}
+    if request.args.get('dtype', 'float32') not in dtypes:
+        return jsonify({'error': 'dtype must be float32 or float16'}), 400
+    dtype = dtypes[request.args.get('dtype', 'float32')]
+    if fmt == 'json':
+        return jsonify({'embeddings': embeddings.tolist()})
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    if fmt == 'raw':
+        body = embeddings.tobytes()
+    elif fmt == 'npy':
+        buf = io.BytesIO()
+        np.save(buf, embeddings)
+        body = buf.getvalue()
+    else:
+        try:
+            import pyarrow as pa
+        except ImportError:
+            return jsonify({'error': 'Arrow responses require pyarrow'}), 406
+        dim = embeddings.shape[1] if embeddings.ndim == 2 else 0
+        column = pa.FixedSizeListArray.from_arrays(pa.array(embeddings.reshape(-1)), dim)
+        table = pa.table({'embedding': column})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        body = sink.getvalue().to_pybytes()
+    return Response(body, mimetype=FORMATS[fmt], headers={
+        'X-Embedding-Count': str(embeddings.shape[0]),
+        'X-Embedding-Dim': str(embeddings.shape[1] if embeddings.ndim == 2 else 0),
+        'X-Embedding-Dtype': dtype.name,
+    })
+
 
 @app.route("/")
 def root():
@@ -21,58 +160,61 @@ def root():
     return html.format(name=os.getenv("LASER", "world"), hostname=socket.gethostname())
 
 
-@app.route("/vectorize")
+@app.route("/vectorize", methods=["GET"])
 def vectorize():
     content = request.args.get('q')
     lang = request.args.get('lang')
-    embedding = ''
     if lang is None or not lang:
         lang = "en"
-    # encoder
-    model_dir = Path(__file__).parent / "LASER" / "models"
-    encoder_path = model_dir / "bilstm.93langs.2018-12-26.pt"
-    bpe_codes_path = model_dir / "93langs.fcodes"
-    print(f' - Encoder: loading {encoder_path}')
-    encoder = SentenceEncoder(encoder_path,
-                              max_sentences=None,
-                              max_tokens=12000,
-                              sort_kind='mergesort',
-                              cpu=True)
-    with tempfile.TemporaryDirectory() as tmp:
-        tmpdir = Path(tmp)
-        ifname = tmpdir / "content.txt"
-        bpe_fname = tmpdir / 'bpe'
-        bpe_oname = tmpdir / 'out.raw'
-        with ifname.open("w") as f:
-            f.write(content)
-        if lang != '--':
-            tok_fname = tmpdir / "tok"
-            Token(str(ifname),
-                  str(tok_fname),
-                  lang=lang,
-                  romanize=True if lang == 'el' else False,
-                  lower_case=True,
-                  gzip=False,
-                  verbose=True,
-                  over_write=False)
-            ifname = tok_fname
-        BPEfastApply(str(ifname),
-                     str(bpe_fname),
-                     str(bpe_codes_path),
-                     verbose=True, over_write=False)
-        ifname = bpe_fname
-        EncodeFile(encoder,
-                   str(ifname),
-                   str(bpe_oname),
-                   verbose=True,
-                   over_write=False,
-                   buffer_size=10000)
-        dim = 1024
-        X = np.fromfile(str(bpe_oname), dtype=np.float32, count=-1)
-        X.resize(X.shape[0] // dim, dim)
-        embedding = X
+    if not valid_lang(lang):
+        return jsonify({'error': 'unknown language code'}), 400
+    embedding = embed(content.split('\n'), lang)
     body = {'content': content, 'embedding': embedding.tolist()}
     return jsonify(body)
 
+
+@app.route("/vectorize", methods=["POST"])
+def vectorize_batch():
+    """
+    JSON body: {"sentences": [...], "lang": "en"}
+    """
+    data = request.get_json(force=True)
+    sentences = data.get('sentences')
+    if not isinstance(sentences, list):
+        return jsonify({'error': 'expected a list of sentences'}), 400
+    lang = data.get('lang') or "en"
+    if not valid_lang(lang):
+        return jsonify({'error': 'unknown language code'}), 400
+    return embeddings_response(embed([str(s) for s in sentences], lang))
+
+
+@app.route("/vectorize/bulk", methods=["POST"])
+def vectorize_bulk():
+    """
+    JSON body: {"sentences": [...], "lang": "en"} with optionally
+    "langs": [...] the language of each sentence, or
+    {"items": [{"text": "...", "lang": "en"}, ...]}
+    Sentences in different languages are encoded together
+    """
+    data = request.get_json(force=True)
+    if 'items' in data:
+        items = data['items']
+        sentences = [str(item.get('text', '')) for item in items]
+        langs = [item.get('lang') or data.get('lang') or "en" for item in items]
+    else:
+        sentences = [str(s) for s in data.get('sentences', [])]
+        langs = data.get('langs') or [data.get('lang') or "en"] * len(sentences)
+    if not isinstance(langs, list) or len(langs) != len(sentences):
+        return jsonify({'error': 'expected one language per sentence'}), 400
+    if not all(valid_lang(lang) for lang in langs):
+        return jsonify({'error': 'unknown language code'}), 400
+    return embeddings_response(embed_multilingual(sentences, langs))
+
+
+@app.route("/metrics")
+def metrics():
+    return jsonify(batcher.metrics())
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=80, host='0.0.0.0')
+    app.run(debug=False, port=80, host='0.0.0.0', threaded=True)
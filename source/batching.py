@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Dynamic batching of concurrent encoding requests (e.g. in a server):
+# the sentences of the requests received within a short time are
+# encoded together, in the forward passes of a single call of the encoder
+# DynamicBatcher serves threads, AsyncSentenceEncoder asyncio coroutines
+
+import sys
+import time
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+)
+logger = logging.getLogger("batching")
+
+
+class DynamicBatcher:
+    """
+    Coalesce the requests submitted by concurrent threads into calls of
+    encode_fn (e.g. SentenceEncoder.encode_sentences) on a worker thread
+    A call is made once max_batch_size sentences are pending, or max_wait
+    seconds after the first pending request. A request larger than
+    max_batch_size is encoded on its own.
+    Empty requests are not encoded: their result is an array of shape
+    (0, dim), by default of the dimension of the encoder of encode_fn
+    (e.g. SentenceEncoder.dim) or of the previous results.
+    """
+    def __init__(self, encode_fn, max_batch_size=256, max_wait=0.005, dim=None,
+                 verbose=False):
+        self.encode_fn = encode_fn
+        self.dim = dim
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.verbose = verbose
+        self.requests = queue.Queue()
+        self.nrequests = 0
+        self.nbatches = 0
+        self.nsentences = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences):
+        """
+        Returns a Future of the embeddings of the sentences
+        """
+        future = Future()
+        if len(sentences) == 0:
+            if self.dim is None:
+                encoder = getattr(self.encode_fn, "__self__", None)
+                self.dim = getattr(encoder, "dim", None)
+            assert self.dim is not None, "unknown embedding dimension"
+            future.set_result(np.zeros((0, self.dim), dtype=np.float32))
+        else:
+            self.requests.put((list(sentences), future))
+        return future
+
+    def encode_sentences(self, sentences):
+        return self.submit(sentences).result()
+
+    def _collect(self, first):
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # stop after this batch
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = self._collect(request)
+            sentences = [s for sentences, _ in batch for s in sentences]
+            try:
+                embeddings = self.encode_fn(sentences)
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            start = 0
+            for request_sentences, future in batch:
+                end = start + len(request_sentences)
+                future.set_result(embeddings[start:end])
+                start = end
+            self.nrequests += len(batch)
+            self.nbatches += 1
+            self.nsentences += len(sentences)
+
+    def metrics(self):
+        return {
+            "requests": self.nrequests,
+            "batches": self.nbatches,
+            "sentences": self.nsentences,
+            "mean_batch_size": self.nsentences / max(self.nbatches, 1),
+            "mean_requests_per_batch": self.nrequests / max(self.nbatches, 1),
+        }
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        if self.verbose:
+            logger.info(
+                "{requests} requests in {batches} batches of {mean_batch_size:.1f} sentences".format(
+                    **self.metrics()
+                )
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSentenceEncoder:
+    """
+    asyncio interface of an encoder: await encode(sentences)
+    The sentences of the pending requests are merged into a single call of
+    encoder.encode_sentences, on a worker thread, which sorts them by length
+    and batches them under the max_tokens/max_sentences limits of the
+    encoder. The event loop is not blocked by the forward passes.
+    """
+    def __init__(self, encoder, max_batch_size=256, max_wait=0.005, verbose=False):
+        self.encoder = encoder
+        self.batcher = DynamicBatcher(
+            encoder.encode_sentences,
+            max_batch_size=max_batch_size,
+            max_wait=max_wait,
+            dim=getattr(encoder, "dim", None),
+            verbose=verbose,
+        )
+
+    async def encode(self, sentences):
+        return await asyncio.wrap_future(self.batcher.submit(sentences))
+
+    def metrics(self):
+        return self.batcher.metrics()
+
+    def close(self):
+        self.batcher.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Tool to preprocess an encoder checkpoint for fast loading:
+# the compiled checkpoint holds the encoder weights only, with the
+# serialized dictionary, and is memory mapped by SentenceEncoder
+
+import argparse
+from pathlib import Path
+
+from embed import CompileCheckpoint
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="LASER: compile an encoder checkpoint for fast loading")
+    parser.add_argument("--encoder", type=str, required=True, help="Encoder checkpoint")
+    parser.add_argument("--output", type=str, required=True, help="Compiled checkpoint")
+    parser.add_argument("--spm-model", type=str, default=None,
+                        help="SPM model of the encoder (its .cvocab is the vocabulary)")
+    parser.add_argument("--vocab", type=str, default=None,
+                        help="Vocabulary of the encoder (instead of --spm-model)")
+    parser.add_argument("--verbose", action="store_true", help="Detailed output")
+    args = parser.parse_args()
+
+    vocab = args.vocab
+    if vocab is None and args.spm_model:
+        vocab = str(Path(args.spm_model).with_suffix(".cvocab"))
+    CompileCheckpoint(args.encoder, args.output, vocab=vocab, verbose=args.verbose)
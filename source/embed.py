@@ -18,22 +18,46 @@
 
 import re
 import os
+import glob
 import tempfile
 import sys
 import time
+import queue
+import json
+import threading
 import argparse
+import zipfile
 import numpy as np
 import logging
-from collections import namedtuple
+from collections import namedtuple, deque, defaultdict
 from subprocess import run
+from functools import partial
+from itertools import chain, repeat
+from contextlib import ExitStack, nullcontext
 from pathlib import Path
 from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
 
 
-from lib.text_processing import Token, BPEfastApply, SPMApply
+from lib.text_processing import (
+    Token,
+    BPEfastApply,
+    SPMApply,
+    BPEfastApplyLines,
+    SPMApplyLines,
+    TokenLines,
+)
+from lib.embedding_cache import EmbeddingCache
+from lib.embedding_format import (
+    EmbeddingWriter,
+    LoadEmbeddings,
+    HEADER_SIZE,
+    ShardedEmbeddingWriter,
+    ManifestFname,
+)
 
 from fairseq.models.transformer import (
     Embedding,
@@ -45,6 +69,10 @@ from examples.laser.laser_src import laser_transformer, character_cnn
 
 LASER_EMBED_DIM = 1024
 
+# attributes of a SentenceEncoder counting the long lines (see max_seq_len):
+# lines truncated, lines split and additional windows of the split lines
+LONG_LINE_COUNTERS = ("ntruncated", "nsplit", "nwindows")
+
 SPACE_NORMALIZER = re.compile(r"\s+")
 Batch = namedtuple("Batch", "srcs tokens lengths")
 
@@ -66,6 +94,91 @@ def buffered_read(fp, buffer_size):
         yield buffer
 
 
+# Whether the CPU computes natively in bfloat16 (AVX512-BF16 or AMX),
+# otherwise bfloat16 matrix products are emulated and slower than fp32
+def CpuSupportsBF16():
+    try:
+        with open("/proc/cpuinfo") as fp:
+            for line in fp:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    return bool(flags & {"avx512_bf16", "amx_bf16"})
+    except OSError:
+        pass
+    return False
+
+
+COMPILED_CHECKPOINT = "laser-compiled-checkpoint"
+
+# (major, minor) of a version string, e.g. (2, 10) for "2.10.0+cpu"
+def VersionTuple(version):
+    return tuple(int(v) for v in re.match(r"(\d+)\.(\d+)", version).groups())
+
+
+# memory mapped loading (torch.load(mmap=True)) and load_state_dict(assign=True)
+# need torch 2.1, older versions read and copy the weights
+TORCH_MMAP = VersionTuple(torch.__version__) >= (2, 1)
+
+
+# Load an encoder checkpoint
+# Checkpoints in the zip format (e.g. written by CompileCheckpoint) are
+# memory mapped instead of read, so that the weights are only paged in
+# when used, and not copied again by LoadStateDict (with torch >= 2.1)
+def LoadCheckpoint(model_path):
+    if not zipfile.is_zipfile(model_path):
+        return torch.load(model_path)
+    state_dict = torch.load(model_path, mmap=True) if TORCH_MMAP else torch.load(model_path)
+    if state_dict.get("format") == COMPILED_CHECKPOINT and "cfg" in state_dict:
+        state_dict["cfg"]["model"] = argparse.Namespace(**state_dict["cfg"]["model"])
+    return state_dict
+
+
+def LoadStateDict(module, state_dict):
+    if TORCH_MMAP:
+        # use the tensors of the state dict, without copy
+        module.load_state_dict(state_dict, assign=True)
+    else:
+        module.load_state_dict(state_dict)
+
+
+# Write an encoder only checkpoint for fast loading: the decoder is removed,
+# the keys are renamed as in the encoder, and the dictionary of transformer
+# encoders is serialized, so that the vocabulary file is no longer needed.
+# The configuration is stored as plain types and the file can be loaded
+# with weights_only=True
+def CompileCheckpoint(model_path, out_fname, vocab=None, verbose=False):
+    state_dict = torch.load(model_path)
+    if "params" in state_dict:
+        compiled = {
+            "params": state_dict["params"],
+            "model": state_dict["model"],
+            "dictionary": state_dict["dictionary"],
+        }
+    else:
+        assert vocab, "the vocabulary is needed to compile a transformer encoder"
+        encoder = LaserTransformerEncoder(state_dict, vocab)
+        cfg = state_dict["cfg"]["model"]
+        if not isinstance(cfg, argparse.Namespace):
+            from omegaconf import OmegaConf
+
+            cfg = argparse.Namespace(**OmegaConf.to_container(cfg, resolve=True))
+        dictionary = encoder.dictionary
+        compiled = {
+            "cfg": {"model": vars(cfg)},
+            "model": encoder.state_dict(),
+            "dictionary": {
+                "symbols": dictionary.symbols,
+                "count": dictionary.count,
+                "nspecial": dictionary.nspecial,
+            },
+        }
+    compiled["format"] = COMPILED_CHECKPOINT
+    compiled["source"] = CheckpointId(model_path)
+    torch.save(compiled, out_fname)
+    if verbose:
+        logger.info(f"compiled {model_path} to {out_fname}")
+
+
 class SentenceEncoder:
     def __init__(
         self,
@@ -77,6 +190,10 @@ class SentenceEncoder:
         fp16=False,
         verbose=False,
         sort_kind="quicksort",
+        quantize=None,
+        bf16=False,
+        max_seq_len=None,
+        long_lines="truncate",
     ):
         if verbose:
             logger.info(f"loading encoder: {model_path}")
@@ -86,10 +203,10 @@ class SentenceEncoder:
         if self.max_tokens is None and self.max_sentences is None:
             self.max_sentences = 1
 
-        state_dict = torch.load(model_path)
+        state_dict = LoadCheckpoint(model_path)
         if "params" in state_dict:
             self.encoder = LaserLstmEncoder(**state_dict["params"])
-            self.encoder.load_state_dict(state_dict["model"])
+            LoadStateDict(self.encoder, state_dict["model"])
             self.dictionary = state_dict["dictionary"]
             self.prepend_bos = False
             self.left_padding = False
@@ -104,14 +221,93 @@ class SentenceEncoder:
         self.eos_index = self.dictionary["</s>"] = 2
         self.unk_index = self.dictionary["<unk>"] = 3
 
+        self.fp16 = fp16
+        self.quantize = quantize
         if fp16:
             self.encoder.half()
+        # bf16: the weights stay in fp32, and matrix products run in
+        # bfloat16 under autocast (normalizations and softmax stay in fp32)
+        self.bf16 = bf16
+        if bf16:
+            assert isinstance(
+                self.encoder, LaserTransformerEncoder
+            ), "bf16 inference is only supported by transformer encoders"
+            assert not fp16 and not quantize, "bf16 cannot be combined with fp16 or int8"
+            if not self.use_cuda and not CpuSupportsBF16():
+                logger.warning("the CPU has no native bf16 support, using fp32")
+                self.bf16 = False
+            elif verbose:
+                logger.info("bf16 autocast inference")
+        if quantize:
+            assert quantize == "int8", f"unsupported quantization: {quantize}"
+            assert not self.use_cuda, "int8 quantization is only supported on CPU"
+            self._quantize_int8(verbose=verbose)
         if self.use_cuda:
             if verbose:
                 logger.info("transfer encoder to GPU")
             self.encoder.cuda()
         self.encoder.eval()
         self.sort_kind = sort_kind
+        self.model_path = str(model_path)
+        self._init_long_lines(max_seq_len, long_lines)
+
+    def _init_long_lines(self, max_seq_len, long_lines):
+        # sentences longer than max_seq_len tokens (including bos/eos) are
+        # truncated, or split into windows of max_seq_len tokens whose
+        # embeddings are pooled with "max" or "mean"
+        assert long_lines in (
+            "truncate", "max", "mean"
+        ), f"unknown policy for long lines: {long_lines}"
+        assert max_seq_len is None or max_seq_len > (
+            2 if self.prepend_bos else 1
+        ), "max_seq_len is too small"
+        self.max_seq_len = max_seq_len
+        self.long_lines = long_lines
+        self.ntruncated = 0  # lines truncated
+        self.nsplit = 0  # lines split
+        self.nwindows = 0  # additional windows of the split lines
+
+    @property
+    def dim(self):
+        # dimension of the sentence embeddings
+        if getattr(self, "_dim", None) is None:
+            self._dim = getattr(getattr(self, "encoder", None), "output_units", None)
+            if self._dim is None:
+                self._dim = self.encode_sentences(["."]).shape[1]
+        return self._dim
+
+    def config_id(self):
+        # inference options changing the embeddings of a checkpoint
+        return json.dumps(
+            {
+                "max_seq_len": self.max_seq_len,
+                "long_lines": self.long_lines,
+                "quantize": self.quantize,
+                "fp16": self.fp16,
+                "bf16": self.bf16,
+            },
+            sort_keys=True,
+        )
+
+    def _quantize_int8(self, verbose=False):
+        # dynamic quantization of the LSTM and of the linear layers
+        # the attention projections of the transformer are left in fp32
+        # since fairseq passes their weights directly to the attention kernel
+        modules = {
+            name
+            for name, module in self.encoder.named_modules()
+            if isinstance(module, nn.LSTM)
+            or (
+                isinstance(module, nn.Linear)
+                and name.split(".")[-1] not in ("q_proj", "k_proj", "v_proj", "out_proj")
+            )
+        }
+        if verbose:
+            logger.info(f"int8 dynamic quantization of {len(modules)} modules")
+        self.encoder.eval()
+        torch.ao.quantization.quantize_dynamic(
+            self.encoder, modules, dtype=torch.qint8, inplace=True
+        )
 
     def _process_batch(self, batch):
         tokens = batch.tokens
@@ -120,11 +316,18 @@ class SentenceEncoder:
             tokens = tokens.cuda()
             lengths = lengths.cuda()
 
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             sentemb = self.encoder(tokens, lengths)["sentemb"]
-        embeddings = sentemb.detach().cpu().numpy()
+        embeddings = sentemb.detach().float().cpu().numpy()
         return embeddings
 
+    def _autocast(self):
+        if not self.bf16:
+            return nullcontext()
+        return torch.autocast(
+            "cuda" if self.use_cuda else "cpu", dtype=torch.bfloat16
+        )
+
     def _tokenize(self, line):
         tokens = SPACE_NORMALIZER.sub(" ", line).strip().split()
         ntokens = len(tokens)
@@ -141,49 +344,375 @@ class SentenceEncoder:
             ids[ntokens] = self.eos_index
         return ids
 
+    def _tokenize_buffer(self, lines):
+        # map all the tokens of a buffer to their ids at once
+        # returns the ids of all sentences (with bos/eos) one after another,
+        # and the start position and length of each sentence
+        tokens = [line.split() for line in lines]
+        ntokens = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        lengths = ntokens + (2 if self.prepend_bos else 1)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        ids = np.empty(int(lengths.sum()), dtype=np.int64)
+        words = np.ones(ids.shape[0], dtype=bool)
+        words[ends - 1] = False
+        ids[ends - 1] = self.eos_index
+        if self.prepend_bos:
+            words[starts] = False
+            ids[starts] = self.bos_index
+        ids[words] = np.fromiter(
+            map(self.dictionary.get, chain.from_iterable(tokens), repeat(self.unk_index)),
+            dtype=np.int64,
+            count=int(ntokens.sum()),
+        )
+        return ids, starts, lengths
+
+    def _split_long(self, ids, starts, lengths):
+        # apply the max_seq_len policy to the output of _tokenize_buffer
+        # returns the segments to encode, and the sentence of each segment
+        # the first segment of a sentence keeps its position
+        owners = np.arange(lengths.shape[0])
+        if self.max_seq_len is None:
+            return ids, starts, lengths, owners
+        long = np.flatnonzero(lengths > self.max_seq_len)
+        if long.shape[0] == 0:
+            return ids, starts, lengths, owners
+        lengths = lengths.copy()
+        if self.long_lines == "truncate":
+            self.ntruncated += long.shape[0]
+        else:
+            first = 1 if self.prepend_bos else 0
+            width = self.max_seq_len - first - 1  # words per window
+            segments = [ids]
+            seg_lengths = [lengths]
+            seg_owners = [owners]
+            for i in long.tolist():
+                words = ids[starts[i] + first : starts[i] + lengths[i] - 1]
+                for w in range(width, words.shape[0], width):
+                    segment = [words[w : w + width], [self.eos_index]]
+                    if self.prepend_bos:
+                        segment.insert(0, [self.bos_index])
+                    segments.append(np.concatenate(segment))
+                    seg_lengths.append([segments[-1].shape[0]])
+                    seg_owners.append([i])
+            self.nsplit += long.shape[0]
+            self.nwindows += len(segments) - 1
+            ids = np.concatenate(segments)
+            lengths = np.concatenate(seg_lengths)
+            owners = np.concatenate(seg_owners)
+            starts = np.cumsum(lengths) - lengths
+        # the first segment is the beginning of the sentence
+        ids[starts[long] + self.max_seq_len - 1] = self.eos_index
+        lengths[long] = self.max_seq_len
+        return ids, starts, lengths, owners
+
+    def _pool(self, embeddings, starts):
+        # pool the embeddings of the windows of each sentence, which are
+        # consecutive, starting at starts
+        if self.long_lines == "max":
+            return np.maximum.reduceat(embeddings, starts, axis=0)
+        counts = np.diff(np.append(starts, embeddings.shape[0]))
+        return np.add.reduceat(embeddings, starts, axis=0) / counts[:, None].astype(
+            embeddings.dtype
+        )
+
+    def _collate(self, ids, starts, lengths, rows):
+        # build the padded batch of the given sentences in one shot
+        lens = lengths[rows]
+        width = lens.max()
+        cols = np.arange(width)[None, :]
+        if self.left_padding:
+            cols = cols - (width - lens)[:, None]
+        mask = (cols >= 0) & (cols < lens[:, None])
+        toks = np.full((len(rows), width), self.pad_index, dtype=np.int64)
+        toks[mask] = ids[(starts[rows][:, None] + cols)[mask]]
+        return Batch(
+            srcs=None, tokens=torch.from_numpy(toks), lengths=torch.from_numpy(lens)
+        )
+
     def _make_batches(self, lines):
-        tokens = [self._tokenize(line) for line in lines]
-        lengths = np.array([t.numel() for t in tokens])
+        # yields the batches and the index of the sentence of each row
+        ids, starts, lengths, owners = self._split_long(*self._tokenize_buffer(lines))
         indices = np.argsort(-lengths, kind=self.sort_kind)
 
-        def batch(tokens, lengths, indices):
-            toks = tokens[0].new_full((len(tokens), tokens[0].shape[0]), self.pad_index)
-            if not self.left_padding:
-                for i in range(len(tokens)):
-                    toks[i, : tokens[i].shape[0]] = tokens[i]
-            else:
-                for i in range(len(tokens)):
-                    toks[i, -tokens[i].shape[0] :] = tokens[i]
-            return (
-                Batch(srcs=None, tokens=toks, lengths=torch.LongTensor(lengths)),
-                indices,
-            )
-
-        batch_tokens, batch_lengths, batch_indices = [], [], []
-        ntokens = nsentences = 0
-        for i in indices:
-            if nsentences > 0 and (
-                (self.max_tokens is not None and ntokens + lengths[i] > self.max_tokens)
-                or (self.max_sentences is not None and nsentences == self.max_sentences)
+        batch_indices = []
+        ntokens = 0
+        for i, length in zip(indices.tolist(), lengths[indices].tolist()):
+            if batch_indices and (
+                (self.max_tokens is not None and ntokens + length > self.max_tokens)
+                or (self.max_sentences is not None and len(batch_indices) == self.max_sentences)
             ):
-                yield batch(batch_tokens, batch_lengths, batch_indices)
-                ntokens = nsentences = 0
-                batch_tokens, batch_lengths, batch_indices = [], [], []
-            batch_tokens.append(tokens[i])
-            batch_lengths.append(lengths[i])
+                yield self._collate(ids, starts, lengths, batch_indices), owners[
+                    batch_indices
+                ].tolist()
+                ntokens = 0
+                batch_indices = []
             batch_indices.append(i)
-            ntokens += tokens[i].shape[0]
-            nsentences += 1
-        if nsentences > 0:
-            yield batch(batch_tokens, batch_lengths, batch_indices)
+            ntokens += length
+        if batch_indices:
+            yield self._collate(ids, starts, lengths, batch_indices), owners[
+                batch_indices
+            ].tolist()
 
-    def encode_sentences(self, sentences):
+    def _encode_batches(self, batches):
         indices = []
         results = []
-        for batch, batch_indices in self._make_batches(sentences):
+        for batch, batch_indices in batches:
             indices.extend(batch_indices)
             results.append(self._process_batch(batch))
-        return np.vstack(results)[np.argsort(indices, kind=self.sort_kind)]
+        if not results:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        order = np.argsort(indices, kind=self.sort_kind)
+        embeddings = np.vstack(results)[order]
+        if len(indices) > 0 and indices[order[-1]] + 1 < len(indices):
+            # windows of long sentences
+            starts = np.flatnonzero(np.diff(np.asarray(indices)[order], prepend=-1))
+            embeddings = self._pool(embeddings, starts)
+        return embeddings
+
+    def encode_sentences(self, sentences):
+        return self._encode_batches(self._make_batches(sentences))
+
+
+class CompiledSentenceEncoder(SentenceEncoder):
+    """
+    Run an encoder exported by export_encoder.py (TorchScript or ONNX graph
+    returning the sentence embeddings only) with the same tokenization and
+    batching as SentenceEncoder. The dictionary and tokenization settings
+    are read from the <model_path>.json sidecar, and the other options of
+    SentenceEncoder (fp16, quantize) are fixed at export time.
+    """
+    def __init__(
+        self,
+        model_path,
+        max_sentences=None,
+        max_tokens=None,
+        cpu=False,
+        verbose=False,
+        sort_kind="quicksort",
+        max_seq_len=None,
+        long_lines="truncate",
+        **kwargs,
+    ):
+        if verbose:
+            logger.info(f"loading compiled encoder: {model_path}")
+        with open(CompiledSentenceEncoder.meta_fname(model_path)) as fp:
+            meta = json.load(fp)
+        self.use_cuda = torch.cuda.is_available() and not cpu
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        if self.max_tokens is None and self.max_sentences is None:
+            self.max_sentences = 1
+        self.dictionary = meta["dictionary"]
+        self.prepend_bos = meta["prepend_bos"]
+        self.left_padding = meta["left_padding"]
+        self.bos_index = meta["bos_index"]
+        self.pad_index = meta["pad_index"]
+        self.eos_index = meta["eos_index"]
+        self.unk_index = meta["unk_index"]
+        self.sort_kind = sort_kind
+        self.model_path = str(model_path)
+        self._init_long_lines(max_seq_len, long_lines)
+        # fixed at export time, and part of the checkpoint
+        self.fp16 = False
+        self.quantize = None
+        self.bf16 = False
+        self.session = None
+        if meta["format"] == "onnx":
+            import onnxruntime
+
+            providers = ["CPUExecutionProvider"]
+            if self.use_cuda:
+                providers.insert(0, "CUDAExecutionProvider")
+            self.session = onnxruntime.InferenceSession(
+                str(model_path), providers=providers
+            )
+        else:
+            self.encoder = torch.jit.load(
+                str(model_path), map_location="cuda" if self.use_cuda else "cpu"
+            )
+            self.encoder.eval()
+
+    @staticmethod
+    def meta_fname(model_path):
+        return str(model_path) + ".json"
+
+    @staticmethod
+    def is_compiled(model_path):
+        return os.path.isfile(CompiledSentenceEncoder.meta_fname(model_path))
+
+    def _process_batch(self, batch):
+        if self.session is not None:
+            return self.session.run(
+                ["sentemb"],
+                {"tokens": batch.tokens.numpy(), "lengths": batch.lengths.numpy()},
+            )[0]
+        tokens = batch.tokens
+        if self.use_cuda:
+            tokens = tokens.cuda()
+        with torch.no_grad():
+            sentemb = self.encoder(tokens, batch.lengths)
+        return sentemb.detach().cpu().numpy()
+
+
+# encoder of the current SentenceEncoderPool worker (inherited through fork)
+_pool_encoder = None
+
+
+def _pool_init(encoder, num_threads, cpu_sets):
+    global _pool_encoder
+    _pool_encoder = encoder
+    torch.set_num_threads(num_threads)
+    if cpu_sets is not None:
+        os.sched_setaffinity(0, cpu_sets.get())
+
+
+def _pool_encode(sentences):
+    # embeddings, and the long lines counted while encoding them
+    counts = [getattr(_pool_encoder, k) for k in LONG_LINE_COUNTERS]
+    embeddings = _pool_encoder.encode_sentences(sentences)
+    return embeddings, [
+        getattr(_pool_encoder, k) - n for k, n in zip(LONG_LINE_COUNTERS, counts)
+    ]
+
+
+class SentenceEncoderPool:
+    """
+    Encode buffers of sentences on CPU with several forked worker processes.
+    The weights of the encoder are moved to shared memory and are only read
+    by the workers. Each worker runs with num_threads intra-op threads and,
+    if pin_cores is set, is pinned to its own set of cores.
+    The pool should be created before the encoder is first used in the
+    parent process.
+    The long lines counted by the workers (LONG_LINE_COUNTERS) are summed
+    in the attributes of the pool.
+    """
+    def __init__(
+        self,
+        encoder,
+        num_workers,
+        num_threads=1,
+        pin_cores=True,
+        max_pending=None,
+        verbose=False,
+    ):
+        assert isinstance(encoder, SentenceEncoder), "only SentenceEncoder can be pooled"
+        assert not encoder.use_cuda, "SentenceEncoderPool only supports CPU encoding"
+        self.encoder = encoder
+        self.num_workers = num_workers
+        self.max_seq_len = encoder.max_seq_len
+        self.long_lines = encoder.long_lines
+        for k in LONG_LINE_COUNTERS:
+            setattr(self, k, 0)
+        # number of buffers submitted ahead of the one being returned
+        self.max_pending = max_pending or 2 * num_workers
+        encoder.encoder.share_memory()
+        ctx = mp.get_context("fork")
+        cpu_sets = None
+        if pin_cores:
+            cores = sorted(os.sched_getaffinity(0))
+            cpu_sets = ctx.Queue()
+            for i in range(num_workers):
+                cpu_sets.put(
+                    {cores[(i * num_threads + j) % len(cores)] for j in range(num_threads)}
+                )
+        if verbose:
+            logger.info(
+                f"starting {num_workers} encoder workers with {num_threads} threads each"
+            )
+        self.pool = ctx.Pool(
+            num_workers,
+            initializer=_pool_init,
+            initargs=(encoder, num_threads, cpu_sets),
+        )
+
+    def _result(self, pending):
+        embeddings, counts = pending.get()
+        for k, n in zip(LONG_LINE_COUNTERS, counts):
+            setattr(self, k, getattr(self, k) + n)
+        return embeddings
+
+    def encode_buffers(self, buffers):
+        # results are returned in the order of the buffers
+        pending = deque()
+        for sentences in buffers:
+            pending.append(self.pool.apply_async(_pool_encode, (sentences,)))
+            if len(pending) >= self.max_pending:
+                yield self._result(pending.popleft())
+        while pending:
+            yield self._result(pending.popleft())
+
+    def encode_sentences(self, sentences):
+        if len(sentences) == 0:
+            return np.zeros((0, self.encoder.dim), dtype=np.float32)
+        size = max(1, -(-len(sentences) // self.num_workers))
+        buffers = [sentences[i : i + size] for i in range(0, len(sentences), size)]
+        return np.vstack(list(self.encode_buffers(buffers)))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Identity of an encoder checkpoint, used to key cached embeddings
+def CheckpointId(model_path):
+    st = os.stat(model_path)
+    return f"{os.path.realpath(model_path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+class CachedSentenceEncoder:
+    """
+    Wrap an encoder with a persistent EmbeddingCache keyed by the
+    preprocessed sentences, the checkpoint and the inference options:
+    only sentences which are not in the cache go through the encoder
+    The dimension of the cache is the one of the encoder by default.
+    """
+    def __init__(self, encoder, cache_dir, max_size=1024, dim=None, verbose=False):
+        self.encoder = encoder
+        self.verbose = verbose
+        base = encoder.encoder if isinstance(encoder, SentenceEncoderPool) else encoder
+        self.cache = EmbeddingCache(
+            cache_dir,
+            dim=dim or base.dim,
+            max_size=max_size,
+            model_id=f"{CheckpointId(base.model_path)}:{base.config_id()}",
+            verbose=verbose,
+        )
+
+    def encode_sentences(self, sentences):
+        keys = self.cache.hash(sentences)
+        embeddings = np.empty((len(sentences), self.cache.meta["dim"]), dtype=np.float32)
+        found = self.cache.lookup(keys, embeddings)
+        if not found.all():
+            # encode each missing sentence once
+            missing = {}
+            for i in np.flatnonzero(~found).tolist():
+                missing.setdefault(keys[i], []).append(i)
+            rows = [indices[0] for indices in missing.values()]
+            encoded = self.encoder.encode_sentences([sentences[i] for i in rows])
+            self.cache.insert(missing.keys(), encoded)
+            for indices, embedding in zip(missing.values(), encoded):
+                embeddings[indices] = embedding
+        return embeddings
+
+    def close(self):
+        self.cache.close()
+        if self.verbose:
+            logger.info(
+                f"embedding cache: {self.cache.hits} hits, {self.cache.misses} misses"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class HuggingFaceEncoder():
@@ -200,12 +729,20 @@ class HuggingFaceEncoder():
 
 class LaserTransformerEncoder(laser_transformer.LaserTransformerEncoder):
     def __init__(self, state_dict, vocab_path):
-        dictionary = Dictionary.load(vocab_path)
-        if any(
-            k in state_dict["model"]
-            for k in ["encoder.layer_norm.weight", "layer_norm.weight"]
-        ):
-            dictionary.add_symbol("<mask>", overwrite=True)
+        if state_dict.get("format") == COMPILED_CHECKPOINT:
+            # serialized dictionary, including <mask>
+            dictionary = Dictionary()
+            dictionary.symbols = list(state_dict["dictionary"]["symbols"])
+            dictionary.count = list(state_dict["dictionary"]["count"])
+            dictionary.indices = {s: i for i, s in enumerate(dictionary.symbols)}
+            dictionary.nspecial = state_dict["dictionary"]["nspecial"]
+        else:
+            dictionary = Dictionary.load(vocab_path)
+            if any(
+                k in state_dict["model"]
+                for k in ["encoder.layer_norm.weight", "layer_norm.weight"]
+            ):
+                dictionary.add_symbol("<mask>", overwrite=True)
         self.pad_idx = dictionary.pad_index
         self.bos_idx = dictionary.bos_index
 
@@ -221,7 +758,7 @@ class LaserTransformerEncoder(laser_transformer.LaserTransformerEncoder):
         if "decoder.version" in state_dict["model"]:
             self._remove_decoder_layers(state_dict)
 
-        self.load_state_dict(state_dict["model"])
+        LoadStateDict(self, state_dict["model"])
 
     def _remove_decoder_layers(self, state_dict):
         for key in list(state_dict["model"].keys()):
@@ -287,15 +824,16 @@ class LaserLstmEncoder(nn.Module):
         x = x.transpose(0, 1)
 
         # pack embedded source tokens into a PackedSequence
-        packed_x = nn.utils.rnn.pack_padded_sequence(x, src_lengths.data.tolist())
+        # (lengths are passed as a tensor so that traced graphs do not fix them)
+        packed_x = nn.utils.rnn.pack_padded_sequence(x, src_lengths.cpu())
 
         # apply LSTM
         if self.bidirectional:
             state_size = 2 * self.num_layers, bsz, self.hidden_size
         else:
             state_size = self.num_layers, bsz, self.hidden_size
-        h0 = x.data.new(*state_size).zero_()
-        c0 = x.data.new(*state_size).zero_()
+        h0 = x.new_zeros(*state_size)
+        c0 = x.new_zeros(*state_size)
         packed_outs, (final_hiddens, final_cells) = self.lstm(packed_x, (h0, c0))
 
         # unpack outputs and apply dropout
@@ -363,6 +901,8 @@ def load_model(
             logger.info(f"custom_cvocab: {vocab}")
     else:
         vocab = None
+    if CompiledSentenceEncoder.is_compiled(encoder):
+        return CompiledSentenceEncoder(encoder, verbose=verbose, **encoder_kwargs)
     return SentenceEncoder(
         encoder, vocab=vocab, verbose=verbose, **encoder_kwargs
     )
@@ -381,6 +921,10 @@ def EncodeLoad(args):
         max_tokens=args.max_tokens,
         cpu=args.cpu,
         verbose=args.verbose,
+        quantize=getattr(args, "quantize", None),
+        bf16=getattr(args, "bf16", False),
+        max_seq_len=getattr(args, "max_seq_len", None),
+        long_lines=getattr(args, "long_lines", "truncate"),
     )
 
 
@@ -392,26 +936,320 @@ def EncodeTime(t):
         return "{:d}m{:d}s".format(t // 60, t % 60)
 
 
+# Encode buffers of sentences with batches of sentences of similar length,
+# taken across buffers from a sliding window of at most [window] sentences
+# The embeddings are returned in input order
+def EncodeBucketed(encoder, buffers, window, bucket_width=1):
+    buckets = {}  # length bucket -> [input indices, token ids, ntokens]
+    done = {}  # embeddings not yet returned
+    windows = {}  # input index -> [number of windows, embeddings] (long lines)
+    npending = nread = nwritten = 0
+
+    def emit(key):
+        nonlocal npending
+        indices, rows, _ = buckets.pop(key)
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        ends = np.cumsum(lengths)
+        order = np.argsort(-lengths, kind=encoder.sort_kind)
+        batch = encoder._collate(np.concatenate(rows), ends - lengths, lengths, order)
+        for i, embedding in zip(order.tolist(), encoder._process_batch(batch)):
+            index = indices[i]
+            if index in windows:
+                windows[index][1].append(embedding)
+                if len(windows[index][1]) < windows[index][0]:
+                    continue
+                embedding = encoder._pool(np.stack(windows.pop(index)[1]), [0])[0]
+            done[index] = embedding
+        npending -= len(indices)
+
+    def ready():
+        nonlocal nwritten
+        n = nwritten
+        while n in done:
+            n += 1
+        if n == nwritten:
+            return None
+        embeddings = np.stack([done.pop(i) for i in range(nwritten, n)])
+        nwritten = n
+        return embeddings
+
+    for sentences in buffers:
+        ids, starts, lengths, owners = encoder._split_long(
+            *encoder._tokenize_buffer(sentences)
+        )
+        nwindows = np.bincount(owners, minlength=len(sentences))
+        for i in np.flatnonzero(nwindows > 1).tolist():
+            windows[nread + i] = [nwindows[i], []]
+        for start, length, owner in zip(
+            starts.tolist(), lengths.tolist(), owners.tolist()
+        ):
+            index = nread + owner
+            key = length // bucket_width
+            bucket = buckets.get(key)
+            if (
+                bucket is not None
+                and encoder.max_tokens is not None
+                and bucket[2] + length > encoder.max_tokens
+            ):
+                emit(key)
+                bucket = None
+            if bucket is None:
+                bucket = buckets[key] = [[], [], 0]
+            bucket[0].append(index)
+            bucket[1].append(ids[start : start + length])
+            bucket[2] += length
+            npending += 1
+            if (
+                encoder.max_sentences is not None
+                and len(bucket[0]) == encoder.max_sentences
+            ):
+                emit(key)
+            while npending > window:
+                # flush the bucket holding the oldest pending sentence
+                emit(min(buckets, key=lambda k: buckets[k][0][0]))
+        nread += len(sentences)
+        embeddings = ready()
+        if embeddings is not None:
+            yield embeddings
+
+    while buckets:
+        emit(min(buckets, key=lambda k: buckets[k][0][0]))
+    embeddings = ready()
+    if embeddings is not None:
+        yield embeddings
+
+
+# Iterate over [iterable] in a background thread, through a bounded queue
+# The time spent producing items is added to busy[stage], and the time
+# spent waiting for them to busy[stage + "_wait"]
+def ReadAhead(iterable, queue_size, busy, stage):
+    items = queue.Queue(queue_size)
+    end = object()
+    error = []
+
+    def produce():
+        try:
+            it = iter(iterable)
+            while True:
+                t = time.perf_counter()
+                item = next(it, end)
+                busy[stage] += time.perf_counter() - t
+                if item is end:
+                    break
+                items.put(item)
+        except BaseException as e:
+            error.append(e)
+        items.put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        t = time.perf_counter()
+        item = items.get()
+        busy[stage + "_wait"] += time.perf_counter() - t
+        if item is end:
+            break
+        yield item
+    thread.join()
+    if error:
+        raise error[0]
+
+
+# Write embeddings to a raw binary file or an EmbeddingWriter
+def WriteEmbeddings(out_file, encoded, fp16=False):
+    if fp16:
+        encoded = encoded.astype(np.float16)
+    if isinstance(out_file, (EmbeddingWriter, ShardedEmbeddingWriter)):
+        out_file.write(encoded)
+    else:
+        encoded.tofile(out_file)
+
+
+# Write embeddings from a bounded queue in a background thread
+class EmbeddingWriterThread(threading.Thread):
+    def __init__(self, out_file, queue_size, busy, fp16=False, on_write=None):
+        super().__init__(daemon=True)
+        self.out_file = out_file
+        self.fp16 = fp16
+        self.busy = busy
+        self.on_write = on_write
+        self.nwritten = 0
+        self.items = queue.Queue(queue_size)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            encoded = self.items.get()
+            if encoded is None:
+                break
+            if self.error is not None:
+                continue
+            t = time.perf_counter()
+            try:
+                WriteEmbeddings(self.out_file, encoded, fp16=self.fp16)
+                self.nwritten += encoded.shape[0]
+                if self.on_write is not None:
+                    self.on_write(self.nwritten)
+            except BaseException as e:
+                self.error = e
+            self.busy["write"] += time.perf_counter() - t
+
+    def write(self, encoded):
+        if self.error is not None:
+            raise self.error
+        self.items.put(encoded)
+
+    def close(self):
+        self.items.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+# number of sentences between the progress reports of EncodeFilep
+PROGRESS_INTERVAL = 10000
+
+
 # Encode sentences (existing file pointers)
+# With pipelined=True, reading (and tokenizing) the next buffers and
+# writing the previous embeddings run in background threads, overlapping
+# with the forward pass
+# on_write is called with the total number of embeddings written
+# after each write
 def EncodeFilep(
-    encoder, inp_file, out_file, buffer_size=10000, fp16=False, verbose=False
+    encoder,
+    inp_file,
+    out_file,
+    buffer_size=10000,
+    fp16=False,
+    verbose=False,
+    bucket_window=0,
+    bucket_width=1,
+    pipelined=False,
+    queue_size=2,
+    on_write=None,
 ):
     n = 0
     t = time.time()
-    for sentences in buffered_read(inp_file, buffer_size):
-        encoded = encoder.encode_sentences(sentences)
-        if fp16:
-            encoded = encoded.astype(np.float16)
-        encoded.tofile(out_file)
-        n += len(sentences)
-        if verbose and n % 10000 == 0:
-            logger.info("encoded {:d} sentences".format(n))
+    busy = defaultdict(float)
+    # long lines affected by max_seq_len, counted by the encoder, the pool
+    # (summed over its workers) or the encoder of a cache
+    counter = encoder.encoder if isinstance(encoder, CachedSentenceEncoder) else encoder
+    long_lines = [getattr(counter, k, 0) for k in LONG_LINE_COUNTERS]
+    buffers = buffered_read(inp_file, buffer_size)
+    if pipelined:
+        if bucket_window == 0 and isinstance(encoder, SentenceEncoder):
+            # tokenize and batch in the read stage
+            buffers = ReadAhead(
+                (list(encoder._make_batches(b)) for b in buffers),
+                queue_size, busy, "read",
+            )
+            encode_sentences = encoder._encode_batches
+        else:
+            buffers = ReadAhead(buffers, queue_size, busy, "read")
+            encode_sentences = encoder.encode_sentences
+        writer = EmbeddingWriterThread(
+            out_file, queue_size, busy, fp16=fp16, on_write=on_write
+        )
+    else:
+        encode_sentences = encoder.encode_sentences
+        writer = None
+    if bucket_window > 0:
+        assert isinstance(
+            encoder, SentenceEncoder
+        ), "length bucketing is only supported by SentenceEncoder"
+        encoded_buffers = EncodeBucketed(
+            encoder, buffers, bucket_window, bucket_width=bucket_width
+        )
+    elif isinstance(encoder, SentenceEncoderPool):
+        encoded_buffers = encoder.encode_buffers(buffers)
+    else:
+        encoded_buffers = map(encode_sentences, buffers)
+    encoded_buffers = iter(encoded_buffers)
+    try:
+        while True:
+            t_encode = time.perf_counter()
+            encoded = next(encoded_buffers, None)
+            busy["encode"] += time.perf_counter() - t_encode
+            if encoded is None:
+                break
+            if writer is not None:
+                writer.write(encoded)
+            else:
+                WriteEmbeddings(out_file, encoded, fp16=fp16)
+                if on_write is not None:
+                    on_write(n + encoded.shape[0])
+            n += encoded.shape[0]
+            # the buffers of bucketed encoding have variable sizes
+            if verbose and n // PROGRESS_INTERVAL > (n - encoded.shape[0]) // PROGRESS_INTERVAL:
+                logger.info("encoded {:d} sentences".format(n))
+    finally:
+        # write the embeddings already encoded, even on error
+        if writer is not None:
+            writer.close()
     if verbose:
         logger.info(f"encoded {n} sentences in {EncodeTime(t)}")
+        ntruncated, nsplit, nwindows = (
+            getattr(counter, k, 0) - n0 for k, n0 in zip(LONG_LINE_COUNTERS, long_lines)
+        )
+        if ntruncated:
+            logger.info(
+                f"truncated {ntruncated} sentences to {counter.max_seq_len} tokens"
+            )
+        if nsplit:
+            logger.info(
+                f"split {nsplit} sentences longer than {counter.max_seq_len} tokens"
+                f" into {nsplit + nwindows} windows ({counter.long_lines} pooling)"
+            )
+        if pipelined:
+            # the encode stage does not count the time spent waiting for input
+            busy["encode"] -= busy["read_wait"]
+            wall = max(time.time() - t, 1e-6)
+            logger.info(
+                "stage utilization: "
+                + ", ".join(
+                    "{} {:.0f}%".format(stage, 100 * busy[stage] / wall)
+                    for stage in ("read", "encode", "write")
+                )
+            )
+
+
 
+# Read lines from a binary file, and append the pair (number of lines,
+# byte offset) to checkpoints every [every] lines
+# Lines only end at "\n", as read by the perl and SPM preprocessing: a
+# lone "\r" does not start a new line
+# Reading stops at the first line starting at or after the offset end
+def ReadLinesWithOffsets(fp, encoding, checkpoints, every, nlines=0, end=None):
+    offset = fp.tell()
+    for raw in fp:
+        if end is not None and offset >= end:
+            break
+        offset += len(raw)
+        nlines += 1
+        if nlines % every == 0:
+            checkpoints.append((nlines, offset))
+        yield raw.decode(encoding, errors="surrogateescape")
+
+
+# Identity of the checkpoint behind a (possibly wrapped) encoder
+def EncoderId(encoder):
+    while not hasattr(encoder, "model_path") and hasattr(encoder, "encoder"):
+        encoder = encoder.encoder
+    if not hasattr(encoder, "model_path"):
+        return None
+    return CheckpointId(encoder.model_path)
 
 
 # Encode sentences (file names)
+# out_format is "raw" (headerless matrix) or "npy" (see lib/embedding_format.py)
+# The embeddings are written to out_fname + ".tmp", which is renamed once
+# complete. After each buffer, the number of lines encoded and the matching
+# input and output byte offsets are saved in out_fname + ".progress", and an
+# interrupted job restarts from there, unless over_write is set
+# With shard_size > 0, the embeddings are split in shards out_fname.000, ...
+# of shard_size rows, and out_fname.manifest.json is written once complete
 def EncodeFile(
     encoder,
     inp_fname,
@@ -421,34 +1259,173 @@ def EncodeFile(
     verbose=False,
     over_write=False,
     inp_encoding="utf-8",
+    preprocess=None,
+    bucket_window=0,
+    bucket_width=1,
+    pipelined=False,
+    out_format="raw",
+    shard_size=0,
 ):
-    # TODO :handle over write
-    if not os.path.isfile(out_fname):
+    assert out_format in ("raw", "npy"), f"unknown output format: {out_format}"
+    # preprocess: optional function mapping the input lines to the lines
+    # to encode, e.g. in memory tokenization, BPE or SPM
+    done_fname = ManifestFname(out_fname) if shard_size > 0 else out_fname
+    if over_write or not os.path.isfile(done_fname):
+        tmp_fname = out_fname + ".tmp"
+        progress_fname = out_fname + ".progress"
+        progress = {"lines": 0, "input_offset": 0, "output_offset": 0}
+        if over_write:
+            # start again, without resuming a previous partial output
+            stale = [progress_fname, tmp_fname]
+            if shard_size > 0:
+                # the shards are rewritten in place
+                stale.append(done_fname)
+                stale += glob.glob(glob.escape(out_fname) + ".[0-9][0-9][0-9]*.tmp")
+            for fname in stale:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+        if len(inp_fname) > 0 and os.path.isfile(progress_fname) and (
+            shard_size > 0 or os.path.isfile(tmp_fname)
+        ):
+            with open(progress_fname) as fp:
+                saved = json.load(fp)
+            if (
+                saved.get("input") == os.path.realpath(inp_fname)
+                and saved.get("input_size") == os.path.getsize(inp_fname)
+            ):
+                progress = saved
         if verbose:
             logger.info(
-                "encoding {} to {}".format(
-                    inp_fname if len(inp_fname) > 0 else "stdin", out_fname,
+                "encoding {} to {}{}".format(
+                    inp_fname if len(inp_fname) > 0 else "stdin",
+                    out_fname,
+                    " (resuming after {} lines)".format(progress["lines"])
+                    if progress["lines"] > 0
+                    else "",
                 )
             )
-        fin = (
-            open(inp_fname, "r", encoding=inp_encoding, errors="surrogateescape")
-            if len(inp_fname) > 0
-            else sys.stdin
-        )
-        fout = open(out_fname, mode="wb")
+        if shard_size > 0:
+            fout = None
+        elif progress["lines"] > 0:
+            fout = open(tmp_fname, mode="r+b")
+            fout.truncate(progress["output_offset"])
+            fout.seek(progress["output_offset"])
+        else:
+            fout = open(tmp_fname, mode="wb")
+
+        checkpoints = deque()
+        if len(inp_fname) > 0:
+            fin = open(inp_fname, "rb")
+            fin.seek(progress["input_offset"])
+            lines = ReadLinesWithOffsets(
+                fin, inp_encoding, checkpoints, buffer_size, nlines=progress["lines"]
+            )
+        else:
+            fin = sys.stdin
+            lines = (
+                raw.decode(inp_encoding, errors="surrogateescape")
+                for raw in sys.stdin.buffer
+            )
+
+        out_file = fout
+        if shard_size > 0:
+            out_file = ShardedEmbeddingWriter(
+                out_fname,
+                shard_size,
+                dim=progress.get("dim"),
+                dtype=np.float16 if fp16 else np.float32,
+                storage=out_format,
+                count=progress["lines"],
+                encoder=EncoderId(encoder),
+            )
+        elif out_format == "npy":
+            out_file = EmbeddingWriter(
+                fout,
+                dim=progress.get("dim"),
+                dtype=np.float16 if fp16 else np.float32,
+                count=progress["lines"],
+                encoder=EncoderId(encoder),
+                fname=out_fname,
+                sidecar=False,
+            )
+
+        def save_progress(nwritten):
+            # nwritten counts the embeddings written by this run only
+            nwritten += progress["lines"]
+            durable = None
+            while checkpoints and checkpoints[0][0] <= nwritten:
+                durable = checkpoints.popleft()
+            if durable is None:
+                return
+            if shard_size > 0:
+                # the sharded writer truncates the last shard when resuming
+                out_file.sync()
+                saved = {
+                    "input": os.path.realpath(inp_fname),
+                    "input_size": os.path.getsize(inp_fname),
+                    "lines": durable[0],
+                    "input_offset": durable[1],
+                    "dim": out_file.dim,
+                }
+                with open(progress_fname + ".tmp", "w") as fp:
+                    json.dump(saved, fp)
+                os.replace(progress_fname + ".tmp", progress_fname)
+                return
+            fout.flush()
+            os.fsync(fout.fileno())
+            # position of the first row written by this run
+            data_start = max(
+                progress["output_offset"], HEADER_SIZE if out_format == "npy" else 0
+            )
+            row_bytes = (fout.tell() - data_start) // (nwritten - progress["lines"])
+            saved = {
+                "input": os.path.realpath(inp_fname),
+                "input_size": os.path.getsize(inp_fname),
+                "lines": durable[0],
+                "input_offset": durable[1],
+                "output_offset": data_start
+                + (durable[0] - progress["lines"]) * row_bytes,
+            }
+            if out_format == "npy":
+                saved["dim"] = out_file.dim
+            with open(progress_fname + ".tmp", "w") as fp:
+                json.dump(saved, fp)
+            os.replace(progress_fname + ".tmp", progress_fname)
+
         EncodeFilep(
-            encoder, fin, fout, buffer_size=buffer_size, fp16=fp16, verbose=verbose
+            encoder,
+            preprocess(lines) if preprocess else lines,
+            out_file,
+            buffer_size=buffer_size,
+            fp16=fp16,
+            verbose=verbose,
+            bucket_window=bucket_window,
+            bucket_width=bucket_width,
+            pipelined=pipelined,
+            on_write=save_progress if len(inp_fname) > 0 else None,
         )
         fin.close()
-        fout.close()
-    elif not over_write and verbose:
+        if shard_size > 0:
+            out_file.close()
+        else:
+            if out_format == "npy":
+                out_file.close()
+            fout.close()
+            os.replace(tmp_fname, out_fname)
+            if out_format == "npy":
+                # the sidecar only describes a complete file
+                out_file.write_meta()
+        if os.path.isfile(progress_fname):
+            os.remove(progress_fname)
+    elif verbose:
         logger.info("encoder: {} exists already".format(os.path.basename(out_fname)))
 
 
 # Load existing embeddings
 def EmbedLoad(fname, dim=1024, verbose=False, fp16=False):
-    x = np.fromfile(fname, dtype=(np.float16 if fp16 else np.float32), count=-1)
-    x.resize(x.shape[0] // dim, dim)
+    x = LoadEmbeddings(
+        fname, dim=dim, dtype=np.float16 if fp16 else np.float32, mmap=False
+    )
     if verbose:
         print(" - Embeddings: {:s}, {:d}x{:d}".format(fname, x.shape[0], dim))
     return x
@@ -456,13 +1433,41 @@ def EmbedLoad(fname, dim=1024, verbose=False, fp16=False):
 
 # Get memory mapped embeddings
 def EmbedMmap(fname, dim=1024, dtype=np.float32, verbose=False):
-    nbex = int(os.path.getsize(fname) / dim / np.dtype(dtype).itemsize)
-    E = np.memmap(fname, mode="r", dtype=dtype, shape=(nbex, dim))
+    E = LoadEmbeddings(fname, dim=dim, dtype=dtype, mmap=True)
     if verbose:
-        print(" - embeddings on disk: {:s} {:d} x {:d}".format(fname, nbex, dim))
+        print(" - embeddings on disk: {:s} {:d} x {:d}".format(fname, E.shape[0], dim))
     return E
 
 
+# In memory preprocessing of the input lines (see EncodeFile)
+def StreamPreprocess(
+    bpe_codes=None, spm_model=None, spm_lang="en", buffer_size=10000, token_lang="--"
+):
+    preprocess = None
+    if bpe_codes:
+        preprocess = partial(
+            BPEfastApplyLines, bpe_codes=bpe_codes, buffer_size=buffer_size
+        )
+    elif spm_model:
+        preprocess = partial(
+            SPMApplyLines,
+            spm_model=spm_model,
+            lang=spm_lang,
+            lower_case=True,
+            buffer_size=buffer_size,
+        )
+    if token_lang == "--":
+        return preprocess
+    # Moses tokenization in Python, as Token(engine="python")
+    if token_lang in ("cmn", "wuu", "yue"):
+        token_lang = "zh"
+    assert token_lang not in ("ja", "jpn"), "no Python tokenizer for Japanese"
+    tokenize = partial(TokenLines, lang=token_lang, romanize=token_lang == "el")
+    if preprocess is None:
+        return tokenize
+    return lambda lines: preprocess(tokenize(lines))
+
+
 def embed_sentences(
     ifname: str,
     output: str,
@@ -470,6 +1475,8 @@ def embed_sentences(
     encoder_path: str = None,
     hugging_face = False,
     token_lang: Optional[str] = "--",
+    token_engine: str = "perl",
+    token_workers: Optional[int] = None,
     custom_tokenizer: Optional[str] = None,
     custom_vocab_file: Optional[str] = None,
     bpe_codes: Optional[str] = None,
@@ -482,6 +1489,20 @@ def embed_sentences(
     cpu: bool = False,
     fp16: bool = False,
     sort_kind: str = "quicksort",
+    stream: bool = False,
+    num_workers: int = 0,
+    num_threads: int = 1,
+    bucket_window: int = 0,
+    bucket_width: int = 1,
+    pipelined: bool = False,
+    cache_dir: Optional[str] = None,
+    cache_size: int = 1024,
+    quantize: Optional[str] = None,
+    bf16: bool = False,
+    max_seq_len: Optional[int] = None,
+    long_lines: str = "truncate",
+    out_format: str = "raw",
+    shard_size: int = 0,
 ):
     assert encoder or encoder_path, "Provide initialised encoder or encoder_path"
     buffer_size = max(buffer_size, 1)
@@ -495,6 +1516,10 @@ def embed_sentences(
         (bpe_codes and spm_model)
     ), "Cannot specify both spm, bpe and/or custom tokenizer"
 
+    assert not (
+        bucket_window > 0 and (num_workers > 0 or cache_dir)
+    ), "length bucketing cannot be combined with worker processes or a cache"
+
     if custom_tokenizer:
         assert custom_tokenizer.endswith(".py"), "Custom tokenizer must be a Python script that reads standard input"
 
@@ -511,57 +1536,112 @@ def embed_sentences(
             max_tokens=max_tokens,
             sort_kind=sort_kind,
             cpu=cpu,
+            quantize=quantize,
+            bf16=bf16,
+            max_seq_len=max_seq_len,
+            long_lines=long_lines,
         )
-    if not ifname:
-        ifname = ""  # default to stdin
-    with tempfile.TemporaryDirectory() as tmpdir:
-        if token_lang != "--":
-            tok_fname = os.path.join(tmpdir, "tok")
-            Token(
+    with ExitStack() as stack:
+        if num_workers > 0:
+            encoder = stack.enter_context(
+                SentenceEncoderPool(
+                    encoder, num_workers, num_threads=num_threads, verbose=verbose
+                )
+            )
+        if cache_dir:
+            encoder = stack.enter_context(
+                CachedSentenceEncoder(
+                    encoder, cache_dir, max_size=cache_size, verbose=verbose
+                )
+            )
+        if not ifname:
+            ifname = ""  # default to stdin
+        if stream:
+            # preprocess and encode buffer by buffer in memory
+            assert not custom_tokenizer, "Custom tokenizers are not supported in stream mode"
+            # Moses tokenization is only available in Python, which is not
+            # guaranteed to match the perl scripts (see tokenize_text.py --verify)
+            assert (
+                token_lang == "--" or token_engine == "python"
+            ), "--stream only tokenizes with --token-engine python"
+            preprocess = StreamPreprocess(
+                bpe_codes=bpe_codes,
+                spm_model=spm_model,
+                spm_lang=spm_lang,
+                buffer_size=buffer_size,
+                token_lang=token_lang,
+            )
+            EncodeFile(
+                encoder,
                 ifname,
-                tok_fname,
-                lang=token_lang,
-                romanize=True if token_lang == "el" else False,
-                lower_case=True,
-                gzip=False,
+                output,
                 verbose=verbose,
                 over_write=False,
+                buffer_size=buffer_size,
+                fp16=fp16,
+                preprocess=preprocess,
+                bucket_window=bucket_window,
+                bucket_width=bucket_width,
+                pipelined=pipelined,
+                out_format=out_format,
+                shard_size=shard_size,
             )
-            ifname = tok_fname
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if token_lang != "--":
+                tok_fname = os.path.join(tmpdir, "tok")
+                Token(
+                    ifname,
+                    tok_fname,
+                    lang=token_lang,
+                    romanize=True if token_lang == "el" else False,
+                    lower_case=True,
+                    gzip=False,
+                    verbose=verbose,
+                    over_write=False,
+                    engine=token_engine,
+                    num_workers=token_workers,
+                )
+                ifname = tok_fname
         
-        if bpe_codes:
-            if ifname == "":  # stdin
-                ifname = os.path.join(tmpdir, "no_tok")
-                run(f'cat > {ifname}', shell=True)
-            bpe_fname = os.path.join(tmpdir, "bpe")
-            BPEfastApply(
-                ifname, bpe_fname, bpe_codes, verbose=verbose, over_write=False
-            )
-            ifname = bpe_fname
+            if bpe_codes:
+                if ifname == "":  # stdin
+                    ifname = os.path.join(tmpdir, "no_tok")
+                    run(f'cat > {ifname}', shell=True)
+                bpe_fname = os.path.join(tmpdir, "bpe")
+                BPEfastApply(
+                    ifname, bpe_fname, bpe_codes, verbose=verbose, over_write=False
+                )
+                ifname = bpe_fname
+
+            if spm_model or custom_tokenizer:
+                spm_fname = os.path.join(tmpdir, "spm")
+                SPMApply(
+                    ifname,
+                    spm_fname,
+                    spm_model,
+                    custom_tokenizer=custom_tokenizer,
+                    lang=spm_lang,
+                    lower_case=True,
+                    verbose=verbose,
+                    over_write=False,
+                )
+                ifname = spm_fname
 
-        if spm_model or custom_tokenizer:
-            spm_fname = os.path.join(tmpdir, "spm")
-            SPMApply(
+            EncodeFile(
+                encoder,
                 ifname,
-                spm_fname,
-                spm_model,
-                custom_tokenizer=custom_tokenizer,
-                lang=spm_lang,
-                lower_case=True,
+                output,
                 verbose=verbose,
                 over_write=False,
+                buffer_size=buffer_size,
+                fp16=fp16,
+                bucket_window=bucket_window,
+                bucket_width=bucket_width,
+                pipelined=pipelined,
+                out_format=out_format,
+                shard_size=shard_size,
             )
-            ifname = spm_fname
-
-        EncodeFile(
-            encoder,
-            ifname,
-            output,
-            verbose=verbose,
-            over_write=False,
-            buffer_size=buffer_size,
-            fp16=fp16,
-        )
 
 
 if __name__ == "__main__":
@@ -576,6 +1656,20 @@ if __name__ == "__main__":
         default="--",
         help="Perform tokenization with given language ('--' for no tokenization)",
     )
+    parser.add_argument(
+        "--token-engine",
+        type=str,
+        default="perl",
+        choices=["perl", "python"],
+        help="Tokenize with the Moses perl scripts, or in Python on --token-workers "
+        "processes (required to tokenize with --stream)",
+    )
+    parser.add_argument(
+        "--token-workers",
+        type=int,
+        default=None,
+        help="Number of processes of the Python tokenizer (default: all cores)",
+    )
     parser.add_argument(
         "--bpe-codes", type=str, default=None, help="Apply BPE using specified codes"
     )
@@ -610,7 +1704,46 @@ if __name__ == "__main__":
         action="store_true",
         help="Store embedding matrices in fp16 instead of fp32",
     )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        default="raw",
+        choices=["raw", "npy"],
+        help="Store embeddings as a raw matrix, or as .npy with a JSON sidecar",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="Split the embeddings in shards OUTPUT.000, OUTPUT.001, ... of this many sentences, listed in OUTPUT.manifest.json (0 for a single file)",
+    )
     parser.add_argument("--cpu", action="store_true", help="Use CPU instead of GPU")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Dynamic quantization of the encoder for CPU inference",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Compute in bfloat16 (transformer encoders, CPUs with AVX512-BF16 or AMX)",
+    )
+    parser.add_argument(
+        "--max-seq-len",
+        type=int,
+        default=None,
+        help="Maximal number of tokens of a sentence, including BOS/EOS",
+    )
+    parser.add_argument(
+        "--long-lines",
+        type=str,
+        default="truncate",
+        choices=["truncate", "max", "mean"],
+        help="Truncate longer sentences, or split them into windows of --max-seq-len "
+        "tokens whose embeddings are pooled (max or mean)",
+    )
     parser.add_argument(
         "--sort-kind",
         type=str,
@@ -627,12 +1760,62 @@ if __name__ == "__main__":
     parser.add_argument(
         "--custom-tokenizer", type=str, default=None, help="Use specified tokenizer script after preprocessing and before encoding. Expects a Python script that reads standard input."
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of CPU worker processes used for encoding (0 to encode in the main process)",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="Number of threads used by each CPU worker process",
+    )
+    parser.add_argument(
+        "--bucket-window",
+        type=int,
+        default=0,
+        help="Batch sentences of similar length across buffers, keeping at most this many sentences pending (0 to batch within each buffer)",
+    )
+    parser.add_argument(
+        "--bucket-width",
+        type=int,
+        default=1,
+        help="Width (in tokens) of the length buckets used with --bucket-window",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap reading, encoding and writing in separate threads",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent cache of sentence embeddings",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="Size budget of a new embedding cache (MB)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Preprocess and encode in memory, without temporary files or external tools",
+    )
 
     args = parser.parse_args()
+    if args.bucket_window > 0 and (args.num_workers > 0 or args.cache_dir):
+        parser.error("--bucket-window cannot be combined with --num-workers or --cache-dir")
     embed_sentences(
         ifname=args.input,
         encoder_path=args.encoder,
         token_lang=args.token_lang,
+        token_engine=args.token_engine,
+        token_workers=args.token_workers,
         custom_tokenizer=args.custom_tokenizer,
         custom_vocab_file=args.custom_vocab_file,
         bpe_codes=args.bpe_codes,
@@ -647,4 +1830,18 @@ if __name__ == "__main__":
         cpu=args.cpu,
         fp16=args.fp16,
         sort_kind=args.sort_kind,
+        stream=args.stream,
+        num_workers=args.num_workers,
+        num_threads=args.num_threads,
+        bucket_window=args.bucket_window,
+        bucket_width=args.bucket_width,
+        pipelined=args.pipelined,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        quantize=args.quantize,
+        bf16=args.bf16,
+        max_seq_len=args.max_seq_len,
+        long_lines=args.long_lines,
+        out_format=args.output_format,
+        shard_size=args.shard_size,
     )
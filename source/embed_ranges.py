@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Embed a single large input file in parallel, by splitting it in byte
+# ranges aligned to line boundaries:
+#  - each range is embedded (in memory preprocessing, as embed.py --stream)
+#    to OUTPUT.range-IIIII-of-NNNNN, renamed once complete
+#  - the ranges are embedded by local worker processes, with retries of the
+#    failed ranges, or one at a time with --range-index (e.g. one job per
+#    node on a shared filesystem)
+#  - once all ranges are embedded, they are merged in input order into
+#    OUTPUT, or renamed into the shards OUTPUT.000, ... listed in
+#    OUTPUT.manifest.json (one shard per range: --num-ranges sets their size)
+# Ranges already embedded are skipped, so that running the command again
+# embeds the missing ranges and merges.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+from embed import (
+    EncodeFilep,
+    EncodeTime,
+    EncoderId,
+    ReadLinesWithOffsets,
+    StreamPreprocess,
+    load_model,
+)
+from lib.embedding_format import (
+    EmbeddingWriter,
+    LoadEmbeddings,
+    MetaFname,
+    ReadMeta,
+    ShardFname,
+    WriteManifest,
+    WriteMeta,
+    FileDigest,
+)
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+)
+logger = logging.getLogger("embed_ranges")
+
+
+# Split a file in num_ranges byte ranges [start, end), each starting
+# at the beginning of a line
+def LineAlignedRanges(fname, num_ranges):
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, "rb") as fp:
+        for i in range(1, num_ranges):
+            offset = max(size * i // num_ranges, bounds[-1])
+            if offset > 0:
+                # move to the start of the next line
+                fp.seek(offset - 1)
+                fp.readline()
+                offset = fp.tell()
+            bounds.append(min(offset, size))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def RangeFname(out_fname, index, num_ranges):
+    return "{}.range-{:05d}-of-{:05d}".format(out_fname, index, num_ranges)
+
+
+def RangeDone(out_fname, index, num_ranges):
+    fname = RangeFname(out_fname, index, num_ranges)
+    return os.path.isfile(fname) and os.path.isfile(MetaFname(fname))
+
+
+# Embed the lines of the byte range [start, end) of inp_fname
+# The embeddings are stored in the given format with a sidecar, which also
+# records the number of rows, and renamed once complete
+def EmbedRange(
+    encoder,
+    inp_fname,
+    start,
+    end,
+    out_fname,
+    preprocess=None,
+    buffer_size=10000,
+    fp16=False,
+    out_format="raw",
+    inp_encoding="utf-8",
+):
+    dtype = np.float16 if fp16 else np.float32
+    nlines = 0
+    nrows = 0
+
+    def count_lines(lines):
+        nonlocal nlines
+        for line in lines:
+            nlines += 1
+            yield line
+
+    def count_rows(nwritten):
+        nonlocal nrows
+        nrows = nwritten
+
+    tmp_fname = out_fname + ".tmp"
+    with open(inp_fname, "rb") as fin, open(tmp_fname, "wb") as fout:
+        fin.seek(start)
+        lines = count_lines(
+            ReadLinesWithOffsets(fin, inp_encoding, [], buffer_size, end=end)
+        )
+        out_file = fout
+        if out_format == "npy":
+            out_file = EmbeddingWriter(fout, dtype=dtype, sidecar=False)
+        EncodeFilep(
+            encoder,
+            preprocess(lines) if preprocess else lines,
+            out_file,
+            buffer_size=buffer_size,
+            fp16=fp16,
+            on_write=count_rows,
+        )
+        assert nrows == nlines, f"{nrows} embeddings for {nlines} lines"
+        dim = None
+        if out_format == "npy":
+            # an empty file without embeddings
+            out_file.close()
+            dim = out_file.dim
+        elif nrows > 0:
+            dim = fout.tell() // nrows // np.dtype(dtype).itemsize
+    os.replace(tmp_fname, out_fname)
+    # a range is complete once its sidecar exists
+    WriteMeta(out_fname, nrows, dim, dtype, encoder=EncoderId(encoder))
+    return nrows
+
+
+# encoder and options of the current worker process
+_worker = {}
+
+
+def _worker_init(args):
+    torch.set_num_threads(args.num_threads)
+    _worker["encoder"] = load_model(
+        args.encoder,
+        args.spm_model,
+        args.bpe_codes,
+        verbose=args.verbose,
+        max_sentences=args.max_sentences,
+        max_tokens=args.max_tokens,
+        cpu=args.cpu,
+        quantize=args.quantize,
+        bf16=args.bf16,
+        max_seq_len=args.max_seq_len,
+        long_lines=args.long_lines,
+    )
+    _worker["preprocess"] = StreamPreprocess(
+        bpe_codes=args.bpe_codes,
+        spm_model=args.spm_model,
+        spm_lang=args.spm_lang,
+        buffer_size=args.buffer_size,
+        token_lang=args.token_lang,
+    )
+    _worker["args"] = args
+
+
+def _worker_embed(index, start, end):
+    args = _worker["args"]
+    return EmbedRange(
+        _worker["encoder"],
+        args.input,
+        start,
+        end,
+        RangeFname(args.output, index, args.num_ranges),
+        preprocess=_worker["preprocess"],
+        buffer_size=args.buffer_size,
+        fp16=args.fp16,
+        out_format=args.output_format,
+    )
+
+
+# Embed the given ranges with num_workers local processes
+# A failed range is retried up to max_retries times. When a worker crashes,
+# the pool is broken and all its unfinished ranges fail: the ranges which
+# were not started are embedded again without counting a retry, and the
+# ranges which were being embedded (their .tmp file exists) are embedded
+# again one at a time, so that the crash is only counted for its range.
+def EmbedRanges(args, ranges, indices):
+    attempts = {index: 0 for index in indices}
+    pending = list(indices)
+    isolated = []  # ranges to embed alone in a pool
+    ctx = multiprocessing.get_context("spawn")
+
+    def retry(index, error):
+        attempts[index] += 1
+        logger.warning(f"range {index} failed (attempt {attempts[index]}): {error!r}")
+        assert (
+            attempts[index] <= args.max_retries
+        ), f"range {index} failed {attempts[index]} times, giving up"
+
+    while pending or isolated:
+        if isolated:
+            batch = [isolated.pop(0)]
+        else:
+            batch, pending = pending, []
+        for index in batch:
+            tmp_fname = RangeFname(args.output, index, args.num_ranges) + ".tmp"
+            if os.path.isfile(tmp_fname):
+                os.remove(tmp_fname)
+        crashed = []
+        with ProcessPoolExecutor(
+            max_workers=min(args.num_workers, len(batch)),
+            mp_context=ctx,
+            initializer=_worker_init,
+            initargs=(args,),
+        ) as pool:
+            futures = {
+                pool.submit(_worker_embed, index, *ranges[index]): index
+                for index in batch
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    nrows = future.result()
+                    if args.verbose:
+                        logger.info(f"range {index}: {nrows} sentences")
+                except BrokenProcessPool as e:
+                    if not RangeDone(args.output, index, args.num_ranges):
+                        crashed.append((index, e))
+                except Exception as e:
+                    retry(index, e)
+                    pending.append(index)
+        if len(batch) == 1:
+            for index, e in crashed:
+                retry(index, e)
+                isolated.append(index)
+        elif crashed:
+            started = [
+                index
+                for index, _ in crashed
+                if os.path.isfile(RangeFname(args.output, index, args.num_ranges) + ".tmp")
+            ]
+            # a crash before any range was started (e.g. loading the
+            # encoder) is attributed to each range alone
+            isolated += started or [index for index, _ in crashed]
+            pending += [index for index, _ in crashed if index not in isolated]
+            logger.warning(
+                f"a worker crashed while embedding ranges {started}, "
+                "embedding them again one at a time"
+            )
+        pending.sort()
+
+
+# Merge the embedded ranges in input order
+# "concat" writes a single file, "shards" renames the ranges into the
+# shards of a manifest (without copying): one shard per non empty range,
+# of the size of the ranges
+def MergeRanges(out_fname, num_ranges, out_format="raw", merge="concat", verbose=False):
+    parts = [RangeFname(out_fname, i, num_ranges) for i in range(num_ranges)]
+    metas = [ReadMeta(part) for part in parts]
+    dims = {meta["dim"] for meta in metas if meta["count"] > 0}
+    assert len(dims) <= 1, f"ranges of different dimensions: {dims}"
+    dim = dims.pop() if dims else None
+    dtype = metas[0]["dtype"]
+    encoder = metas[0]["encoder"]
+    count = sum(meta["count"] for meta in metas)
+    if merge == "shards":
+        shards = []
+        start = 0
+        for part, meta in zip(parts, metas):
+            if meta["count"] == 0:
+                continue
+            fname = ShardFname(out_fname, len(shards))
+            os.replace(part, fname)
+            shards.append({
+                "file": os.path.basename(fname),
+                "start": start,
+                "rows": meta["count"],
+                "sha256": FileDigest(fname),
+            })
+            start += meta["count"]
+        WriteManifest(out_fname, shards, dim, dtype, out_format, encoder=encoder)
+    else:
+        tmp_fname = out_fname + ".tmp"
+        with open(tmp_fname, "wb") as fout:
+            if out_format == "npy":
+                writer = EmbeddingWriter(
+                    fout, dim=dim, dtype=dtype, encoder=encoder, fname=out_fname,
+                    sidecar=False,
+                )
+                for part, meta in zip(parts, metas):
+                    if meta["count"] > 0:
+                        x = LoadEmbeddings(part, mmap=True)
+                        for i in range(0, x.shape[0], 100000):
+                            writer.write(np.asarray(x[i : i + 100000]))
+                writer.close()
+            else:
+                for part in parts:
+                    with open(part, "rb") as fin:
+                        shutil.copyfileobj(fin, fout, 1 << 24)
+        os.replace(tmp_fname, out_fname)
+        if out_format == "npy":
+            writer.write_meta()
+    for part in parts:
+        for fname in (part, MetaFname(part)):
+            if os.path.isfile(fname):
+                os.remove(fname)
+    if verbose:
+        logger.info(
+            "merged {:d} ranges into {:s}: {:d} sentences".format(
+                num_ranges, out_fname, count
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="LASER: Embed a large file in parallel byte ranges"
+    )
+    parser.add_argument("-i", "--input", type=str, required=True, help="Input text file")
+    parser.add_argument("--encoder", type=str, required=True, help="encoder to be used")
+    parser.add_argument(
+        "--token-lang",
+        type=str,
+        default="--",
+        help="Perform tokenization (in Python) with given language ('--' for no tokenization)",
+    )
+    parser.add_argument(
+        "--bpe-codes", type=str, default=None, help="Apply BPE using specified codes"
+    )
+    parser.add_argument(
+        "--spm-lang", type=str, default="en", help="Apply SPM using specified language"
+    )
+    parser.add_argument(
+        "--spm-model", type=str, default=None, help="Apply SPM using specified model"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Detailed output")
+    parser.add_argument(
+        "-o", "--output", required=True, help="Output sentence embeddings"
+    )
+    parser.add_argument(
+        "--buffer-size", type=int, default=10000, help="Buffer size (sentences)"
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=12000,
+        help="Maximum number of tokens to process in a batch",
+    )
+    parser.add_argument(
+        "--max-sentences",
+        type=int,
+        default=None,
+        help="Maximum number of sentences to process in a batch",
+    )
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Store embedding matrices in fp16 instead of fp32",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        default="raw",
+        choices=["raw", "npy"],
+        help="Store embeddings as a raw matrix, or as .npy with a JSON sidecar",
+    )
+    parser.add_argument("--cpu", action="store_true", help="Use CPU instead of GPU")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Dynamic quantization of the encoder for CPU inference",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Compute in bfloat16 (transformer encoders, CPUs with AVX512-BF16 or AMX)",
+    )
+    parser.add_argument(
+        "--max-seq-len",
+        type=int,
+        default=None,
+        help="Maximal number of tokens of a sentence, including BOS/EOS",
+    )
+    parser.add_argument(
+        "--long-lines",
+        type=str,
+        default="truncate",
+        choices=["truncate", "max", "mean"],
+        help="Truncate longer sentences, or split them into windows of --max-seq-len "
+        "tokens whose embeddings are pooled (max or mean)",
+    )
+    parser.add_argument(
+        "--num-ranges",
+        type=int,
+        required=True,
+        help="Number of byte ranges the input is split in",
+    )
+    parser.add_argument(
+        "--range-index",
+        type=int,
+        default=None,
+        help="Only embed this range (without merging), e.g. on one node of a cluster",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="Number of local worker processes",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="Number of threads used by each worker process",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="Number of times a failed range is embedded again",
+    )
+    parser.add_argument(
+        "--merge",
+        type=str,
+        default="concat",
+        choices=["concat", "shards"],
+        help="Merge the ranges into a single file, or rename them into shards listed in "
+        "OUTPUT.manifest.json (one shard per range, as many as --num-ranges)",
+    )
+    args = parser.parse_args()
+
+    ranges = LineAlignedRanges(args.input, args.num_ranges)
+    t = time.time()
+    if args.range_index is not None:
+        assert (
+            0 <= args.range_index < args.num_ranges
+        ), f"--range-index must be in [0, {args.num_ranges})"
+        indices = [args.range_index]
+    else:
+        indices = range(args.num_ranges)
+    indices = [i for i in indices if not RangeDone(args.output, i, args.num_ranges)]
+    if args.verbose:
+        logger.info(
+            "embedding {:d}/{:d} ranges of {:s} with {:d} workers".format(
+                len(indices), args.num_ranges, args.input, args.num_workers
+            )
+        )
+    EmbedRanges(args, ranges, indices)
+    if args.range_index is None:
+        MergeRanges(
+            args.output,
+            args.num_ranges,
+            out_format=args.output_format,
+            merge=args.merge,
+            verbose=args.verbose,
+        )
+    if args.verbose:
+        logger.info(f"done in {EncodeTime(t)}")
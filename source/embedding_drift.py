@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Tool to check the accuracy of an optimized inference mode of an encoder
+# (int8 quantization or bf16) against the reference fp32 embeddings:
+#  - cosine drift between the embeddings of the same sentences
+#  - xSIM error of both encoders on the Tatoeba test sets
+
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import numpy as np
+from pathlib import Path
+from tabulate import tabulate
+
+from embed import embed_sentences, load_model, EmbedLoad
+from xsim import xSIM
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+)
+logger = logging.getLogger("embedding_drift")
+
+
+def CosineDrift(x, y):
+    cos = (x * y).sum(axis=1) / (
+        np.linalg.norm(x, axis=1) * np.linalg.norm(y, axis=1) + 1e-12
+    )
+    return 1.0 - cos
+
+
+def Embed(encoder, fname, out_fname, args, lang):
+    embed_sentences(
+        fname,
+        out_fname,
+        encoder=encoder,
+        spm_model=args.spm_model,
+        bpe_codes=args.bpe_codes,
+        token_lang=lang if args.bpe_codes else "--",
+        buffer_size=args.buffer_size,
+        verbose=args.verbose,
+    )
+    return EmbedLoad(out_fname, dim=args.embedding_dimension)
+
+
+def CompareEncoders(ref_encoder, encoder, langs, args):
+    outputs = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for lang in langs:
+            embeddings = {}
+            for side in (lang, "eng"):
+                fname = Path(args.data) / f"tatoeba.{lang}-eng.{side}"
+                assert fname.exists(), f"{fname} does not exist"
+                for name, enc in (("ref", ref_encoder), ("new", encoder)):
+                    embeddings[name, side] = Embed(
+                        enc, str(fname), str(tmpdir / f"{name}.{lang}-eng.{side}"),
+                        args, side,
+                    )
+            drift = np.concatenate([
+                CosineDrift(embeddings["ref", side], embeddings["new", side])
+                for side in (lang, "eng")
+            ])
+            errors = []
+            for name in ("ref", "new"):
+                err, nbex, _ = xSIM(
+                    embeddings[name, lang].copy(),
+                    embeddings[name, "eng"].copy(),
+                    dim=args.embedding_dimension,
+                )
+                errors.append(100 * err / nbex)
+            outputs.append([
+                f"{lang}-eng", f"{drift.mean():.2e}", f"{drift.max():.2e}",
+                f"{errors[0]:.2f}", f"{errors[1]:.2f}", nbex,
+            ])
+    print(tabulate(
+        outputs,
+        headers=["pair", "mean drift", "max drift", "xSIM ref (%)", "xSIM new (%)", "nbex"],
+        tablefmt="psql",
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="LASER: compare an optimized inference mode to the fp32 reference")
+    parser.add_argument("--encoder", type=str, required=True, help="Encoder to be used")
+    parser.add_argument("--spm-model", type=str, default=None, help="SPM model of the encoder")
+    parser.add_argument("--bpe-codes", type=str, default=None, help="BPE codes of the encoder")
+    parser.add_argument(
+        "--data", type=str,
+        default=os.path.join(os.environ.get("LASER", "."), "data/tatoeba/v1"),
+        help="Directory with the Tatoeba test sets",
+    )
+    parser.add_argument(
+        "--langs", type=str, nargs="+", default=["deu", "fra", "spa", "rus", "cmn", "ara"],
+        help="Languages to compare (paired with English)",
+    )
+    parser.add_argument(
+        "--quantize", type=str, default=None, choices=["int8"],
+        help="Dynamic quantization of the encoder to compare",
+    )
+    parser.add_argument(
+        "--bf16", action="store_true",
+        help="Compare bf16 inference of the encoder",
+    )
+    parser.add_argument("--buffer-size", type=int, default=10000, help="Buffer size (sentences)")
+    parser.add_argument(
+        "--max-tokens", type=int, default=12000,
+        help="Maximum number of tokens to process in a batch",
+    )
+    parser.add_argument("--embedding-dimension", type=int, default=1024)
+    parser.add_argument("--verbose", action="store_true", help="Detailed output")
+    args = parser.parse_args()
+    assert args.quantize or args.bf16, "specify --quantize or --bf16"
+
+    encoder_args = dict(max_tokens=args.max_tokens, cpu=True, verbose=args.verbose)
+    ref_encoder = load_model(args.encoder, args.spm_model, args.bpe_codes, **encoder_args)
+    encoder = load_model(
+        args.encoder, args.spm_model, args.bpe_codes,
+        quantize=args.quantize, bf16=args.bf16, **encoder_args,
+    )
+    CompareEncoders(ref_encoder, encoder, args.langs, args)
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Registry of the per-language encoders, for services embedding
+# sentences in many languages:
+#  - the encoders are loaded on first use, following the naming of
+#    tasks/embed/embed.sh (laser3-<lang>.v<version>.pt, with its own SPM
+#    model if any, otherwise laser2.spm; laser2.pt for other languages)
+#  - SPM models with the same content are loaded once and shared
+#  - the least recently used encoders are evicted when the size of the
+#    parameters of the loaded encoders exceeds a budget
+
+import os
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from embed import load_model
+from lib.embedding_format import FileDigest
+from lib.text_processing import SPMApplyLines
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+)
+logger = logging.getLogger("encoder_registry")
+
+
+def EncoderSize(encoder):
+    # bytes of the parameters and buffers of a SentenceEncoder, not the
+    # memory used by the process (activations, allocator, SPM models, ...)
+    module = encoder.encoder
+    return sum(t.numel() * t.element_size() for t in module.parameters()) + sum(
+        t.numel() * t.element_size() for t in module.buffers()
+    )
+
+
+class RegisteredEncoder:
+    """
+    Encoder of a language and its SPM model: encode_sentences takes raw
+    sentences and applies the same preprocessing as embed.py --stream
+    (--spm-lang, "en" in embed.sh, whatever the language of the encoder)
+    """
+    def __init__(self, lang, encoder, spm, spm_digest, nbytes, load_time,
+                 spm_lang="en"):
+        self.lang = lang
+        self.spm_lang = spm_lang
+        self.encoder = encoder
+        self.spm = spm
+        self.spm_digest = spm_digest
+        self.nbytes = nbytes
+        self.load_time = load_time
+
+    def encode_sentences(self, sentences):
+        lines = list(SPMApplyLines(sentences, self.spm, lang=self.spm_lang))
+        return self.encoder.encode_sentences(lines)
+
+
+class EncoderRegistry:
+    def __init__(
+        self,
+        model_dir,
+        version=1,
+        memory_budget=8192,
+        spm_lang="en",
+        verbose=False,
+        **encoder_kwargs,
+    ):
+        """
+        model_dir: directory of the models (see nllb/download_models.sh)
+        memory_budget: maximal size of the parameters of the loaded
+            encoders in MB, as measured by EncoderSize (the most recently
+            used encoder is kept even if larger)
+        spm_lang: language of the preprocessing before SPM, as --spm-lang
+            of embed.py
+        encoder_kwargs: options of SentenceEncoder (max_tokens, cpu, ...)
+        """
+        self.model_dir = model_dir
+        self.version = version
+        self.memory_budget = memory_budget << 20
+        self.spm_lang = spm_lang
+        self.verbose = verbose
+        self.encoder_kwargs = encoder_kwargs
+        self.encoders = OrderedDict()  # LRU order, most recent last
+        self.spm_models = {}  # digest -> SentencePieceProcessor
+        self.spm_users = defaultdict(int)  # digest -> number of encoders
+        self.lock = threading.Lock()
+        self.lang_locks = defaultdict(threading.Lock)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def paths(self, lang=None):
+        # encoder and SPM model of a language, as in tasks/embed/embed.sh
+        model_file = os.path.join(self.model_dir, "laser2.pt")
+        spm_file = os.path.join(self.model_dir, "laser2.spm")
+        if lang:
+            model_file = os.path.join(
+                self.model_dir, f"laser3-{lang}.v{self.version}.pt"
+            )
+            lang_spm = os.path.join(self.model_dir, f"laser3-{lang}.v{self.version}.spm")
+            if os.path.isfile(lang_spm) and os.path.getsize(lang_spm) > 0:
+                spm_file = lang_spm
+        return model_file, spm_file
+
+    def _load_spm(self, spm_file):
+        import sentencepiece as spm
+
+        digest = FileDigest(spm_file)
+        with self.lock:
+            if digest not in self.spm_models:
+                self.spm_models[digest] = spm.SentencePieceProcessor(model_file=spm_file)
+            # counted now, so that it is not released by an eviction
+            # while the encoder is loaded
+            self.spm_users[digest] += 1
+            return digest, self.spm_models[digest]
+
+    def _release_spm(self, digest):
+        # called with the lock held
+        self.spm_users[digest] -= 1
+        if self.spm_users[digest] == 0:
+            del self.spm_users[digest]
+            del self.spm_models[digest]
+
+    def _load(self, lang):
+        model_file, spm_file = self.paths(lang)
+        assert os.path.isfile(model_file), f"no encoder for {lang}: {model_file}"
+        t = time.perf_counter()
+        digest, spm = self._load_spm(spm_file)
+        try:
+            encoder = load_model(
+                model_file, spm_file, None, verbose=self.verbose, **self.encoder_kwargs
+            )
+        except BaseException:
+            with self.lock:
+                self._release_spm(digest)
+            raise
+        load_time = time.perf_counter() - t
+        entry = RegisteredEncoder(
+            lang, encoder, spm, digest, EncoderSize(encoder), load_time,
+            spm_lang=self.spm_lang,
+        )
+        if self.verbose:
+            logger.info(
+                "loaded encoder {} ({:.0f}MB of parameters) in {:.2f}s".format(
+                    model_file, entry.nbytes / 2**20, load_time
+                )
+            )
+        return entry
+
+    def _evict(self):
+        # called with the lock held
+        while (
+            len(self.encoders) > 1
+            and sum(e.nbytes for e in self.encoders.values()) > self.memory_budget
+        ):
+            lang, entry = self.encoders.popitem(last=False)
+            self.evictions += 1
+            self._release_spm(entry.spm_digest)
+            if self.verbose:
+                logger.info(f"evicted encoder of {lang or 'laser2'}")
+
+    def get(self, lang=None):
+        """
+        Encoder of the language lang (laser2 if None)
+        An evicted encoder stays usable by the callers holding it
+        """
+        with self.lock:
+            if lang in self.encoders:
+                self.encoders.move_to_end(lang)
+                self.hits += 1
+                return self.encoders[lang]
+            lang_lock = self.lang_locks[lang]
+        # load each language once, without blocking the other languages
+        with lang_lock:
+            with self.lock:
+                if lang in self.encoders:
+                    self.encoders.move_to_end(lang)
+                    self.hits += 1
+                    return self.encoders[lang]
+                self.misses += 1
+            entry = self._load(lang)
+            with self.lock:
+                self.load_time += entry.load_time
+                self.encoders[lang] = entry
+                self._evict()
+            return entry
+
+    def encode_sentences(self, sentences, lang=None):
+        return self.get(lang).encode_sentences(sentences)
+
+    def metrics(self):
+        with self.lock:
+            loads = self.misses
+            return {
+                "loaded": len(self.encoders),
+                "languages": [lang or "laser2" for lang in self.encoders],
+                "parameter_mb": sum(e.nbytes for e in self.encoders.values()) / 2**20,
+                "parameter_budget_mb": self.memory_budget / 2**20,
+                "spm_models": len(self.spm_models),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1),
+                "evictions": self.evictions,
+                "load_time": self.load_time,
+                "mean_load_time": self.load_time / max(loads, 1),
+            }
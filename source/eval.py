@@ -51,7 +51,7 @@ class Eval:
         self.encoder_args = {
             k: v
             for k, v in args._get_kwargs()
-            if k in ["max_sentences", "max_tokens", "cpu", "sort_kind", "verbose"]
+            if k in ["max_sentences", "max_tokens", "cpu", "sort_kind", "verbose", "quantize", "bf16"]
         }
         self.src_bpe_codes = args.src_bpe_codes
         self.tgt_bpe_codes = args.tgt_bpe_codes
@@ -92,6 +92,7 @@ class Eval:
             self.tgt_vocab_file = self.src_vocab_file
         self.nway = args.nway
         self.buffer_size = args.buffer_size
+        self.bucket_window = args.bucket_window
         self.fp16 = args.fp16
         self.margin = args.margin
         self.output_dir = args.output_dir
@@ -130,6 +131,7 @@ class Eval:
                 bpe_codes=bpe_codes,
                 token_lang=lang if bpe_codes else "--",
                 buffer_size=self.buffer_size,
+                bucket_window=self.bucket_window,
                 fp16=self.fp16,
                 **self.encoder_args,
             )
@@ -411,6 +413,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--buffer-size", type=int, default=100, help="Buffer size (sentences)"
     )
+    parser.add_argument(
+        "--bucket-window",
+        type=int,
+        default=0,
+        help="Batch sentences of similar length across buffers, keeping at most this many sentences pending",
+    )
     parser.add_argument(
         "--max-tokens",
         type=int,
@@ -424,6 +432,18 @@ if __name__ == "__main__":
         help="Maximum number of sentences to process in a batch",
     )
     parser.add_argument("--cpu", action="store_true", help="Use CPU instead of GPU")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Dynamic quantization of the encoder for CPU inference",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Compute in bfloat16 (transformer encoders, CPUs with AVX512-BF16 or AMX)",
+    )
 
     parser.add_argument(
         "--src-langs",
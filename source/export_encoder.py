@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Export a LASER encoder to a TorchScript or ONNX graph which computes
+# the sentence embeddings only. The exported file is run by
+# embed.CompiledSentenceEncoder (or by load_model / embed.py --encoder)
+
+import json
+import inspect
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from embed import SentenceEncoder, CompiledSentenceEncoder, load_model
+
+
+class SentembModule(nn.Module):
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, tokens, lengths):
+        return self.encoder(tokens, lengths)["sentemb"]
+
+
+def ExampleBatch(encoder):
+    # the example must contain padding, so that the masking of the padded
+    # positions is part of the traced graph
+    ids, starts, lengths = encoder._tokenize_buffer(["x x x x x x x x", "x x"])
+    return encoder._collate(ids, starts, lengths, np.array([0, 1]))
+
+
+def ExportEncoder(encoder: SentenceEncoder, out_fname, fmt="torchscript", verbose=False):
+    assert fmt in ("torchscript", "onnx"), f"unknown export format: {fmt}"
+    module = SentembModule(encoder.encoder.cpu().float()).eval()
+    batch = ExampleBatch(encoder)
+    with torch.no_grad():
+        if fmt == "onnx":
+            # packed sequences are only supported by the TorchScript based exporter
+            kwargs = {}
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                kwargs["dynamo"] = False
+            torch.onnx.export(
+                module,
+                (batch.tokens, batch.lengths),
+                out_fname,
+                input_names=["tokens", "lengths"],
+                output_names=["sentemb"],
+                dynamic_axes={
+                    "tokens": {0: "batch", 1: "length"},
+                    "lengths": {0: "batch"},
+                    "sentemb": {0: "batch"},
+                },
+                opset_version=17,
+                **kwargs,
+            )
+        else:
+            traced = torch.jit.trace(module, (batch.tokens, batch.lengths), check_trace=False)
+            torch.jit.save(torch.jit.freeze(traced), out_fname)
+    meta = {
+        "format": fmt,
+        "dictionary": {k: int(v) for k, v in encoder.dictionary.items()},
+        "prepend_bos": bool(encoder.prepend_bos),
+        "left_padding": bool(encoder.left_padding),
+        "bos_index": encoder.bos_index,
+        "pad_index": encoder.pad_index,
+        "eos_index": encoder.eos_index,
+        "unk_index": encoder.unk_index,
+    }
+    with open(CompiledSentenceEncoder.meta_fname(out_fname), "w") as fp:
+        json.dump(meta, fp, ensure_ascii=False)
+    if verbose:
+        print(" - exported encoder ({:s}) to {:s}".format(fmt, out_fname))
+
+
+def CheckExport(encoder, compiled, sentences):
+    ref = encoder.encode_sentences(sentences)
+    new = compiled.encode_sentences(sentences)
+    diff = np.abs(ref - new).max()
+    print(" - max abs difference on {:d} sentences: {:.2e}".format(len(sentences), diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LASER: export an encoder")
+    parser.add_argument("--encoder", type=str, required=True, help="Encoder to be exported")
+    parser.add_argument("--spm-model", type=str, default=None, help="SPM model of the encoder")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Exported encoder")
+    parser.add_argument(
+        "--format", type=str, default="torchscript", choices=["torchscript", "onnx"],
+        help="Export format",
+    )
+    parser.add_argument(
+        "--check", type=str, default=None,
+        help="Preprocessed text file used to compare the exported encoder to the original one",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Detailed output")
+    args = parser.parse_args()
+
+    encoder = load_model(args.encoder, args.spm_model, None,
+                         max_tokens=12000, cpu=True, verbose=args.verbose)
+    ExportEncoder(encoder, args.output, fmt=args.format, verbose=args.verbose)
+    if args.check:
+        with open(args.check, encoding="utf-8", errors="surrogateescape") as fin:
+            sentences = [line.strip() for line in fin][:1000]
+        compiled = CompiledSentenceEncoder(args.output, max_tokens=12000, cpu=True)
+        CheckExport(encoder, compiled, sentences)
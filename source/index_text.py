@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Tool to create the sentence offsets, word counts and language files
+# of a text corpus, as read by indexing.IndexTextOpen
+
+import os
+import sys
+import argparse
+
+from lib.indexing import IndexTextCreate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="LASER: create the offsets of the sentences of a text corpus")
+    parser.add_argument("--text", type=str, required=True,
+                        help="Text corpus (.txt), created from --inputs if given")
+    parser.add_argument("--inputs", type=str, nargs="+", default=None,
+                        help="Text files concatenated into the corpus")
+    parser.add_argument("--langs", type=str, nargs="+", default=None,
+                        help="Language of each input (or of the corpus), written to the .meta file")
+    parser.add_argument("--no-word-counts", action="store_true",
+                        help="Do not create the .nw.bin8 file")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="Size of the blocks scanned at once (MB)")
+    parser.add_argument("--verbose", action="store_true", help="Detailed output")
+    args = parser.parse_args()
+
+    if not args.inputs and not os.path.isfile(args.text):
+        print("ERROR: text corpus {:s} not found".format(args.text))
+        sys.exit(1)
+    IndexTextCreate(args.text, inputs=args.inputs, langs=args.langs,
+                    word_counts=not args.no_word_counts,
+                    block_size=args.block_size << 20, verbose=args.verbose)
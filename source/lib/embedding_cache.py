@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Persistent cache of sentence embeddings
+#
+# The cache is a directory holding fixed-width memory mapped records:
+#  - keys.bin     uint64 hash of (encoder, sentence), 0 for a free slot
+#  - vectors.bin  float32 embeddings
+#  - ref.bin      uint8 reference bits for the clock eviction
+#  - meta.json    dimension, capacity and position of the clock hand
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import numpy as np
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+logger = logging.getLogger("embedding_cache")
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, dim=1024, max_size=1024, model_id="",
+                 verbose=False):
+        """
+        cache_dir: directory of the cache, created if needed
+        max_size: size budget of a new cache in MB
+        model_id: identity of the encoder, part of the key of each sentence
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.hash_key = hashlib.blake2b(
+            model_id.encode('utf-8'), digest_size=32).digest()
+        meta_fname = os.path.join(cache_dir, 'meta.json')
+        if os.path.isfile(meta_fname):
+            with open(meta_fname) as fp:
+                self.meta = json.load(fp)
+            assert self.meta['dim'] == dim, \
+                f'embedding cache {cache_dir} has dimension {self.meta["dim"]}, not {dim}'
+            mode = 'r+'
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            capacity = max(1, (max_size << 20) // (4 * dim + 8 + 1))
+            self.meta = {'dim': dim, 'capacity': capacity, 'hand': 0}
+            mode = 'w+'
+        capacity = self.meta['capacity']
+        self.keys = np.memmap(os.path.join(cache_dir, 'keys.bin'),
+                              mode=mode, dtype=np.uint64, shape=(capacity,))
+        self.vectors = np.memmap(os.path.join(cache_dir, 'vectors.bin'),
+                                 mode=mode, dtype=np.float32, shape=(capacity, dim))
+        self.ref = np.memmap(os.path.join(cache_dir, 'ref.bin'),
+                             mode=mode, dtype=np.uint8, shape=(capacity,))
+        used = np.flatnonzero(self.keys)
+        self.slots = dict(zip(self.keys[used].tolist(), used.tolist()))
+        # free slots, taken in order: an insert interrupted by a crash can
+        # leave free slots between the used ones
+        self.free = np.flatnonzero(self.keys == 0)
+        self.next_free = 0
+        if verbose:
+            logger.info('embedding cache {}: {:d}/{:d} entries'
+                        .format(cache_dir, len(self.slots), capacity))
+        self.flush()
+
+    def hash(self, sentences):
+        keys = []
+        for sentence in sentences:
+            digest = hashlib.blake2b(
+                sentence.encode('utf-8', errors='surrogateescape'),
+                digest_size=8, key=self.hash_key).digest()
+            keys.append(int.from_bytes(digest, 'little') or 1)  # 0 is a free slot
+        return keys
+
+    def lookup(self, keys, out):
+        """
+        Copy the cached embeddings of keys into the rows of out
+        Returns a boolean array of the keys which were found
+        """
+        slots = np.fromiter((self.slots.get(k, -1) for k in keys),
+                            dtype=np.int64, count=len(keys))
+        found = slots >= 0
+        out[found] = self.vectors[slots[found]]
+        self.ref[slots[found]] = 1
+        nhits = int(found.sum())
+        self.hits += nhits
+        self.misses += len(keys) - nhits
+        return found
+
+    def _free_slot(self, pending):
+        if self.next_free < len(self.free):
+            self.next_free += 1
+            return int(self.free[self.next_free - 1])
+        # clock eviction: skip (and clear) recently referenced slots
+        capacity = self.meta['capacity']
+        hand = self.meta['hand']
+        while self.ref[hand]:
+            self.ref[hand] = 0
+            hand = (hand + 1) % capacity
+        # the key of a slot taken by the same insert is not written yet
+        key = pending.pop(hand)[0] if hand in pending else int(self.keys[hand])
+        del self.slots[key]
+        self.keys[hand] = 0
+        self.meta['hand'] = (hand + 1) % capacity
+        return hand
+
+    def insert(self, keys, vectors):
+        pending = {}  # slot: (key, vector)
+        for key, vector in zip(keys, vectors):
+            if key in self.slots:
+                continue
+            slot = self._free_slot(pending)
+            pending[slot] = (key, vector)
+            self.slots[key] = slot
+        if not pending:
+            return
+        # the evicted keys are cleared before their vectors are overwritten,
+        # and the new keys written once their vectors are, so that a key
+        # never points to another or a partial vector
+        slots = np.fromiter(pending, dtype=np.int64, count=len(pending))
+        self.keys.flush()
+        self.vectors[slots] = np.stack([vector for _, vector in pending.values()])
+        self.ref[slots] = 0
+        self.vectors.flush()
+        self.keys[slots] = np.fromiter((key for key, _ in pending.values()),
+                                       dtype=np.uint64, count=len(pending))
+
+    def flush(self):
+        self.keys.flush()
+        self.vectors.flush()
+        self.ref.flush()
+        with open(os.path.join(self.cache_dir, 'meta.json'), 'w') as fp:
+            json.dump(self.meta, fp)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Self-describing embedding files
+#
+# An embedding file is a .npy file (readable by np.load) with a fixed size
+# header, so that it can be written in a streaming way and the number of
+# rows filled in at the end, and a JSON sidecar <fname>.json:
+#   {"format": "laser-embeddings", "version": 1, "dim": 1024,
+#    "dtype": "float32", "count": N, "normalized": false, "encoder": "..."}
+#
+# Legacy headerless float32/float16 files are still supported by the
+# loader, as long as the dimension and type are given, and can be
+# converted with ConvertEmbeddings()
+#
+# Large outputs can be split in shards <fname>.000, <fname>.001, ...
+# (the naming expected by indexing.SplitFnames), described by a manifest
+# <fname>.manifest.json listing the row range and checksum of each shard
+
+import os
+import json
+import struct
+import hashlib
+import argparse
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY'
+HEADER_SIZE = 128  # bytes, large enough for any shape
+FORMAT_NAME = 'laser-embeddings'
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'laser-embedding-shards'
+
+
+def _NpyHeader(count, dim, dtype):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({:d}, {:d}), }}".format(
+        np.dtype(dtype).str, count, dim)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    return NPY_MAGIC + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def MetaFname(fname):
+    return fname + '.json'
+
+
+def ReadMeta(fname):
+    meta_fname = MetaFname(fname)
+    if not os.path.isfile(meta_fname):
+        return None
+    with open(meta_fname) as fp:
+        meta = json.load(fp)
+    assert meta.get('format') == FORMAT_NAME, f'{meta_fname} is not an embedding sidecar'
+    assert meta['version'] <= FORMAT_VERSION, \
+        f'{fname}: unsupported format version {meta["version"]}'
+    return meta
+
+
+def IsNpy(fname):
+    with open(fname, 'rb') as fp:
+        return fp.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+
+class EmbeddingWriter:
+    """
+    Write embeddings to an open binary file, in the .npy format
+    The header is written before the first rows and updated by close(),
+    which also writes the sidecar. If the file already holds [count] rows
+    (e.g. when resuming), the new rows are appended at the current position.
+    The sidecar describes fname, by default the name of the file: with
+    sidecar=False, call write_meta() once fname is in place.
+    Without any embedding, a (0, dim) array is written if dim is known,
+    and an empty file otherwise.
+    """
+    def __init__(self, fp, dim=None, dtype=np.float32, count=0,
+                 normalized=False, encoder=None, fname=None, sidecar=True):
+        self.fp = fp
+        self.fname = fname or fp.name  # file described by the sidecar
+        self.sidecar = sidecar
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.normalized = normalized
+        self.encoder = encoder
+
+    def write(self, embeddings):
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        assert embeddings.shape[1] == self.dim, \
+            f'embeddings of dimension {embeddings.shape[1]} written to a file of dimension {self.dim}'
+        if self.fp.tell() == 0:
+            self.fp.write(_NpyHeader(0, self.dim, self.dtype))
+        embeddings.astype(self.dtype, copy=False).tofile(self.fp)
+        self.count += embeddings.shape[0]
+
+    def close(self):
+        if self.dim is None:
+            assert self.count == 0, 'unknown embedding dimension'
+            self.fp.seek(0)
+            self.fp.truncate()
+        else:
+            end = max(self.fp.tell(), HEADER_SIZE)
+            self.fp.seek(0)
+            self.fp.write(_NpyHeader(self.count, self.dim, self.dtype))
+            self.fp.seek(end)
+        self.fp.flush()
+        if self.sidecar:
+            self.write_meta()
+
+    def write_meta(self):
+        WriteMeta(self.fname, self.count, self.dim, self.dtype,
+                  normalized=self.normalized, encoder=self.encoder)
+
+
+def WriteMeta(fname, count, dim, dtype, normalized=False, encoder=None):
+    meta = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'dim': dim,
+        'dtype': np.dtype(dtype).name,
+        'count': count,
+        'normalized': normalized,
+        'encoder': encoder,
+    }
+    with open(MetaFname(fname), 'w') as fp:
+        json.dump(meta, fp)
+
+
+def LoadEmbeddings(fname, dim=None, dtype=None, mmap=True, verbose=False):
+    """
+    Load embeddings in the .npy format, or legacy raw embeddings
+    With mmap=True, returns a read-only memory map without reading the file,
+    otherwise an array in memory.
+    dim and dtype are only needed for raw files without sidecar.
+    For .npy files, dim is checked if given and the stored type is returned.
+    """
+    assert os.path.isfile(fname), f'file: {fname} does not exist.'
+    if IsNpy(fname):
+        x = np.load(fname, mmap_mode='r' if mmap else None)
+        assert dim is None or x.shape[1] == dim, \
+            f'{fname}: embeddings of dimension {x.shape[1]}, expected {dim}'
+    else:
+        meta = ReadMeta(fname)
+        if meta is not None:
+            # the dimension of an empty output can be unknown
+            assert dim is None or meta['dim'] in (dim, None), \
+                f'{fname}: embeddings of dimension {meta["dim"]}, expected {dim}'
+            dim = meta['dim'] or dim
+            dtype = meta['dtype']
+        dtype = np.dtype(dtype or np.float32)
+        size = os.path.getsize(fname)
+        if size == 0:
+            # empty output of an empty input (a file can not be mapped)
+            return np.zeros((0, dim or 0), dtype=dtype)
+        assert dim is not None, f'{fname}: raw embeddings need a dimension'
+        assert size % (dim * dtype.itemsize) == 0, \
+            f'{fname}: size {size} is not a multiple of {dim} x {dtype.name}'
+        n = size // (dim * dtype.itemsize)
+        if mmap:
+            x = np.memmap(fname, mode='r', dtype=dtype, shape=(n, dim))
+        else:
+            x = np.fromfile(fname, dtype=dtype, count=-1).reshape(n, dim)
+    if verbose:
+        print(' - embeddings: {:s} {:d} x {:d} {:s}'
+              .format(fname, x.shape[0], x.shape[1], x.dtype.name))
+    return x
+
+
+def ShardFname(fname, shard):
+    return '{}.{:03d}'.format(fname, shard)
+
+
+def ManifestFname(fname):
+    return fname + '.manifest.json'
+
+
+def FileDigest(fname, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def FsyncDir(fname):
+    # make the creation or renaming of fname durable
+    fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ShardedEmbeddingWriter:
+    """
+    Write embeddings to shards fname.000, fname.001, ... of shard_size rows,
+    stored as raw matrices or .npy files, and once all rows are written,
+    a manifest listing the row range and checksum of each shard.
+    Each shard is written to <shard>.tmp and renamed once complete.
+    If count > 0 (e.g. when resuming), the new rows are appended after the
+    first count rows: the complete shards are kept and the last one is
+    truncated. dim is then needed if no rows are written.
+    """
+    def __init__(self, fname, shard_size, dim=None, dtype=np.float32,
+                 storage='raw', count=0, normalized=False, encoder=None):
+        assert shard_size > 0, 'the shard size must be positive'
+        assert storage in ('raw', 'npy'), f'unknown storage: {storage}'
+        self.fname = fname
+        self.shard_size = shard_size
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.storage = storage
+        self.count = count
+        self.normalized = normalized
+        self.encoder = encoder
+        self.shard = count // shard_size  # current shard
+        self.rows = count % shard_size  # rows already in the current shard
+        self.fp = None
+        self.writer = None
+
+    def _open(self):
+        fname = ShardFname(self.fname, self.shard)
+        if self.rows > 0:
+            if not os.path.isfile(fname + '.tmp'):
+                os.replace(fname, fname + '.tmp')
+            offset = self.rows * self.dim * self.dtype.itemsize
+            if self.storage == 'npy':
+                offset += HEADER_SIZE
+            self.fp = open(fname + '.tmp', 'r+b')
+            self.fp.truncate(offset)
+            self.fp.seek(offset)
+        else:
+            self.fp = open(fname + '.tmp', 'wb')
+        if self.storage == 'npy':
+            self.writer = EmbeddingWriter(self.fp, dim=self.dim, dtype=self.dtype,
+                                          count=self.rows, sidecar=False)
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        # the shard is durable before it is renamed (and before the
+        # progress of a resumable job can count its rows)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        self.fp = None
+        fname = ShardFname(self.fname, self.shard)
+        os.replace(fname + '.tmp', fname)
+        FsyncDir(fname)
+        self.shard += 1
+        self.rows = 0
+
+    def write(self, embeddings):
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        assert embeddings.shape[1] == self.dim, \
+            f'embeddings of dimension {embeddings.shape[1]} written to shards of dimension {self.dim}'
+        embeddings = embeddings.astype(self.dtype, copy=False)
+        i = 0
+        while i < embeddings.shape[0]:
+            if self.fp is None:
+                self._open()
+            n = min(embeddings.shape[0] - i, self.shard_size - self.rows)
+            if self.writer is not None:
+                self.writer.write(embeddings[i:i + n])
+            else:
+                embeddings[i:i + n].tofile(self.fp)
+            self.rows += n
+            self.count += n
+            i += n
+            if self.rows == self.shard_size:
+                self._close_shard()
+
+    def sync(self):
+        # make the rows written so far durable, including the entry of the
+        # current shard in the directory (complete shards are synced when
+        # closed)
+        if self.fp is not None:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            FsyncDir(self.fname)
+
+    def close(self):
+        if self.rows > 0:
+            if self.fp is None:
+                self._open()
+            self._close_shard()
+        # remove the shards left by a previous, larger output
+        stale = self.shard
+        while os.path.isfile(ShardFname(self.fname, stale)):
+            os.remove(ShardFname(self.fname, stale))
+            stale += 1
+        shards = []
+        for shard in range(self.shard):
+            fname = ShardFname(self.fname, shard)
+            start = shard * self.shard_size
+            shards.append({
+                'file': os.path.basename(fname),
+                'start': start,
+                'rows': min(self.shard_size, self.count - start),
+                'sha256': FileDigest(fname),
+            })
+        WriteManifest(self.fname, shards, self.dim, self.dtype, self.storage,
+                      normalized=self.normalized, encoder=self.encoder)
+
+
+def WriteManifest(fname, shards, dim, dtype, storage, normalized=False, encoder=None):
+    manifest = {
+        'format': MANIFEST_NAME,
+        'version': FORMAT_VERSION,
+        'dim': dim,
+        'dtype': np.dtype(dtype).name,
+        'storage': storage,
+        'count': sum(shard['rows'] for shard in shards),
+        'normalized': normalized,
+        'encoder': encoder,
+        'shards': shards,
+    }
+    manifest_fname = ManifestFname(fname)
+    with open(manifest_fname + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(manifest_fname + '.tmp', manifest_fname)
+
+
+def ReadManifest(fname):
+    manifest_fname = ManifestFname(fname)
+    if not os.path.isfile(manifest_fname):
+        return None
+    with open(manifest_fname) as fp:
+        manifest = json.load(fp)
+    assert manifest.get('format') == MANIFEST_NAME, \
+        f'{manifest_fname} is not an embedding manifest'
+    assert manifest['version'] <= FORMAT_VERSION, \
+        f'{manifest_fname}: unsupported format version {manifest["version"]}'
+    return manifest
+
+
+def ShardFnames(fname, manifest):
+    dirname = os.path.dirname(fname)
+    return [os.path.join(dirname, shard['file']) for shard in manifest['shards']]
+
+
+def LoadShards(fname, mmap=True, verify=False, verbose=False):
+    """
+    Open the shards listed in the manifest of fname, in order
+    With verify=True, the checksums of the shards are checked first.
+    """
+    manifest = ReadManifest(fname)
+    assert manifest is not None, f'no manifest for {fname}'
+    shards = []
+    for shard_fname, shard in zip(ShardFnames(fname, manifest), manifest['shards']):
+        if verify:
+            assert FileDigest(shard_fname) == shard['sha256'], \
+                f'{shard_fname}: checksum mismatch'
+        x = LoadEmbeddings(shard_fname, dim=manifest['dim'],
+                           dtype=manifest['dtype'], mmap=mmap, verbose=verbose)
+        assert x.shape[0] == shard['rows'], \
+            f'{shard_fname}: {x.shape[0]} rows, expected {shard["rows"]}'
+        shards.append(x)
+    return shards
+
+
+def ConvertEmbeddings(fname, out_fname, dim=1024, dtype=np.float32,
+                      normalized=False, encoder=None, chunk_size=100000):
+    """
+    Convert legacy raw embeddings to the .npy format with sidecar
+    """
+    x = LoadEmbeddings(fname, dim=dim, dtype=dtype, mmap=True)
+    with open(out_fname, 'wb') as fp:
+        writer = EmbeddingWriter(fp, dim=dim, dtype=x.dtype,
+                                 normalized=normalized, encoder=encoder)
+        for i in range(0, x.shape[0], chunk_size):
+            writer.write(np.asarray(x[i:i + chunk_size]))
+        writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='LASER: convert raw embeddings to the .npy format')
+    parser.add_argument('input', type=str, help='Raw embeddings')
+    parser.add_argument('output', type=str, help='Converted embeddings')
+    parser.add_argument('--dim', type=int, default=1024, help='Embedding dimension')
+    parser.add_argument('--fp16', action='store_true', help='Input is in fp16')
+    parser.add_argument('--normalized', action='store_true',
+                        help='Embeddings are L2 normalized')
+    parser.add_argument('--encoder', type=str, default=None,
+                        help='Identity of the encoder (stored in the sidecar)')
+    args = parser.parse_args()
+    ConvertEmbeddings(args.input, args.output, dim=args.dim,
+                      dtype=np.float16 if args.fp16 else np.float32,
+                      normalized=args.normalized, encoder=args.encoder)
@@ -18,6 +18,11 @@ import faiss
 import os.path
 import sys
 import numpy as np
+try:
+    from .embedding_format import LoadEmbeddings, ReadManifest, ShardFnames
+except ImportError:
+    # imported as a top-level module (source/lib in sys.path)
+    from embedding_format import LoadEmbeddings, ReadManifest, ShardFnames
 
 #-------------------------------------------------------------
 # Get list of fnames:
@@ -28,6 +33,11 @@ def SplitFnames(par_fname, langs):
     fnames = []
     for l in langs:
         fname = par_fname + '.' + l
+        manifest = ReadManifest(fname)
+        if manifest is not None:
+            # shards written by embed.py
+            fnames.extend(ShardFnames(fname, manifest))
+            continue
         if os.path.isfile(fname):
             fnames.append(fname)
         for i in range(1000):
@@ -46,10 +56,10 @@ def SplitOpen(par_fname, langs, dim, dtype, verbose=False):
     print('Reading sentence embeddings')
     print(' - memory mapped files {:s}'.format(par_fname))
     for fname in SplitFnames(par_fname, langs):
-        n = int(os.path.getsize(fname) / dim / np.dtype(dtype).itemsize)
+        Mi = LoadEmbeddings(fname, dim=dim, dtype=dtype, mmap=True)
+        n = Mi.shape[0]
         if verbose:
             print(' - {:s}: {:d} x {:d}'.format(fname, n, dim))
-        Mi = np.memmap(fname, mode='r', dtype=dtype, shape=(n, dim))
         nc += n
         nf += 1
         M.append(Mi)
@@ -74,11 +84,10 @@ def IndexCreate(dname, idx_type,
                 verbose=False, normalize=True, save_index=False, dim=1024):
 
     assert idx_type == 'FlatL2', 'only FlatL2 index is currently supported'
-    x = np.fromfile(dname, dtype=np.float32, count=-1)
-    nbex = x.shape[0] // dim
+    x = LoadEmbeddings(dname, dim=dim, dtype=np.float32, mmap=False)
+    nbex = x.shape[0]
     print(' - embedding: {:s} {:d} examples of dim {:d}'
           .format(dname, nbex, dim))
-    x.resize(nbex, dim)
     print(' - creating FAISS index')
     idx = faiss.IndexFlatL2(dim)
     if normalize:
@@ -225,6 +234,104 @@ def IndexTextOpen(txt_fname):
     return txt_mmap, ref_mmap, nbw_mmap, M
 
 
+###############################################################################
+# Creates the files read by IndexTextOpen for the text file txt_fname:
+#  - .ref.bin32 (or .ref.bin64 if the text is larger than 4GB)
+#    byte offset of the start of each sentence
+#  - .nw.bin8  number of words of each sentence (clipped to 255)
+#  - .meta     language and number of sentences of each input
+# If inputs are given, they are first concatenated into txt_fname
+# (adding a final newline if needed), otherwise txt_fname is a single input
+# The text is scanned in blocks of block_size bytes of a memory map,
+# with vectorized newline and word boundary search
+
+def IndexTextCreate(txt_fname, inputs=None, langs=None, word_counts=True,
+                    block_size=1 << 26, verbose=False):
+    assert txt_fname.endswith('.txt'), 'the text file must have the extension .txt'
+    if langs is not None:
+        assert len(langs) == len(inputs or [txt_fname]), \
+            'one language must be given for each input'
+    bounds = []  # byte offset of the end of each input
+    if inputs:
+        with open(txt_fname, 'wb') as fout:
+            for fname in inputs:
+                with open(fname, 'rb') as fin:
+                    last = b'\n'
+                    while True:
+                        block = fin.read(block_size)
+                        if not block:
+                            break
+                        fout.write(block)
+                        last = block[-1:]
+                if last != b'\n':
+                    fout.write(b'\n')
+                bounds.append(fout.tell())
+    size = os.path.getsize(txt_fname)
+    if not inputs:
+        bounds.append(size)
+    dtype = np.uint32 if size < 2**32 else np.uint64
+    ref_fname = txt_fname.replace('.txt', '.ref.bin32' if dtype == np.uint32 else '.ref.bin64')
+    nbw_fname = txt_fname.replace('.txt', '.nw.bin8')
+    if verbose:
+        print('Indexing text corpus')
+        print(' - texts: {:s} ({:d} bytes)'.format(txt_fname, size))
+        print(' - sentence start offsets ({:d} bit): {:s}'
+              .format(8 * np.dtype(dtype).itemsize, ref_fname))
+    txt_mmap = np.memmap(txt_fname, mode='r', dtype=np.uint8) if size > 0 else np.zeros(0, np.uint8)
+    nlines = 0
+    pending = 0  # words of the current line in the previous blocks
+    prev_space = True  # whether the previous byte is a word separator
+    with open(ref_fname, 'wb') as fref, open(nbw_fname, 'wb') as fnbw:
+        for start in range(0, size, block_size):
+            block = np.asarray(txt_mmap[start:start + block_size])
+            newlines = np.flatnonzero(block == 10)
+            # sentences starting in this block
+            starts = newlines + (start + 1)
+            if start == 0:
+                starts = np.concatenate(([0], starts))
+            starts = starts[starts < size]
+            starts.astype(dtype).tofile(fref)
+            nlines += starts.shape[0]
+            if not word_counts:
+                continue
+            # words are separated by spaces and control characters
+            space = block <= 32
+            word_starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1
+            if prev_space and not space[0]:
+                word_starts = np.concatenate(([0], word_starts))
+            prev_space = bool(space[-1])
+            # number of words before each newline
+            words = np.searchsorted(word_starts, newlines)
+            if newlines.shape[0] > 0:
+                counts = np.diff(words, prepend=0)
+                counts[0] += pending
+                np.minimum(counts, 255).astype(np.uint8).tofile(fnbw)
+                pending = word_starts.shape[0] - int(words[-1])
+            else:
+                pending += word_starts.shape[0]
+        if word_counts and size > 0 and txt_mmap[-1] != 10:
+            # last sentence without newline
+            np.array([min(pending, 255)], dtype=np.uint8).tofile(fnbw)
+    if not word_counts:
+        os.remove(nbw_fname)
+    elif verbose:
+        print(' - word counts: {:s}'.format(nbw_fname))
+    if verbose:
+        print(' - found {:d} sentences'.format(nlines))
+
+    if langs is not None:
+        ref_mmap = np.memmap(ref_fname, mode='r', dtype=dtype) if nlines > 0 else np.zeros(0, dtype)
+        ends = np.searchsorted(ref_mmap, np.array(bounds, dtype=dtype), side='left')
+        counts = np.diff(ends, prepend=0)
+        meta_fname = txt_fname.replace('.txt', '.meta')
+        with open(meta_fname, 'w') as fp:
+            for lang, n in zip(langs, counts):
+                fp.write('{:s} {:d}\n'.format(lang, int(n)))
+        if verbose:
+            print(' - metafile: {:s}'.format(meta_fname))
+    return nlines
+
+
 ###############################################################################
 # Return the text for the given index
 
@@ -1,73 +1,153 @@
 # This is a Python equivalent of the MOSES tooklit Perl script
+#
+# The substitutions of the script are listed in order below, and are
+# compiled once per language: consecutive non ASCII single character
+# replacements are merged into one str.translate() table, and each step is
+# skipped when a substring it needs is not in the line (non ASCII steps are
+# skipped on ASCII lines)
 
 import re
 
-def normalize_punctuation(line, language="en", penn=0):
-    text = line.replace('\r', '')
-    
-    # remove extra spaces
-    text = re.sub(r'\(', ' (', text)
-    text = re.sub(r'\)', ') ', text)
-    text = re.sub(r' +', ' ', text)
-    text = re.sub(r'\) ([\.\!\:\?\;\,])', r')\1', text)
-    text = re.sub(r'\( ', '(', text)
-    text = re.sub(r' \)', ')', text)
-    text = re.sub(r'(\d) %', r'\1%', text)
-    text = re.sub(r' :', ':', text)
-    text = re.sub(r' ;', ';', text)
-
-    # normalize unicode punctuation
-    if penn == 0:
-        text = text.replace('`', "'")
-        text = text.replace("''", ' " ')
-
-    text = text.replace('„', '"')
-    text = text.replace('“', '"')
-    text = text.replace('”', '"')
-    text = text.replace('–', '-')
-    text = re.sub(r'—', ' - ', text)
-    text = re.sub(r' +', ' ', text)
-    text = text.replace('´', "'")
-    text = re.sub(r'([a-z])‘([a-z])', r"\1'\2", text, flags=re.IGNORECASE)
-    text = re.sub(r'([a-z])’([a-z])', r"\1'\2", text, flags=re.IGNORECASE)
-    text = text.replace('‘', '"')
-    text = text.replace('‚', '"')
-    text = text.replace('’', '"')
-    text = text.replace("''", '"')
-    text = text.replace('´´', '"')
-    text = text.replace('…', '...')
-    
+# (substring needed by the step, pattern, replacement)
+# the pattern is a literal string, or a compiled regular expression
+
+# remove extra spaces
+_SPACES = [
+    ('\r', '\r', ''),
+    ('(', '(', ' ('),
+    (')', ')', ') '),
+    ('  ', re.compile(r' +'), ' '),
+    (') ', re.compile(r'\) ([\.\!\:\?\;\,])'), r')\1'),
+    ('( ', '( ', '('),
+    (' )', ' )', ')'),
+    (' %', re.compile(r'(\d) %'), r'\1%'),
+    (' :', ' :', ':'),
+    (' ;', ' ;', ';'),
+]
+
+_PENN = [
+    ('`', '`', "'"),
+    ("''", "''", ' " '),
+]
+
+# normalize unicode punctuation
+_UNICODE = [
+    ('„', '„', '"'),
+    ('“', '“', '"'),
+    ('”', '”', '"'),
+    ('–', '–', '-'),
+    ('—', '—', ' - '),
+    ('  ', re.compile(r' +'), ' '),
+    ('´', '´', "'"),
+    ('‘', re.compile(r'([a-z])‘([a-z])', flags=re.IGNORECASE), r"\1'\2"),
+    ('’', re.compile(r'([a-z])’([a-z])', flags=re.IGNORECASE), r"\1'\2"),
+    ('‘', '‘', '"'),
+    ('‚', '‚', '"'),
+    ('’', '’', '"'),
+    ("''", "''", '"'),
+    ('´´', '´´', '"'),
+    ('…', '…', '...'),
+
     # French quotes
-    text = text.replace(' « ', ' "')
-    text = text.replace('« ', '"')
-    text = text.replace('«', '"')
-    text = text.replace(' » ', '" ')
-    text = text.replace(' »', '"')
-    text = text.replace('»', '"')
+    ('\xa0«\xa0', '\xa0«\xa0', ' "'),
+    ('«\xa0', '«\xa0', '"'),
+    ('«', '«', '"'),
+    ('\xa0»\xa0', '\xa0»\xa0', '" '),
+    ('\xa0»', '\xa0»', '"'),
+    ('»', '»', '"'),
 
     # handle pseudo-spaces
-    text = text.replace(' %', '%')
-    text = text.replace('nº ', 'nº ')
-    text = text.replace(' :', ':')
-    text = text.replace(' ºC', ' ºC')
-    text = text.replace(' cm', ' cm')
-    text = text.replace(' ?', '?')
-    text = text.replace(' !', '!')
-    text = text.replace(' ;', ';')
-    text = text.replace(', ', ', ')
-    text = re.sub(r' +', ' ', text)
-
-    # English "quotation," followed by comma, style
-    if language == "en":
-        text = re.sub(r'\"([,\.]+)', r'\1"', text)
-    # German/Spanish/French "quotation", followed by comma, style
-    elif language in ["de", "es", "cz", "cs", "fr"]:
-        text = re.sub(r',\"', '",', text)
-        text = re.sub(r'(\.+)"(\s*[^<])', r'"\1\2', text)
-
-    if language in ["de", "es", "cz", "cs", "fr"]:
-        text = re.sub(r'(\d) (\d)', r'\1,\2', text)
-    else:
-        text = re.sub(r'(\d) (\d)', r'\1.\2', text)
+    ('\xa0%', '\xa0%', '%'),
+    ('nº\xa0', 'nº\xa0', 'nº '),
+    ('\xa0:', '\xa0:', ':'),
+    ('\xa0ºC', '\xa0ºC', ' ºC'),
+    ('\xa0cm', '\xa0cm', ' cm'),
+    ('\xa0?', '\xa0?', '?'),
+    ('\xa0!', '\xa0!', '!'),
+    ('\xa0;', '\xa0;', ';'),
+    (',\xa0', ',\xa0', ', '),
+    ('  ', re.compile(r' +'), ' '),
+]
+
+# English "quotation," followed by comma, style
+_QUOTES_EN = [
+    ('"', re.compile(r'\"([,\.]+)'), r'\1"'),
+]
+
+# German/Spanish/French "quotation", followed by comma, style
+_QUOTES_DE = [
+    (',"', re.compile(r',\"'), '",'),
+    ('."', re.compile(r'(\.+)"(\s*[^<])'), r'"\1\2'),
+]
+
+_LANGS_DE = ('de', 'es', 'cz', 'cs', 'fr')
+
+_DIGITS_DE = [(' ', re.compile(r'(\d) (\d)'), r'\1,\2')]
+_DIGITS = [(' ', re.compile(r'(\d) (\d)'), r'\1.\2')]
+
+
+def _Rules(language, penn):
+    rules = _SPACES + (_PENN if penn == 0 else []) + _UNICODE
+    if language == 'en':
+        rules = rules + _QUOTES_EN
+    elif language in _LANGS_DE:
+        rules = rules + _QUOTES_DE
+    return rules + (_DIGITS_DE if language in _LANGS_DE else _DIGITS)
 
+
+def _Translate(table):
+    chars = re.compile('[' + re.escape(''.join(table)) + ']')
+    table = str.maketrans(table)
+    return lambda text: text.translate(table) if chars.search(text) else text
+
+
+def _Compile(rules):
+    # returns a list of (substring needed, function, applies to ASCII text)
+    steps = []
+    table = {}
+    for needed, pattern, repl in rules + [(None, None, None)]:
+        if (isinstance(pattern, str) and len(pattern) == 1 and not pattern.isascii()
+                and not any(pattern in value for value in table.values())):
+            # applying the replacements at once is only equivalent if a
+            # replacement does not create the character of a later one
+            table[pattern] = repl
+            continue
+        if len(table) == 1:
+            (char, value), = table.items()
+            steps.append((char, lambda text, a=char, b=value: text.replace(a, b), False))
+        elif table:
+            steps.append(('', _Translate(table), False))
+        table = {}
+        if isinstance(pattern, str):
+            if len(pattern) == 1 and not pattern.isascii():
+                table[pattern] = repl
+                continue
+            steps.append((needed, lambda text, a=pattern, b=repl: text.replace(a, b),
+                          needed.isascii()))
+        elif pattern is not None:
+            steps.append((needed, lambda text, p=pattern, r=repl: p.sub(r, text),
+                          needed.isascii()))
+    return steps
+
+
+_compiled = {}
+
+
+def _Steps(language, penn):
+    # (steps, steps for ASCII lines) of a language
+    if (language, penn) not in _compiled:
+        steps = _Compile(_Rules(language, penn))
+        _compiled[(language, penn)] = (
+            [(needed, step) for needed, step, _ in steps],
+            [(needed, step) for needed, step, ascii in steps if ascii],
+        )
+    return _compiled[(language, penn)]
+
+
+def normalize_punctuation(line, language="en", penn=0):
+    steps, ascii_steps = _Steps(language, penn)
+    text = line
+    for needed, step in ascii_steps if text.isascii() else steps:
+        if needed in text:
+            text = step(text)
     return text
@@ -1,7 +1,28 @@
 # This is a Python equivalent of the MOSES tooklit Perl script
+#
+# The translate table of the non printing characters is shared with the
+# sentence cleaner of utils/ (installed or loaded from the repository)
+
+try:
+    from sentence_cleaner_splitter.remove_non_printing_char import get_replacer
+except ImportError:
+    import importlib.util
+    from pathlib import Path
+
+    _spec = importlib.util.spec_from_file_location(
+        'remove_non_printing_char',
+        Path(__file__).resolve().parents[2] / 'utils' / 'src' / 'remove_non_printing_char.py')
+    _module = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_module)
+    get_replacer = _module.get_replacer
+
+_replace_non_printing_chars = None
 
-import unicodedata
 
 def remove_non_printing_chars(line):
+    global _replace_non_printing_chars
+    if _replace_non_printing_chars is None:
+        # the table is built on first use
+        _replace_non_printing_chars = get_replacer(' ')
     text = line.rstrip('\n')
-    return ''.join(ch if unicodedata.category(ch)[0] != 'C' else ' ' for ch in text) + '\n'
+    return _replace_non_printing_chars(text) + '\n'
@@ -16,13 +16,26 @@
 
 import os
 import sys
+import gzip as gz
 import logging
+import queue
+import shlex
+import secrets
+import signal
+import string
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from contextlib import nullcontext
+from itertools import islice
 from pathlib import Path
 import numpy as np
-from subprocess import run, check_output, CalledProcessError, DEVNULL
+from subprocess import run, Popen, CalledProcessError, DEVNULL, PIPE, TimeoutExpired
 from .remove_non_printing_chars import remove_non_printing_chars
 from .normalize_punctuation import normalize_punctuation
 from .deescape_special_chars import deescape_special_chars
+from .embedding_format import LoadEmbeddings
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -42,7 +55,8 @@ NORM_PUNC = MOSES_BDIR + 'normalize-punctuation.perl -l '
 DESCAPE = MOSES_BDIR + 'deescape-special-chars.perl'
 REM_NON_PRINT_CHAR = MOSES_BDIR + 'remove-non-printing-char.perl'
 SPM_DIR = LASER + '/tools-external/sentencepiece-master/build/src/'
-SPM = 'LD_LIBRARY_PATH=' + SPM_DIR + ' ' + SPM_DIR + '/spm_encode --output_format=piece'
+SPM_ENCODE = SPM_DIR + '/spm_encode'
+SPM = 'LD_LIBRARY_PATH=' + SPM_DIR + ' ' + SPM_ENCODE + ' --output_format=piece'
 
 # Romanization (and lower casing)
 ROMAN_LC = 'python3 ' + LASER + '/source/lib/romanize_lc.py -l '
@@ -50,6 +64,15 @@ ROMAN_LC = 'python3 ' + LASER + '/source/lib/romanize_lc.py -l '
 # Mecab tokenizer for Japanese
 MECAB = LASER + '/tools-external/mecab'
 
+# Run a perl script with autoflush: the scripts which do not implement -b
+# (e.g. remove-non-printing-char.perl) would otherwise buffer their output
+PERL_FLUSH = "perl -e '$|=1; $0=shift; do $0; die $@ if $@' "
+
+# Prefix of the line written after each batch of a TokenizerSession, which
+# is followed by random letters so that no input line can end the batch.
+# It is unchanged by all the steps of the pipeline (lower case ASCII letters)
+SESSION_SENTINEL = 'qqlasertokenizersessionendqq'
+
 
 
 
@@ -59,21 +82,172 @@ MECAB = LASER + '/tools-external/mecab'
 #
 ###############################################################################
 
-def TokenLine(line, lang='en', lower_case=True, romanize=False):
+class TokenizerSession:
+    """
+    Tokenize lines as TokenLine, keeping the tokenizer alive between calls
+    engine 'perl': the pipeline of the Moses perl scripts is started once,
+    each step flushing its output after each line, and the lines are
+    streamed through it, followed by SESSION_SENTINEL and random letters
+    which mark the end of the output. The tokenizer is killed, and
+    TimeoutError raised, if it does not output anything for timeout
+    seconds, and on any other error (e.g. not one output line per input
+    line). A tokenizer killed or closed is started again by the next call.
+    engine 'python': the lines are tokenized in process (TokenLinePython)
+    descape: de-escape the special characters, as Token
+    """
+    def __init__(self, lang='en', lower_case=True, romanize=False,
+                 descape=False, engine='perl', timeout=60):
+        assert lower_case, 'lower case is needed by all the models'
+        assert engine in ('perl', 'python'), f'unknown tokenizer engine: {engine}'
+        assert not (engine == 'python' and lang == 'ja'), \
+            'no Python tokenizer for Japanese (Mecab)'
+        self.lang = lang
+        self.romanize = romanize
+        self.descape = descape
+        self.engine = engine
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        if engine == 'perl':
+            self._start()
+
+    def _start(self):
+        # lang is quoted, it may come from a request (docker/app.py)
+        lang = shlex.quote(self.lang)
+        roman = lang if self.romanize else 'none'
+        self.process = Popen(
+            PERL_FLUSH + REM_NON_PRINT_CHAR
+            + '|' + PERL_FLUSH + NORM_PUNC + lang + ' -b'
+            + ('|' + PERL_FLUSH + DESCAPE if self.descape else '')
+            + '|' + PERL_FLUSH + MOSES_BDIR + 'tokenizer.perl -q -no-escape -b -l ' + lang
+            + ('| python3 -m jieba -d ' if self.lang == 'zh' else '')
+            + ('| stdbuf -oL ' + MECAB + '/bin/mecab -O wakati -b 50000 ' if self.lang == 'ja' else '')
+            + '|' + ROMAN_LC + roman,
+            stdin=PIPE, stdout=PIPE, encoding='UTF-8', shell=True,
+            start_new_session=True,  # to kill the whole pipeline
+            env=dict(os.environ, PYTHONUNBUFFERED='1',
+                     LD_LIBRARY_PATH=MECAB + '/lib'))
+        # read from another thread, to wait with a timeout
+        self.output = queue.Queue()
+        threading.Thread(target=self._read, args=(self.process, self.output),
+                         daemon=True).start()
+
+    @staticmethod
+    def _read(process, output):
+        # output lines of the tokenizer, then None at its end
+        for line in process.stdout:
+            output.put(line)
+        output.put(None)
+
+    @staticmethod
+    def _write(process, lines):
+        try:
+            for line in lines:
+                process.stdin.write(line + '\n')
+            process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass  # the tokenizer was killed
+
+    def _kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # the whole pipeline terminated
+        self.process.wait()
+        self.process = None
+
+    def tokenize_many(self, lines):
+        """
+        Tokenize a list of lines (without newlines), returns the list of
+        tokenized lines
+        """
+        lines = [line.rstrip('\n').replace('\n', ' ') for line in lines]
+        if self.engine == 'python':
+            return [TokenLinePython(line, lang=self.lang, romanize=self.romanize,
+                                    descape=self.descape) for line in lines]
+        with self.lock:
+            if self.process is None:  # closed, or killed after a timeout
+                self._start()
+            sentinel = SESSION_SENTINEL + ''.join(
+                secrets.choice(string.ascii_lowercase) for _ in range(16))
+            # write from another thread, the pipes have limited capacity
+            writer = threading.Thread(target=self._write, args=(
+                self.process, lines + [sentinel]))
+            writer.start()
+            tok = []
+            try:
+                while True:
+                    try:
+                        out = self.output.get(timeout=self.timeout)
+                    except queue.Empty:
+                        raise TimeoutError(
+                            f'no output of the tokenizer for {self.timeout} seconds')
+                    assert out is not None, 'the tokenizer process terminated'
+                    out = out.rstrip('\n')
+                    if out.strip() == sentinel:
+                        break
+                    tok.append(out)
+                assert len(tok) == len(lines), \
+                    f'{len(tok)} tokenized lines for {len(lines)} lines'
+            except BaseException:
+                # the output of the batch must not be read by the next one
+                self._kill()
+                raise
+            finally:
+                writer.join()
+        return tok
+
+    def tokenize(self, line):
+        return self.tokenize_many([line])[0]
+
+    def close(self):
+        # waits for the batch being tokenized
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.close()
+                try:
+                    self.process.wait(timeout=self.timeout)
+                    self.process = None
+                except TimeoutExpired:
+                    self._kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# at most TOKEN_SESSIONS_MAX tokenizers are kept alive, the least recently
+# used one is closed when another language is needed
+TOKEN_SESSIONS_MAX = 16
+_token_sessions = OrderedDict()
+_token_sessions_lock = threading.Lock()
+
+
+def TokenSession(lang='en', romanize=False, descape=False):
+    # shared tokenizer of a language, started on first use
+    with _token_sessions_lock:
+        key = (lang, romanize, descape)
+        session = _token_sessions.get(key)
+        if session is None:
+            session = _token_sessions[key] = TokenizerSession(
+                lang=lang, romanize=romanize, descape=descape)
+        _token_sessions.move_to_end(key)
+        evicted = []
+        while len(_token_sessions) > TOKEN_SESSIONS_MAX:
+            evicted.append(_token_sessions.popitem(last=False)[1])
+    # a session still used by another thread is started again
+    for old in evicted:
+        old.close()
+    return session
+
+
+def TokenLine(line, lang='en', lower_case=True, romanize=False, descape=True):
+    # de-escaped by default, as before the tokenizer sessions
     assert lower_case, 'lower case is needed by all the models'
-    roman = lang if romanize else 'none'
-    tok = check_output(
-        REM_NON_PRINT_CHAR
-        + '|' + NORM_PUNC + lang
-        + '|' + DESCAPE
-        + '|' + MOSES_TOKENIZER + lang
-        + ('| python3 -m jieba -d ' if lang == 'zh' else '')
-        + ('|' + MECAB + '/bin/mecab -O wakati -b 50000 ' if lang == 'ja' else '')
-        + '|' + ROMAN_LC + roman,
-        input=line,
-        encoding='UTF-8',
-        shell=True)
-    return tok.strip()
+    session = TokenSession(lang, romanize=romanize, descape=descape)
+    return '\n'.join(session.tokenize_many(line.split('\n'))).strip()
 
 
 ###############################################################################
@@ -84,9 +258,15 @@ def TokenLine(line, lang='en', lower_case=True, romanize=False):
 
 def Token(inp_fname, out_fname, lang='en',
           lower_case=True, romanize=False, descape=False,
-          verbose=False, over_write=False, gzip=False):
+          verbose=False, over_write=False, gzip=False,
+          engine='perl', num_workers=None):
+    """
+    engine: 'perl' runs the Moses perl scripts, 'python' the in-process
+    tokenizer (TokenLines) on num_workers processes (default: all cores)
+    """
     assert lower_case, 'lower case is needed by all the models'
     assert not over_write, 'over-write is not yet implemented'
+    assert engine in ('perl', 'python'), f'unknown tokenizer engine: {engine}'
     if not os.path.isfile(out_fname):
         cat = 'zcat ' if gzip else 'cat '
         roman = lang if romanize else 'none'
@@ -95,12 +275,20 @@ def Token(inp_fname, out_fname, lang='en',
             lang = 'zh'
         if lang in ('jpn'):
             lang = 'ja'
+        if engine == 'python' and lang == 'ja':
+            logger.warning('no Python tokenizer for Japanese (Mecab), using perl')
+            engine = 'perl'
         if verbose:
-            logger.info('tokenizing {} in language {} {} {}'
+            logger.info('tokenizing {} in language {} {} {} {}'
                   .format(os.path.basename(inp_fname), lang,
                           '(gzip)' if gzip else '',
                           '(de-escaped)' if descape else '',
-                          '(romanized)' if romanize else ''))
+                          '(romanized)' if romanize else '',
+                          '(python)' if engine == 'python' else ''))
+        if engine == 'python':
+            TokenFilePython(inp_fname, out_fname, lang=lang, romanize=romanize,
+                            descape=descape, gzip=gzip, num_workers=num_workers)
+            return
         run(cat + inp_fname
             + '|' + REM_NON_PRINT_CHAR
             + '|' + NORM_PUNC + lang
@@ -117,6 +305,127 @@ def Token(inp_fname, out_fname, lang='en',
               .format(os.path.basename(out_fname), lang))
 
 
+###############################################################################
+#
+# Tokenize in Python, without the perl scripts
+# Same steps as Token: remove non printing characters, normalize
+# punctuation, de-escape, Moses tokenization (sacremoses), jieba for
+# Chinese, and romanization and lower casing
+#
+###############################################################################
+
+@lru_cache(maxsize=None)
+def _MosesTokenizer(lang):
+    # one tokenizer per language and process, loading the non-breaking
+    # prefixes is slow
+    from sacremoses import MosesTokenizer
+    return MosesTokenizer(lang=lang)
+
+
+@lru_cache(maxsize=None)
+def _Jieba():
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+    return jieba
+
+
+def TokenLinePython(line, lang='en', lower_case=True, romanize=False,
+                    descape=False):
+    """
+    Tokenize a line as Token with the perl scripts, without the newline
+    """
+    assert lower_case, 'lower case is needed by all the models'
+    text = remove_non_printing_chars(line)
+    text = normalize_punctuation(text, lang).rstrip('\n')
+    if descape:
+        text = deescape_special_chars(text)
+    # tokenizer.perl -no-escape
+    text = _MosesTokenizer(lang).tokenize(text, escape=False, return_str=True)
+    if lang == 'zh':
+        # python3 -m jieba -d
+        text = ' '.join(_Jieba().cut(text))
+    if romanize:
+        from transliterate import translit
+        text = translit(text, lang, reversed=True)
+    return text.lower()
+
+
+def TokenLines(lines, lang='en', lower_case=True, romanize=False,
+               descape=False):
+    """
+    Tokenize an iterable of lines in process and yield the tokenized lines
+    """
+    for line in lines:
+        yield TokenLinePython(line, lang=lang, lower_case=lower_case,
+                              romanize=romanize, descape=descape)
+
+
+def _token_chunk(chunk, lang, romanize, descape):
+    return ''.join(TokenLinePython(line, lang=lang, romanize=romanize,
+                                   descape=descape) + '\n'
+                   for line in chunk)
+
+
+def TokenFilePython(inp_fname, out_fname, lang='en', romanize=False,
+                    descape=False, gzip=False, num_workers=None,
+                    chunk_size=2000):
+    """
+    Tokenize a file (standard input if inp_fname is empty) with
+    TokenLinePython, by chunks of lines processed by a pool of num_workers
+    processes (default: all cores), in input order
+    """
+    num_workers = num_workers or len(os.sched_getaffinity(0))
+    max_pending = 2 * num_workers
+    with _OpenLines(inp_fname, gzip) as fin, \
+            open(out_fname, 'w', encoding='utf-8') as fout:
+        if num_workers == 1:
+            for chunk in _chunks(fin, chunk_size):
+                fout.write(_token_chunk(chunk, lang, romanize, descape))
+            return
+        with ProcessPoolExecutor(num_workers) as pool:
+            pending = deque()
+            for chunk in _chunks(fin, chunk_size):
+                pending.append(
+                    pool.submit(_token_chunk, chunk, lang, romanize, descape))
+                if len(pending) >= max_pending:
+                    fout.write(pending.popleft().result())
+            while pending:
+                fout.write(pending.popleft().result())
+
+
+def TokenVerify(inp_fname, lang='en', romanize=False, descape=False,
+                gzip=False, num_workers=None, max_diffs=10):
+    """
+    Tokenize a file with the perl scripts and in Python, and compare the
+    outputs byte for byte. Returns the number of lines which differ
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outputs = {}
+        for engine in ('perl', 'python'):
+            outputs[engine] = os.path.join(tmpdir, engine)
+            Token(inp_fname, outputs[engine], lang=lang, romanize=romanize,
+                  descape=descape, gzip=gzip, engine=engine,
+                  num_workers=num_workers)
+        ndiffs = nlines = 0
+        with open(outputs['perl'], 'rb') as fperl, \
+                open(outputs['python'], 'rb') as fpython:
+            for nlines, (perl, python) in enumerate(
+                    zip(fperl, fpython), start=1):
+                if perl != python:
+                    ndiffs += 1
+                    if ndiffs <= max_diffs:
+                        logger.info('line {:d} differs:\n  perl:   {!r}\n  python: {!r}'
+                                    .format(nlines, perl, python))
+            # files of different lengths
+            rest = len(fperl.readlines()) + len(fpython.readlines())
+    if rest:
+        logger.info('the outputs have different numbers of lines')
+    logger.info('{}: {:d}/{:d} lines differ'
+                .format(os.path.basename(inp_fname), ndiffs + rest, nlines + rest))
+    return ndiffs + rest
+
+
 ###############################################################################
 #
 # Apply SPM on a whole file
@@ -138,18 +447,39 @@ def PreprocessLine(line, lang='en', lower_case=True, descape=False):
 
 def SPMApply(inp_fname, out_fname, spm_model, custom_tokenizer=None, lang='en',
              lower_case=True, descape=False,
-             verbose=False, over_write=False, gzip=False):
+             verbose=False, over_write=False, gzip=False,
+             in_process=None, num_threads=-1):
+    """
+    in_process: normalize in Python and encode with the sentencepiece
+    library (SPMApplyLines) on num_threads threads (-1: all cores), instead
+    of the perl scripts and spm_encode (default: if spm_encode is not built)
+    """
     assert lower_case, 'lower case is needed by all the models'
     assert not(spm_model and custom_tokenizer), 'cannot define both SPM model and custom tokenizer'
+    if in_process is None:
+        in_process = bool(spm_model) and not os.path.isfile(SPM_ENCODE)
+    assert not (in_process and custom_tokenizer), 'custom tokenizers cannot run in process'
     if not os.path.isfile(out_fname):
         cat = 'zcat ' if gzip else 'cat '
         if verbose:
-            logger.info('SPM processing {} {} {}'
+            logger.info('SPM processing {} {} {} {}'
                   .format(os.path.basename(inp_fname),
                          '(gzip)' if gzip else '',
-                         '(de-escaped)' if descape else ''))
+                         '(de-escaped)' if descape else '',
+                         '(in process)' if in_process else ''))
 
         assert os.path.isfile(custom_tokenizer) if custom_tokenizer else os.path.isfile(spm_model), f'No SPM model ({spm_model}) or custom tokenizer ({custom_tokenizer}) found'
+        if in_process:
+            # the output only appears once complete
+            tmp_fname = out_fname + '.tmp'
+            with _OpenLines(inp_fname, gzip) as fp, \
+                    open(tmp_fname, 'w', encoding='utf-8') as fout:
+                for line in SPMApplyLines(fp, spm_model, lang=lang,
+                                          lower_case=lower_case, descape=descape,
+                                          num_threads=num_threads):
+                    fout.write(line + '\n')
+            os.replace(tmp_fname, out_fname)
+            return
         command = (cat + inp_fname
             + '|' + REM_NON_PRINT_CHAR
             + '|' + NORM_PUNC + lang
@@ -191,6 +521,76 @@ def BPEfastApply(inp_fname, out_fname, bpe_codes,
               .format(os.path.basename(out_fname)))
 
 
+###############################################################################
+#
+# In memory equivalents of SPMApply and BPEfastApply
+# Lines are processed buffer by buffer, without temporary files or
+# external processes
+#
+###############################################################################
+
+def _OpenLines(fname, gzip=False):
+    """
+    Open a text file (standard input if fname is empty) to iterate over
+    its lines as the perl scripts read them: lines only end at '\n', a lone
+    '\r' is kept in the line (and replaced by a space as non printing)
+    """
+    if not fname:
+        return nullcontext(line.decode('utf-8') for line in sys.stdin.buffer)
+    if gzip:
+        return gz.open(fname, 'rt', encoding='utf-8', newline='\n')
+    return open(fname, encoding='utf-8', newline='\n')
+
+
+def _chunks(lines, size):
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def SPMApplyLines(lines, spm_model, lang='en', lower_case=True, descape=False,
+                  buffer_size=10000, num_threads=-1):
+    """
+    Apply to an iterable of lines the same processing as SPMApply
+    and yield the SPM encoded lines
+    spm_model is the file name of the model, or a loaded
+    SentencePieceProcessor (e.g. shared by several encoders)
+    Each buffer is encoded on num_threads threads (-1: all cores)
+    """
+    if isinstance(spm_model, (str, os.PathLike)):
+        import sentencepiece as spm
+        assert os.path.isfile(spm_model), f'No SPM model ({spm_model}) found'
+        sp = spm.SentencePieceProcessor(model_file=str(spm_model))
+    else:
+        sp = spm_model
+    for chunk in _chunks(lines, buffer_size):
+        chunk = [PreprocessLine(line, lang=lang, lower_case=lower_case,
+                                descape=descape).rstrip('\n')
+                 for line in chunk]
+        for pieces in sp.encode(chunk, out_type=str, num_threads=num_threads):
+            yield ' '.join(pieces)
+
+
+def BPEfastApplyLines(lines, bpe_codes, buffer_size=10000):
+    """
+    Apply fastBPE to an iterable of lines and yield the BPE encoded lines
+    bpe_codes is the file name of the codes, or a loaded fastBPE object
+    """
+    if isinstance(bpe_codes, (str, os.PathLike)):
+        import fastBPE
+        bpe_codes = str(bpe_codes)
+        bpe_vocab = bpe_codes.replace('fcodes', 'fvocab')
+        assert os.path.isfile(bpe_vocab), f'fastBPE: vocab file {bpe_vocab} not found'
+        bpe = fastBPE.fastBPE(bpe_codes, bpe_vocab)
+    else:
+        bpe = bpe_codes
+    for chunk in _chunks(lines, buffer_size):
+        yield from bpe.apply([line.rstrip('\n') for line in chunk])
+
+
 ###############################################################################
 #
 # Split long lines into multiple sentences at "."
@@ -254,7 +654,7 @@ def JoinEmbed(if_embed, sid_fname, of_embed, dim=1024):
         print(' - JoinEmbed: {} already exists'.format(of_embed))
         return
     # read the input embeddings
-    em_in = np.fromfile(if_embed, dtype=np.float32, count=-1).reshape(-1, dim)
+    em_in = LoadEmbeddings(if_embed, dim=dim, dtype=np.float32, mmap=False)
     ninp = em_in.shape[0]
     print(' - Combine embeddings:')
     print('                input: {:s} {:d} sentences'.format(if_embed, ninp))
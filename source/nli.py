@@ -25,6 +25,7 @@ import torch.optim as optim
 import torch.utils.data as data_utils
 import numpy as np
 import faiss
+from lib.embedding_format import LoadEmbeddings
 
 
 ################################################
@@ -33,12 +34,10 @@ def LoadDataNLI(fn1, fn2, fn_lbl,
                 dim=1024, bsize=32,
                 fraction=1.0,
                 shuffle=False, quiet=False):
-    x = np.fromfile(fn1, dtype=np.float32, count=-1)
-    x.resize(x.shape[0] // dim, dim)
+    x = LoadEmbeddings(fn1, dim=dim, dtype=np.float32, mmap=False).astype(np.float32, copy=False)
     faiss.normalize_L2(x)
 
-    y = np.fromfile(fn2, dtype=np.float32, count=-1)
-    y.resize(y.shape[0] // dim, dim)
+    y = LoadEmbeddings(fn2, dim=dim, dtype=np.float32, mmap=False).astype(np.float32, copy=False)
     faiss.normalize_L2(y)
 
     lbl = np.loadtxt(fn_lbl, dtype=np.int32)
@@ -23,13 +23,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data as data_utils
+from lib.embedding_format import LoadEmbeddings
 
 
 ################################################
 
 def LoadData(bdir, dfn, lfn, dim=1024, bsize=32, shuffle=False, quiet=False):
-    x = np.fromfile(bdir + dfn, dtype=np.float32, count=-1)
-    x.resize(x.shape[0] // dim, dim)
+    x = LoadEmbeddings(bdir + dfn, dim=dim, dtype=np.float32, mmap=False)
+    x = x.astype(np.float32, copy=False)
 
     lbl = np.loadtxt(bdir + lfn, dtype=np.int32)
     lbl.reshape(lbl.shape[0], 1)
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Tool to tokenize a text file as embed.py --token-lang, with the Moses
+# perl scripts or in Python, or to compare both tokenizers on a file
+
+import sys
+import argparse
+
+from lib.text_processing import Token, TokenVerify
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="LASER: tokenize a text file")
+    parser.add_argument("--input", type=str, required=True, help="Input text file")
+    parser.add_argument("--output", type=str, default=None, help="Tokenized text file")
+    parser.add_argument("--lang", type=str, default="en", help="Language of the text")
+    parser.add_argument("--engine", type=str, default="python", choices=["perl", "python"],
+                        help="Moses perl scripts or Python tokenizer")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="Number of processes of the Python tokenizer (default: all cores)")
+    parser.add_argument("--romanize", action="store_true", help="Romanize the text")
+    parser.add_argument("--descape", action="store_true", help="De-escape special characters")
+    parser.add_argument("--gzip", action="store_true", help="The input is gzipped")
+    parser.add_argument("--verify", action="store_true",
+                        help="Compare the outputs of the perl and Python tokenizers")
+    parser.add_argument("--verbose", action="store_true", help="Detailed output")
+    args = parser.parse_args()
+
+    if args.verify:
+        ndiffs = TokenVerify(args.input, lang=args.lang, romanize=args.romanize,
+                             descape=args.descape, gzip=args.gzip,
+                             num_workers=args.num_workers)
+        sys.exit(1 if ndiffs else 0)
+    assert args.output, "--output is required"
+    Token(args.input, args.output, lang=args.lang, romanize=args.romanize,
+          descape=args.descape, gzip=args.gzip, verbose=args.verbose,
+          engine=args.engine, num_workers=args.num_workers)
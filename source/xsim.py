@@ -19,6 +19,7 @@ import typing as tp
 import os
 import json
 from enum import Enum
+from lib.embedding_format import LoadEmbeddings
 
 
 class Margin(Enum):
@@ -51,11 +52,10 @@ def xSIM(
 
 
 def _load_embeddings(infile: str, dim: int, fp16: bool = False) -> np.ndarray:
-    assert os.path.isfile(infile), f"file: {infile} does not exist."
-    emb = np.fromfile(infile, dtype=np.float16 if fp16 else np.float32)
-    num_examples = emb.shape[0] // dim
-    emb.resize(num_examples, dim)
-    if fp16:
+    emb = LoadEmbeddings(
+        infile, dim=dim, dtype=np.float16 if fp16 else np.float32, mmap=False
+    )
+    if emb.dtype != np.float32:
         emb = emb.astype(np.float32)  # faiss currently only supports fp32
     return emb
 
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# LASER  Language-Agnostic SEntence Representations
+# is a toolkit to calculate multilingual sentence embeddings
+# and to use them for document classification, bitext filtering
+# and mining
+#
+# --------------------------------------------------------
+#
+# Micro-benchmarks of the hot spots of the embedding pipeline, against the
+# reference implementations of the tests
+# e.g. python tests/benchmark.py normalize -i data/tatoeba/v1/tatoeba.*
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+os.environ.setdefault("LASER", str(ROOT))
+sys.path.insert(0, str(ROOT / "source"))
+
+from reference import make_batches_reference, normalize_punctuation_reference  # noqa: E402
+
+
+def Timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def ReadLines(args, strip=True):
+    lines = []
+    for fname in args.input:
+        with open(fname, encoding="utf-8", errors="surrogateescape") as fin:
+            lines.extend(line.strip() if strip else line for line in fin)
+    return lines[:args.max_lines]
+
+
+def Report(name, n, ref_time, new_time):
+    print(" - {:s}: {:d} lines".format(name, n))
+    print("   reference: {:8.3f}s {:10.0f} lines/s".format(ref_time, n / ref_time))
+    print("   optimized: {:8.3f}s {:10.0f} lines/s (x{:.1f})".format(
+        new_time, n / new_time, ref_time / new_time))
+
+
+###############################################################################
+#
+# Tokenization and batch construction in SentenceEncoder
+#
+###############################################################################
+
+def BenchBatching(args):
+    from embed import load_model
+    encoder = load_model(
+        args.encoder, args.spm_model, None,
+        max_tokens=args.max_tokens, cpu=True)
+    lines = ReadLines(args)
+
+    for (ref_toks, ref_idx), (batch, idx) in zip(
+            make_batches_reference(encoder, lines), encoder._make_batches(lines)):
+        assert list(ref_idx) == list(idx), "batch indices differ"
+        assert (ref_toks == batch.tokens).all(), "batch tokens differ"
+
+    ref_time = Timeit(lambda: list(make_batches_reference(encoder, lines)), args.repeat)
+    new_time = Timeit(lambda: list(encoder._make_batches(lines)), args.repeat)
+    Report("tokenization and batching", len(lines), ref_time, new_time)
+
+
+###############################################################################
+#
+# Punctuation normalization (PreprocessLine)
+#
+###############################################################################
+
+def BenchNormalize(args):
+    # e.g. --max-lines 1000000
+    from lib.normalize_punctuation import normalize_punctuation
+    lines = ReadLines(args, strip=False)
+    for lang in args.langs:
+        for penn in (0, 1):
+            for line in lines:
+                assert normalize_punctuation(line, lang, penn) == \
+                    normalize_punctuation_reference(line, lang, penn), \
+                    "normalize_punctuation differs ({}): {!r}".format(lang, line)
+        ref_time = Timeit(lambda: [normalize_punctuation_reference(line, lang)
+                                   for line in lines], args.repeat)
+        new_time = Timeit(lambda: [normalize_punctuation(line, lang)
+                                   for line in lines], args.repeat)
+        Report("normalize_punctuation ({})".format(lang), len(lines), ref_time, new_time)
+
+
+BENCHMARKS = {
+    "batching": BenchBatching,
+    "normalize": BenchNormalize,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LASER: micro-benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()),
+                        help="Benchmark to run")
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+                        help="Input text files (already preprocessed for batching)")
+    parser.add_argument("--encoder", type=str, default=None,
+                        help="Encoder to be used")
+    parser.add_argument("--spm-model", type=str, default=None,
+                        help="SPM model of the encoder")
+    parser.add_argument("--max-tokens", type=int, default=12000,
+                        help="Maximum number of tokens to process in a batch")
+    parser.add_argument("--max-lines", type=int, default=100000,
+                        help="Maximum number of input lines")
+    parser.add_argument("--langs", type=str, nargs="+", default=["en", "fr", "ru"],
+                        help="Languages of the normalization rules")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs (best is reported)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,18 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Regression tests: run with python -m pytest tests from the root of the
+# repository. The tests of the encoder need fairseq, the tests of the
+# tokenizers the Moses scripts (install_external_tools.sh) and are
+# skipped otherwise.
+
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+os.environ.setdefault("LASER", str(ROOT))
+sys.path.insert(0, str(ROOT / "source"))
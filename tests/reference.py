@@ -0,0 +1,136 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Reference implementations of the optimized code paths, which the tests
+# and benchmark.py compare against
+
+import re
+import unicodedata
+
+import numpy as np
+
+
+def make_batches_reference(encoder, lines):
+    # per sentence implementation of SentenceEncoder._make_batches
+    import torch
+
+    tokens = [encoder._tokenize(line) for line in lines]
+    lengths = np.array([t.numel() for t in tokens])
+    indices = np.argsort(-lengths, kind=encoder.sort_kind)
+    batches = []
+    batch = []
+    ntokens = 0
+    for i in indices:
+        if batch and (
+            (encoder.max_tokens is not None and ntokens + lengths[i] > encoder.max_tokens)
+            or (encoder.max_sentences is not None and len(batch) == encoder.max_sentences)
+        ):
+            batches.append(batch)
+            batch = []
+            ntokens = 0
+        batch.append(i)
+        ntokens += lengths[i]
+    if batch:
+        batches.append(batch)
+    for batch in batches:
+        toks = torch.full((len(batch), lengths[batch[0]]), encoder.pad_index, dtype=torch.long)
+        for j, i in enumerate(batch):
+            if encoder.left_padding:
+                toks[j, -lengths[i]:] = tokens[i]
+            else:
+                toks[j, :lengths[i]] = tokens[i]
+        yield toks, batch
+
+
+def normalize_punctuation_reference(line, language="en", penn=0):
+    # sequential implementation of normalize_punctuation
+    text = line.replace('\r', '')
+
+    # remove extra spaces
+    text = re.sub(r'\(', ' (', text)
+    text = re.sub(r'\)', ') ', text)
+    text = re.sub(r' +', ' ', text)
+    text = re.sub(r'\) ([\.\!\:\?\;\,])', r')\1', text)
+    text = re.sub(r'\( ', '(', text)
+    text = re.sub(r' \)', ')', text)
+    text = re.sub(r'(\d) %', r'\1%', text)
+    text = re.sub(r' :', ':', text)
+    text = re.sub(r' ;', ';', text)
+
+    # normalize unicode punctuation
+    if penn == 0:
+        text = text.replace('`', "'")
+        text = text.replace("''", ' " ')
+
+    text = text.replace('„', '"')
+    text = text.replace('“', '"')
+    text = text.replace('”', '"')
+    text = text.replace('–', '-')
+    text = re.sub(r'—', ' - ', text)
+    text = re.sub(r' +', ' ', text)
+    text = text.replace('´', "'")
+    text = re.sub(r'([a-z])‘([a-z])', r"\1'\2", text, flags=re.IGNORECASE)
+    text = re.sub(r'([a-z])’([a-z])', r"\1'\2", text, flags=re.IGNORECASE)
+    text = text.replace('‘', '"')
+    text = text.replace('‚', '"')
+    text = text.replace('’', '"')
+    text = text.replace("''", '"')
+    text = text.replace('´´', '"')
+    text = text.replace('…', '...')
+
+    # French quotes
+    text = text.replace('\xa0«\xa0', ' "')
+    text = text.replace('«\xa0', '"')
+    text = text.replace('«', '"')
+    text = text.replace('\xa0»\xa0', '" ')
+    text = text.replace('\xa0»', '"')
+    text = text.replace('»', '"')
+
+    # handle pseudo-spaces
+    text = text.replace('\xa0%', '%')
+    text = text.replace('nº\xa0', 'nº ')
+    text = text.replace('\xa0:', ':')
+    text = text.replace('\xa0ºC', ' ºC')
+    text = text.replace('\xa0cm', ' cm')
+    text = text.replace('\xa0?', '?')
+    text = text.replace('\xa0!', '!')
+    text = text.replace('\xa0;', ';')
+    text = text.replace(',\xa0', ', ')
+    text = re.sub(r' +', ' ', text)
+
+    # English "quotation," followed by comma, style
+    if language == "en":
+        text = re.sub(r'\"([,\.]+)', r'\1"', text)
+    # German/Spanish/French "quotation", followed by comma, style
+    elif language in ["de", "es", "cz", "cs", "fr"]:
+        text = re.sub(r',\"', '",', text)
+        text = re.sub(r'(\.+)"(\s*[^<])', r'"\1\2', text)
+
+    if language in ["de", "es", "cz", "cs", "fr"]:
+        text = re.sub(r'(\d) (\d)', r'\1,\2', text)
+    else:
+        text = re.sub(r'(\d) (\d)', r'\1.\2', text)
+
+    return text
+
+
+def remove_non_printing_chars_reference(line):
+    # per character implementation of remove_non_printing_chars
+    text = line.rstrip("\n")
+    return "".join(
+        ch if unicodedata.category(ch)[0] != "C" else " " for ch in text
+    ) + "\n"
+
+
+def index_text_reference(text):
+    # per line implementation of IndexTextCreate: byte offset and number of
+    # words (clipped to 255) of each line of the bytes text
+    lines = text.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    offsets = np.cumsum([0] + [len(line) + 1 for line in lines])[:-1]
+    words = [min(len(re.findall(rb"[^\x00-\x20]+", line)), 255) for line in lines]
+    return offsets, np.array(words, dtype=np.uint8)
@@ -0,0 +1,174 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Endpoints of the embedding server (docker/app.py) and their response
+# formats against encoding the preprocessed sentences, with a fake encoder
+# and a small SPM model
+
+import importlib.util
+import io
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+spm = pytest.importorskip("sentencepiece")
+pytest.importorskip("fairseq")
+
+import embed  # noqa: E402
+from lib.text_processing import SPMApplyLines  # noqa: E402
+
+APP = os.path.join(os.environ["LASER"], "docker", "app.py")
+
+TEXT = [
+    "Hey, how are you?",
+    "I'm OK and you?",
+    "Ça va, merci.",
+    "Wie geht es dir?",
+    "the quick brown fox jumps over the lazy dog",
+]
+
+
+class FakeEncoder:
+    # embedding: number of pieces and length of each SPM encoded sentence
+    dim = embed.LASER_EMBED_DIM
+
+    def __init__(self):
+        self.calls = []
+
+    def encode_sentences(self, sentences):
+        self.calls.append(list(sentences))
+        x = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            x[i, :2] = len(sentence.split()), len(sentence)
+        return x
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("spm")
+    inp = tmp_path / "input"
+    inp.write_text("\n".join(TEXT * 20) + "\n", encoding="utf-8")
+    spm.SentencePieceTrainer.train(input=str(inp), model_prefix=str(tmp_path / "spm"),
+                                   vocab_size=60, hard_vocab_limit=False)
+    encoder = FakeEncoder()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("LASER_SPM_MODEL", str(tmp_path / "spm.model"))
+        monkeypatch.setattr(embed, "load_model", lambda *args, **kwargs: encoder)
+        spec = importlib.util.spec_from_file_location("laser_app", APP)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    yield module
+    module.batcher.close()
+
+
+def _reference(app, sentences, lang):
+    lines = list(SPMApplyLines([" ".join(s.split()) for s in sentences],
+                               app.spm_model, lang=lang))
+    return FakeEncoder().encode_sentences(lines)
+
+
+def test_vectorize(app):
+    client = app.app.test_client()
+    resp = client.get("/vectorize", query_string={"q": "\n".join(TEXT[:2]), "lang": "fr"})
+    assert resp.status_code == 200
+    assert np.array_equal(resp.get_json()["embedding"], _reference(app, TEXT[:2], "fr"))
+
+    resp = client.post("/vectorize", json={"sentences": TEXT, "lang": "de"})
+    assert np.array_equal(resp.get_json()["embeddings"], _reference(app, TEXT, "de"))
+
+
+def test_vectorize_empty(app):
+    client = app.app.test_client()
+    calls = len(app.encoder.calls)
+    resp = client.post("/vectorize", json={"sentences": []})
+    assert resp.status_code == 200 and resp.get_json()["embeddings"] == []
+    assert len(app.encoder.calls) == calls
+
+
+@pytest.mark.parametrize(
+    "lang", ["en; touch pwned", "$(id)", "EN", "english", "en\n", "", 12, ["en"]]
+)
+def test_invalid_lang(app, lang):
+    # the language is passed to the tokenizer processes
+    client = app.app.test_client()
+    if isinstance(lang, str) and lang:
+        resp = client.get("/vectorize", query_string={"q": "hello", "lang": lang})
+        assert resp.status_code == 400
+    if lang:
+        resp = client.post("/vectorize", json={"sentences": ["hello"], "lang": lang})
+        assert resp.status_code == 400
+    resp = client.post("/vectorize/bulk", json={"items": [
+        {"text": "hello", "lang": "en"}, {"text": "world", "lang": lang}]})
+    assert resp.status_code == (200 if lang == "" else 400)
+    resp = client.post("/vectorize/bulk", json={"sentences": ["hello"], "langs": [lang]})
+    assert resp.status_code == 400
+
+
+def _decode(resp, fmt, dtype):
+    if fmt == "raw":
+        return np.frombuffer(resp.data, dtype=dtype).reshape(
+            int(resp.headers["X-Embedding-Count"]), int(resp.headers["X-Embedding-Dim"]))
+    if fmt == "npy":
+        return np.load(io.BytesIO(resp.data))
+    pa = pytest.importorskip("pyarrow")
+    table = pa.ipc.open_stream(resp.data).read_all()
+    column = table.column("embedding").combine_chunks()
+    return np.asarray(column.flatten(), dtype=dtype).reshape(
+        table.num_rows, column.type.list_size)
+
+
+@pytest.mark.parametrize("fmt", ["raw", "npy", "arrow"])
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+@pytest.mark.parametrize("n", [0, 1, 5])
+def test_binary_formats(app, fmt, dtype, n):
+    client = app.app.test_client()
+    reference = _reference(app, TEXT[:n], "fr") if n else np.zeros((0, FakeEncoder.dim))
+    for kwargs in ({"query_string": {"format": fmt, "dtype": dtype}},
+                   {"query_string": {"dtype": dtype},
+                    "headers": {"Accept": app.FORMATS[fmt]}}):
+        resp = client.post("/vectorize", json={"sentences": TEXT[:n], "lang": "fr"}, **kwargs)
+        assert resp.status_code == 200 and resp.mimetype == app.FORMATS[fmt]
+        assert resp.headers["X-Embedding-Count"] == str(n)
+        assert resp.headers["X-Embedding-Dim"] == str(FakeEncoder.dim)
+        assert resp.headers["X-Embedding-Dtype"] == dtype
+        embeddings = _decode(resp, fmt, dtype)
+        assert embeddings.dtype == dtype
+        assert np.array_equal(embeddings, reference.astype(dtype))
+
+
+def test_format_errors(app):
+    client = app.app.test_client()
+    body = {"sentences": TEXT[:2]}
+    resp = client.post("/vectorize", json=body, query_string={"format": "xml"})
+    assert resp.status_code == 406
+    resp = client.post("/vectorize", json=body, query_string={"format": "raw", "dtype": "int8"})
+    assert resp.status_code == 400
+    # JSON when no supported format is accepted
+    resp = client.post("/vectorize", json=body, headers={"Accept": "text/html"})
+    assert resp.status_code == 200 and resp.mimetype == "application/json"
+    assert np.array_equal(resp.get_json()["embeddings"], _reference(app, TEXT[:2], "en"))
+
+
+def test_bulk_keeps_order(app):
+    # the sentences of each language are encoded as by /vectorize
+    client = app.app.test_client()
+    langs = ["fr", "en", "de", "fr", "--"]
+    reference = np.vstack([_reference(app, [text], lang) for text, lang in zip(TEXT, langs)])
+    resp = client.post("/vectorize/bulk", json={"sentences": TEXT, "langs": langs})
+    assert np.array_equal(resp.get_json()["embeddings"], reference)
+
+    items = [{"text": text, "lang": lang} for text, lang in zip(TEXT, langs)]
+    items[1].pop("lang")
+    resp = client.post("/vectorize/bulk", json={"items": items, "lang": "en"},
+                       query_string={"format": "npy"})
+    assert np.array_equal(np.load(io.BytesIO(resp.data)), reference)
+
+    resp = client.post("/vectorize/bulk", json={"sentences": TEXT, "lang": "de"})
+    assert np.array_equal(resp.get_json()["embeddings"], _reference(app, TEXT, "de"))
+    resp = client.post("/vectorize/bulk", json={"sentences": TEXT, "langs": langs[:2]})
+    assert resp.status_code == 400
@@ -0,0 +1,85 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Dynamic batching of concurrent requests against encoding each request
+
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from batching import AsyncSentenceEncoder, DynamicBatcher
+
+
+class FakeEncoder:
+    # embedding: length and first character of each sentence
+    dim = 2
+
+    def __init__(self):
+        self.calls = []
+
+    def encode_sentences(self, sentences):
+        assert len(sentences) > 0, "empty call of the encoder"
+        if "fail" in sentences:
+            raise ValueError("fail")
+        self.calls.append(len(sentences))
+        return np.array(
+            [[len(s), ord(s[0]) if s else 0] for s in sentences], dtype=np.float32
+        )
+
+
+def _requests(n):
+    return [[f"{i}" * (j + 1) for j in range(i % 5 + 1)] for i in range(n)]
+
+
+def test_dynamic_batcher_matches_requests():
+    encoder = FakeEncoder()
+    requests = _requests(200)
+    results = {}
+    with DynamicBatcher(encoder.encode_sentences, max_batch_size=64, max_wait=0.05) as batcher:
+        def submit(i):
+            results[i] = batcher.encode_sentences(requests[i])
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = batcher.metrics()
+    for i, sentences in enumerate(requests):
+        assert np.array_equal(results[i], FakeEncoder().encode_sentences(sentences))
+    assert metrics["requests"] == len(requests)
+    assert metrics["sentences"] == sum(map(len, requests))
+    assert metrics["batches"] == len(encoder.calls) < len(requests)
+
+
+def test_dynamic_batcher_errors_and_empty_requests():
+    encoder = FakeEncoder()
+    with DynamicBatcher(encoder.encode_sentences) as batcher:
+        with pytest.raises(ValueError):
+            batcher.encode_sentences(["fail"])
+        assert batcher.encode_sentences([]).shape == (0, 2)
+        assert batcher.encode_sentences(["ok"]).shape == (1, 2)
+    with DynamicBatcher(lambda sentences: 1 / 0, dim=7) as batcher:
+        assert batcher.submit([]).result().shape == (0, 7)
+
+
+def test_async_encoder_matches_requests():
+    encoder = FakeEncoder()
+    requests = _requests(50)
+
+    async def main():
+        async with AsyncSentenceEncoder(encoder, max_wait=0.05) as async_encoder:
+            return await asyncio.gather(
+                *(async_encoder.encode(sentences) for sentences in requests + [[]])
+            )
+
+    results = asyncio.run(main())
+    for result, sentences in zip(results, requests):
+        assert np.array_equal(result, FakeEncoder().encode_sentences(sentences))
+    assert results[-1].shape == (0, 2)
+    assert len(encoder.calls) < len(requests)
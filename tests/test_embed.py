@@ -0,0 +1,343 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# SentenceEncoder and EncodeFile against the baseline: batching within each
+# buffer, per sentence tokenization and collation (reference.py), without
+# resume, cache or shards. The encoder is a small random LSTM.
+
+import copy
+import logging
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("fairseq")
+
+import torch  # noqa: E402
+
+import embed  # noqa: E402
+from embed import (  # noqa: E402
+    LONG_LINE_COUNTERS,
+    COMPILED_CHECKPOINT,
+    CachedSentenceEncoder,
+    CompileCheckpoint,
+    EncodeFile,
+    LaserLstmEncoder,
+    SentenceEncoder,
+    SentenceEncoderPool,
+    VersionTuple,
+)
+from lib.embedding_format import LoadEmbeddings, LoadShards, ManifestFname  # noqa: E402
+from reference import make_batches_reference  # noqa: E402
+
+VOCAB = 64
+DIM = 12
+
+
+@pytest.fixture(scope="module")
+def encoder_path(tmp_path_factory):
+    torch.manual_seed(0)
+    params = dict(num_embeddings=VOCAB, padding_idx=1, embed_dim=8,
+                  hidden_size=DIM // 2, num_layers=2, bidirectional=True)
+    model = LaserLstmEncoder(**params)
+    path = tmp_path_factory.mktemp("encoder") / "encoder.pt"
+    torch.save({
+        "params": params,
+        "model": model.state_dict(),
+        "dictionary": {f"w{i}": i for i in range(4, VOCAB)},
+    }, path)
+    return str(path)
+
+
+@pytest.fixture
+def encoder(encoder_path):
+    return SentenceEncoder(encoder_path, max_tokens=60, cpu=True, sort_kind="mergesort")
+
+
+def _lines(n=300, seed=0):
+    rs = np.random.RandomState(seed)
+    lines = [
+        " ".join(f"w{w}" for w in rs.randint(4, VOCAB + 8, size=rs.randint(0, 30)))
+        for _ in range(n)
+    ]
+    # duplicates, spaces and unknown words
+    return lines + lines[:20] + ["", "  w5\tw6  ", "w7　w8 w9 w10\x1cw11", "x y"]
+
+
+def _write_lines(path, lines):
+    # a lone \r does not end a line
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8", newline="\n")
+    return str(path)
+
+
+def _reference(encoder, lines):
+    # encoding each sentence alone
+    return np.vstack([encoder.encode_sentences([line]) for line in lines])
+
+
+@pytest.mark.parametrize("max_tokens, max_sentences", [(60, None), (None, 7), (25, 3), (1, None)])
+@pytest.mark.parametrize("left_padding", [False, True])
+@pytest.mark.parametrize("prepend_bos", [False, True])
+def test_make_batches_matches_reference(encoder, max_tokens, max_sentences,
+                                        left_padding, prepend_bos):
+    encoder = copy.copy(encoder)
+    encoder.max_tokens = max_tokens
+    encoder.max_sentences = max_sentences
+    encoder.left_padding = left_padding
+    encoder.prepend_bos = prepend_bos
+    lines = _lines()
+    batches = list(encoder._make_batches(lines))
+    reference = list(make_batches_reference(encoder, lines))
+    assert len(batches) == len(reference)
+    for (batch, indices), (ref_tokens, ref_indices) in zip(batches, reference):
+        assert list(indices) == list(ref_indices)
+        assert torch.equal(batch.tokens, ref_tokens)
+        assert batch.lengths.tolist() == (ref_tokens != encoder.pad_index).sum(1).tolist()
+
+
+def test_encode_matches_single_sentences(encoder):
+    lines = _lines()
+    x = encoder.encode_sentences(lines)
+    assert x.shape == (len(lines), DIM) and x.dtype == np.float32
+    assert np.allclose(x, _reference(encoder, lines), atol=1e-6)
+    assert encoder.dim == DIM
+    assert encoder.encode_sentences([]).shape[0] == 0
+
+
+def test_encoder_pool_matches_encoder(encoder):
+    lines = _lines()
+    reference = encoder.encode_sentences(lines)
+    with SentenceEncoderPool(copy.deepcopy(encoder), 2, pin_cores=False) as pool:
+        assert np.allclose(pool.encode_sentences(lines), reference, atol=1e-6)
+        assert pool.encode_sentences([]).shape == (0, DIM)
+
+
+@pytest.mark.parametrize("long_lines", ["truncate", "max"])
+def test_encoder_pool_counts_long_lines(encoder_path, long_lines):
+    lines = _lines()
+    encoder = SentenceEncoder(encoder_path, max_tokens=60, cpu=True,
+                              max_seq_len=6, long_lines=long_lines)
+    with SentenceEncoderPool(copy.deepcopy(encoder), 2, pin_cores=False) as pool:
+        for _ in range(2):
+            assert np.allclose(pool.encode_sentences(lines),
+                               encoder.encode_sentences(lines), atol=1e-6)
+    counts = [getattr(encoder, k) for k in LONG_LINE_COUNTERS]
+    assert [getattr(pool, k) for k in LONG_LINE_COUNTERS] == counts
+    assert max(counts) > 0
+
+
+@pytest.mark.parametrize("long_lines", ["truncate", "max", "mean"])
+def test_long_lines(encoder_path, long_lines):
+    encoder = SentenceEncoder(encoder_path, max_tokens=60, cpu=True,
+                              max_seq_len=6, long_lines=long_lines)
+    lines = _lines(100)
+    reference = []
+    for line in lines:
+        words = line.split()
+        # windows of max_seq_len - 1 words and eos
+        windows = [" ".join(words[i : i + 5]) for i in range(0, max(len(words), 1), 5)]
+        if long_lines == "truncate":
+            windows = windows[:1]
+        x = encoder.encode_sentences(windows)
+        reference.append(x.max(0) if long_lines == "max" else x.mean(0))
+    assert np.allclose(encoder.encode_sentences(lines), np.vstack(reference), atol=1e-6)
+
+
+@pytest.mark.parametrize("out_format", ["raw", "npy"])
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"pipelined": True},
+        {"bucket_window": 64},
+        {"bucket_window": 64, "bucket_width": 4, "pipelined": True},
+        {"shard_size": 50},
+    ],
+)
+def test_encode_file_matches_encode_sentences(tmp_path, encoder, out_format, options):
+    lines = _lines()
+    lines[3] += "\rw12"  # not a line break
+    inp = _write_lines(tmp_path / "input", lines)
+    out = str(tmp_path / "output")
+    EncodeFile(encoder, inp, out, buffer_size=32, out_format=out_format, **options)
+    if options.get("shard_size"):
+        x = np.concatenate(LoadShards(out, verify=True))
+    else:
+        x = LoadEmbeddings(out, dim=DIM)
+    assert np.allclose(x, _reference(encoder, lines), atol=1e-6)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith((".tmp", ".progress"))]
+
+
+@pytest.mark.parametrize("options", [{}, {"bucket_window": 64, "bucket_width": 4}])
+def test_encode_file_reports_progress(tmp_path, encoder, caplog, monkeypatch, options):
+    lines = _lines()
+    inp = _write_lines(tmp_path / "input", lines)
+    monkeypatch.setattr(embed, "PROGRESS_INTERVAL", 50)
+    caplog.set_level(logging.INFO)
+    EncodeFile(encoder, inp, str(tmp_path / "output"), buffer_size=32, verbose=True, **options)
+    reports = [int(r.getMessage().split()[1]) for r in caplog.records
+               if r.getMessage().startswith("encoded") and "in" not in r.getMessage().split()]
+    # once for each output crossing a multiple of 50 sentences
+    intervals = [n // 50 for n in reports]
+    assert intervals == sorted(set(intervals)) and intervals[-1] == len(lines) // 50
+    if not options:
+        assert intervals == list(range(1, len(lines) // 50 + 1))
+
+
+@pytest.mark.parametrize("wrapper", ["pool", "cache"])
+def test_encode_file_reports_long_lines(tmp_path, encoder_path, caplog, wrapper):
+    lines = _lines()
+    inp = _write_lines(tmp_path / "input", lines)
+    out = str(tmp_path / "output")
+    encoder = SentenceEncoder(encoder_path, max_tokens=60, cpu=True, max_seq_len=6)
+    reference = copy.deepcopy(encoder)
+    # the sentences found in the cache are not encoded again
+    reference.encode_sentences(lines if wrapper == "pool" else list(dict.fromkeys(lines)))
+    assert reference.ntruncated > 0
+    caplog.set_level(logging.INFO)
+    if wrapper == "pool":
+        with SentenceEncoderPool(encoder, 2, pin_cores=False) as pool:
+            EncodeFile(pool, inp, out, buffer_size=32, verbose=True)
+    else:
+        with CachedSentenceEncoder(encoder, str(tmp_path / "cache")) as cached:
+            EncodeFile(cached, inp, out, buffer_size=32, verbose=True)
+    assert f"truncated {reference.ntruncated} sentences to 6 tokens" in caplog.text
+
+
+@pytest.mark.parametrize("out_format", ["raw", "npy"])
+@pytest.mark.parametrize("shard_size", [0, 50])
+def test_encode_file_resumes_after_crash(tmp_path, encoder, monkeypatch, out_format, shard_size):
+    lines = _lines()
+    inp = _write_lines(tmp_path / "input", lines)
+    out = str(tmp_path / "output")
+    process_batch = encoder._process_batch
+    calls = []
+
+    def crash(batch):
+        calls.append(batch.tokens.shape[0])
+        if len(calls) == 30:
+            raise RuntimeError("crash")
+        return process_batch(batch)
+
+    monkeypatch.setattr(encoder, "_process_batch", crash)
+    with pytest.raises(RuntimeError):
+        EncodeFile(encoder, inp, out, buffer_size=32, out_format=out_format,
+                   shard_size=shard_size)
+    assert os.path.isfile(out + ".progress")
+
+    ncalls = len(calls)
+    EncodeFile(encoder, inp, out, buffer_size=32, out_format=out_format, shard_size=shard_size)
+    # the buffers saved in the progress file are not encoded again
+    assert sum(calls[ncalls:]) < len(lines)
+    x = np.concatenate(LoadShards(out)) if shard_size else LoadEmbeddings(out, dim=DIM)
+    assert np.allclose(x, _reference(encoder, lines), atol=1e-6)
+    assert not os.path.isfile(out + ".progress")
+
+
+def test_encode_file_resumes_before_rename(tmp_path, encoder, monkeypatch):
+    # all the embeddings are written, the output is not renamed yet
+    lines = _lines()
+    inp = _write_lines(tmp_path / "input", lines)
+    out = str(tmp_path / "output.npy")
+    replace = os.replace
+
+    def crash(src, dst):
+        if dst == out:
+            raise RuntimeError("crash")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(RuntimeError):
+        EncodeFile(encoder, inp, out, buffer_size=32, out_format="npy")
+    monkeypatch.undo()
+    assert not os.path.isfile(out) and not os.path.isfile(out + ".json")
+
+    EncodeFile(encoder, inp, out, buffer_size=32, out_format="npy")
+    assert np.allclose(np.load(out), _reference(encoder, lines), atol=1e-6)
+    assert LoadEmbeddings(out).shape == (len(lines), DIM)
+
+
+@pytest.mark.parametrize("shard_size", [0, 50])
+def test_encode_file_over_write(tmp_path, encoder, monkeypatch, shard_size):
+    lines = _lines()
+    inp = _write_lines(tmp_path / "input", lines)
+    out = str(tmp_path / "output")
+    process_batch = encoder._process_batch
+    calls = []
+
+    def crash(batch):
+        calls.append(batch.tokens.shape[0])
+        if len(calls) == 30:
+            raise RuntimeError("crash")
+        return process_batch(batch)
+
+    monkeypatch.setattr(encoder, "_process_batch", crash)
+    with pytest.raises(RuntimeError):
+        EncodeFile(encoder, inp, out, buffer_size=32, out_format="npy", shard_size=shard_size)
+    monkeypatch.undo()
+    # the partial output is not reused
+    for fname in tmp_path.glob("output*"):
+        if not fname.name.endswith(".progress"):
+            fname.write_bytes(b"\xff" * fname.stat().st_size)
+    EncodeFile(encoder, inp, out, buffer_size=32, out_format="npy",
+               shard_size=shard_size, over_write=True)
+    x = np.concatenate(LoadShards(out, verify=True)) if shard_size else np.load(out)
+    assert np.allclose(x, _reference(encoder, lines), atol=1e-6)
+
+
+@pytest.mark.parametrize("out_format", ["raw", "npy"])
+@pytest.mark.parametrize("shard_size", [0, 50])
+def test_encode_file_empty_input(tmp_path, encoder, out_format, shard_size):
+    inp = tmp_path / "input"
+    inp.write_bytes(b"")
+    out = str(tmp_path / "output")
+    EncodeFile(encoder, str(inp), out, out_format=out_format, shard_size=shard_size)
+    if shard_size:
+        assert os.path.isfile(ManifestFname(out))
+        assert LoadShards(out) == []
+    else:
+        assert LoadEmbeddings(out, dim=DIM).shape == (0, DIM)
+
+
+def test_cache_matches_encoder(tmp_path, encoder_path, encoder):
+    lines = _lines()
+    reference = encoder.encode_sentences(lines)
+    with CachedSentenceEncoder(encoder, str(tmp_path)) as cached:
+        assert np.allclose(cached.encode_sentences(lines), reference, atol=1e-6)
+        assert (cached.cache.hits, cached.cache.misses) == (0, len(lines))
+        assert np.allclose(cached.encode_sentences(lines[::-1]), reference[::-1], atol=1e-6)
+        assert (cached.cache.hits, cached.cache.misses) == (len(lines), len(lines))
+    # embeddings of other inference options are not reused
+    truncated = SentenceEncoder(encoder_path, max_tokens=60, cpu=True, max_seq_len=6)
+    with CachedSentenceEncoder(truncated, str(tmp_path)) as cached:
+        assert np.allclose(cached.encode_sentences(lines),
+                           truncated.encode_sentences(lines), atol=1e-6)
+        assert cached.cache.hits == 0
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_compiled_checkpoint(tmp_path, encoder_path, encoder, monkeypatch, mmap):
+    # fall back to reading the weights with older versions of torch
+    monkeypatch.setattr(embed, "TORCH_MMAP", mmap and embed.TORCH_MMAP)
+    out = str(tmp_path / "encoder.compiled.pt")
+    CompileCheckpoint(encoder_path, out)
+    state_dict = torch.load(out, weights_only=True)
+    assert state_dict["format"] == COMPILED_CHECKPOINT
+    assert state_dict["source"] == embed.CheckpointId(encoder_path)
+    compiled = SentenceEncoder(out, max_tokens=60, cpu=True, sort_kind="mergesort")
+    lines = _lines()
+    assert np.array_equal(compiled.encode_sentences(lines), encoder.encode_sentences(lines))
+    assert compiled.dictionary == encoder.dictionary
+
+
+@pytest.mark.parametrize(
+    "version, mmap",
+    [("1.13.1", False), ("2.0.1+cu118", False), ("2.1.0", True), ("2.10.0a0+git", True),
+     ("10.0", True)],
+)
+def test_torch_version(version, mmap):
+    assert (VersionTuple(version) >= (2, 1)) == mmap
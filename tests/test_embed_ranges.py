@@ -0,0 +1,115 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Embedding a file in byte ranges against SentenceEncoder.encode_sentences,
+# and the retries of the failed ranges
+
+import multiprocessing
+import os
+import time
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("fairseq")
+
+import torch  # noqa: E402
+
+import embed_ranges  # noqa: E402
+from embed import LaserLstmEncoder, SentenceEncoder  # noqa: E402
+from embed_ranges import (  # noqa: E402
+    EmbedRange,
+    EmbedRanges,
+    LineAlignedRanges,
+    MergeRanges,
+    RangeDone,
+    RangeFname,
+)
+from lib.embedding_format import LoadEmbeddings, LoadShards, WriteMeta  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def encoder(tmp_path_factory):
+    torch.manual_seed(0)
+    params = dict(num_embeddings=32, padding_idx=1, embed_dim=8, hidden_size=4,
+                  bidirectional=True)
+    path = tmp_path_factory.mktemp("encoder") / "encoder.pt"
+    torch.save({
+        "params": params,
+        "model": LaserLstmEncoder(**params).state_dict(),
+        "dictionary": {f"w{i}": i for i in range(4, 32)},
+    }, path)
+    return SentenceEncoder(str(path), max_tokens=60, cpu=True)
+
+
+@pytest.fixture
+def lines():
+    rs = np.random.RandomState(0)
+    return [" ".join(f"w{w}" for w in rs.randint(4, 40, size=rs.randint(0, 20)))
+            for _ in range(200)]
+
+
+@pytest.mark.parametrize("num_ranges", [1, 3, 7, 500])
+@pytest.mark.parametrize("out_format", ["raw", "npy"])
+@pytest.mark.parametrize("merge", ["concat", "shards"])
+def test_ranges_match_encode_sentences(tmp_path, encoder, lines, num_ranges, out_format, merge):
+    inp = tmp_path / "input"
+    inp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    ranges = LineAlignedRanges(str(inp), num_ranges)
+    assert ranges[0][0] == 0 and ranges[-1][1] == inp.stat().st_size
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    out = str(tmp_path / "output")
+    for i, (start, end) in enumerate(ranges):
+        EmbedRange(encoder, str(inp), start, end, RangeFname(out, i, num_ranges),
+                   buffer_size=16, out_format=out_format)
+        assert RangeDone(out, i, num_ranges)
+    MergeRanges(out, num_ranges, out_format=out_format, merge=merge)
+    if merge == "shards":
+        x = np.concatenate(LoadShards(out, verify=True))
+    else:
+        x = LoadEmbeddings(out, dim=encoder.dim)
+    assert np.allclose(x, encoder.encode_sentences(lines), atol=1e-6)
+    assert not [f for f in os.listdir(tmp_path) if ".range-" in f]
+
+
+# state of the workers, inherited by fork
+CRASH = {}
+
+
+def _crashing_embed(index, start, end):
+    fname = RangeFname(CRASH["output"], index, 8)
+    open(fname + ".tmp", "w").close()
+    with open(CRASH["log"], "a") as fp:
+        fp.write(f"{index}\n")
+    time.sleep(0.05 * (index % 3))
+    if index == 5:
+        os._exit(1)
+    os.replace(fname + ".tmp", fname)
+    WriteMeta(fname, 0, None, np.float32)
+    return 0
+
+
+def test_worker_crash_charges_its_range(tmp_path, monkeypatch, caplog):
+    # the worker embedding range 5 always crashes, breaking the pool
+    out = str(tmp_path / "output")
+    log = tmp_path / "log"
+    monkeypatch.setitem(CRASH, "output", out)
+    monkeypatch.setitem(CRASH, "log", str(log))
+    fork = multiprocessing.get_context("fork")
+    monkeypatch.setattr(embed_ranges, "_worker_init", lambda args: None)
+    monkeypatch.setattr(embed_ranges, "_worker_embed", _crashing_embed)
+    monkeypatch.setattr(embed_ranges, "multiprocessing",
+                        types.SimpleNamespace(get_context=lambda method: fork))
+    args = types.SimpleNamespace(output=out, num_ranges=8, num_workers=3,
+                                 max_retries=2, verbose=False)
+    with pytest.raises(AssertionError, match="range 5 failed 3 times"):
+        EmbedRanges(args, [(0, 0)] * 8, list(range(8)))
+    charged = [r.getMessage().split()[1] for r in caplog.records
+               if "failed (attempt" in r.getMessage()]
+    assert charged == ["5"] * 3
+    # once with the other ranges, then alone for each attempt
+    assert list(map(int, log.read_text().split())).count(5) == 4
@@ -0,0 +1,80 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Persistent embedding cache: lookups after inserts, eviction, reopening
+# and recovery from an interrupted insert
+
+import numpy as np
+import pytest
+
+from lib.embedding_cache import EmbeddingCache
+
+
+def _vectors(keys, dim):
+    # embedding of a key: the key repeated
+    return np.repeat(np.asarray(keys, dtype=np.float32)[:, None], dim, axis=1)
+
+
+def _check(cache, keys, dim):
+    # each key is found with its own vector, or not found
+    out = np.full((len(keys), dim), -1, dtype=np.float32)
+    found = cache.lookup(keys, out)
+    assert np.array_equal(out[found], _vectors(keys, dim)[found])
+    return found
+
+
+def test_lookup_and_reopen(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), dim=8, max_size=1, model_id="enc")
+    keys = cache.hash([f"sentence {i}" for i in range(100)])
+    cache.insert(keys[:60], _vectors(keys[:60], 8))
+    assert _check(cache, keys, 8).tolist() == [True] * 60 + [False] * 40
+    cache.close()
+
+    cache = EmbeddingCache(str(tmp_path), dim=8, max_size=1, model_id="enc")
+    assert _check(cache, keys, 8).sum() == 60
+    cache.insert(keys, _vectors(keys, 8))
+    assert _check(cache, keys, 8).all()
+    # keys of another encoder
+    other = EmbeddingCache(str(tmp_path), dim=8, model_id="other")
+    assert other.hash(["sentence 0"]) != keys[:1]
+    with pytest.raises(AssertionError, match="dimension"):
+        EmbeddingCache(str(tmp_path), dim=4)
+
+
+@pytest.mark.parametrize("batch", [1, 3, 10])
+def test_eviction(tmp_path, batch):
+    # dimension of 3 records per MB
+    dim = 1 << 16
+    cache = EmbeddingCache(str(tmp_path), dim=dim, max_size=1)
+    assert cache.meta["capacity"] == 3
+    keys = list(range(1, 21))
+    for i in range(0, len(keys), batch):
+        cache.insert(keys[i : i + batch], _vectors(keys[i : i + batch], dim))
+        _check(cache, keys[:1], dim)  # referenced, kept longer
+        assert len(cache.slots) == min(i + batch, 3)
+    found = _check(cache, keys, dim)
+    assert found.sum() == 3 and found[-1]
+    cache.close()
+    assert _check(EmbeddingCache(str(tmp_path), dim=dim), keys, dim).sum() == 3
+
+
+def test_recover_interrupted_insert(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), dim=4, max_size=1)
+    keys = list(range(1, 9))
+    cache.insert(keys, _vectors(keys, 4))
+    # a crash after the key of a slot was cleared
+    cache.keys[2] = 0
+    cache.close()
+
+    cache = EmbeddingCache(str(tmp_path), dim=4)
+    assert len(cache.slots) == 7
+    new = list(range(100, 110))
+    cache.insert(new, _vectors(new, 4))
+    assert _check(cache, keys, 4).sum() == 7
+    assert _check(cache, new, 4).all()
+    cache.close()
+    cache = EmbeddingCache(str(tmp_path), dim=4)
+    assert _check(cache, keys + new, 4).sum() == 17
@@ -0,0 +1,157 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# .npy embeddings with sidecar, and shards with manifest, against
+# the legacy raw matrices
+
+import json
+
+import numpy as np
+import pytest
+
+from lib.embedding_format import (
+    EmbeddingWriter,
+    FileDigest,
+    LoadEmbeddings,
+    LoadShards,
+    ManifestFname,
+    MetaFname,
+    ReadManifest,
+    ReadMeta,
+    ShardedEmbeddingWriter,
+    ShardFname,
+)
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.RandomState(0).rand(103, 8).astype(np.float32)
+
+
+def test_npy_matches_raw(tmp_path, embeddings):
+    raw = tmp_path / "raw"
+    embeddings.tofile(raw)
+    out = tmp_path / "out.npy"
+    with open(out, "wb") as fp:
+        writer = EmbeddingWriter(fp, encoder="enc")
+        for i in range(0, embeddings.shape[0], 10):
+            writer.write(embeddings[i : i + 10])
+        writer.close()
+    assert np.array_equal(np.load(out), LoadEmbeddings(str(raw), dim=8))
+    assert np.array_equal(LoadEmbeddings(str(out), mmap=False), embeddings)
+    meta = ReadMeta(str(out))
+    assert (meta["count"], meta["dim"], meta["dtype"]) == (103, 8, "float32")
+    assert meta["encoder"] == "enc"
+
+
+def test_npy_resume(tmp_path, embeddings):
+    # append to a file holding the first rows, as EncodeFile when resuming
+    out = tmp_path / "out.npy"
+    with open(out, "wb") as fp:
+        writer = EmbeddingWriter(fp, sidecar=False)
+        writer.write(embeddings[:40])
+        fp.flush()
+    with open(out, "r+b") as fp:
+        fp.seek(0, 2)
+        writer = EmbeddingWriter(fp, dim=8, count=40)
+        writer.write(embeddings[40:])
+        writer.close()
+    assert np.array_equal(np.load(out), embeddings)
+
+
+def test_npy_resume_without_rows(tmp_path, embeddings):
+    # all the rows were written before the interruption
+    out = tmp_path / "out.npy"
+    with open(out, "wb") as fp:
+        writer = EmbeddingWriter(fp, sidecar=False)
+        writer.write(embeddings)
+    with open(out, "r+b") as fp:
+        fp.seek(0, 2)
+        writer = EmbeddingWriter(fp, dim=8, count=embeddings.shape[0])
+        writer.close()
+    assert np.array_equal(np.load(out), embeddings)
+
+
+def test_npy_empty(tmp_path):
+    out = tmp_path / "out.npy"
+    with open(out, "wb") as fp:
+        EmbeddingWriter(fp, dim=8).close()
+    assert np.load(out).shape == (0, 8)
+    assert ReadMeta(str(out))["count"] == 0
+
+    # unknown dimension: empty file
+    out = tmp_path / "unknown.npy"
+    with open(out, "wb") as fp:
+        EmbeddingWriter(fp).close()
+    assert out.stat().st_size == 0
+    assert LoadEmbeddings(str(out)).shape == (0, 0)
+    assert LoadEmbeddings(str(out), dim=8).shape == (0, 8)
+
+
+def test_sidecar_written_by_write_meta(tmp_path, embeddings):
+    out = tmp_path / "out.npy"
+    with open(str(out) + ".tmp", "wb") as fp:
+        writer = EmbeddingWriter(fp, fname=str(out), sidecar=False)
+        writer.write(embeddings)
+        writer.close()
+    assert not (tmp_path / MetaFname("out.npy")).exists()
+    writer.write_meta()
+    assert ReadMeta(str(out))["count"] == embeddings.shape[0]
+
+
+@pytest.mark.parametrize("storage", ["raw", "npy"])
+@pytest.mark.parametrize("shard_size", [1, 10, 103, 1000])
+def test_shards(tmp_path, embeddings, storage, shard_size):
+    out = str(tmp_path / "out")
+    writer = ShardedEmbeddingWriter(out, shard_size, storage=storage)
+    for i in range(0, embeddings.shape[0], 7):
+        writer.write(embeddings[i : i + 7])
+    writer.close()
+    manifest = ReadManifest(out)
+    assert manifest["count"] == embeddings.shape[0]
+    assert len(manifest["shards"]) == -(-embeddings.shape[0] // shard_size)
+    assert np.array_equal(np.concatenate(LoadShards(out, verify=True)), embeddings)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.parametrize("storage", ["raw", "npy"])
+@pytest.mark.parametrize("done", [0, 25, 30, 59, 103])
+def test_shards_resume(tmp_path, embeddings, storage, done):
+    # interrupted after more than done rows, resumed from done rows
+    out = str(tmp_path / "out")
+    writer = ShardedEmbeddingWriter(out, 10, storage=storage)
+    writer.write(embeddings[: min(done + 7, embeddings.shape[0])])
+    writer.sync()
+    writer = ShardedEmbeddingWriter(out, 10, dim=8, storage=storage, count=done)
+    writer.write(embeddings[done:])
+    writer.close()
+    assert np.array_equal(np.concatenate(LoadShards(out, verify=True)), embeddings)
+
+
+def test_shards_remove_stale(tmp_path, embeddings):
+    out = str(tmp_path / "out")
+    writer = ShardedEmbeddingWriter(out, 10)
+    writer.write(embeddings)
+    writer.close()
+    writer = ShardedEmbeddingWriter(out, 10)
+    writer.write(embeddings[:15])
+    writer.close()
+    assert len(ReadManifest(out)["shards"]) == 2
+    assert not (tmp_path / ShardFname("out", 2)).exists()
+
+
+def test_shards_checksum(tmp_path, embeddings):
+    out = str(tmp_path / "out")
+    writer = ShardedEmbeddingWriter(out, 50)
+    writer.write(embeddings)
+    writer.close()
+    with open(ManifestFname(out)) as fp:
+        shards = json.load(fp)["shards"]
+    assert shards[1]["sha256"] == FileDigest(ShardFname(out, 1), chunk_size=17)
+    with open(ShardFname(out, 1), "r+b") as fp:
+        fp.write(b"\xff" * 4)
+    with pytest.raises(AssertionError, match="checksum"):
+        LoadShards(out, verify=True)
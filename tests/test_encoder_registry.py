@@ -0,0 +1,131 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Encoder registry against loading each encoder as embed.py does, with
+# small random LSTM encoders
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+spm = pytest.importorskip("sentencepiece")
+pytest.importorskip("fairseq")
+
+import torch  # noqa: E402
+
+from embed import LaserLstmEncoder, load_model  # noqa: E402
+from encoder_registry import EncoderRegistry  # noqa: E402
+from lib.text_processing import SPMApplyLines  # noqa: E402
+
+TEXT = [
+    'He said "hi", then left.',
+    'End "quote".',
+    "Hey, how are you?",
+    "Ça va, merci.",
+    "the quick brown fox jumps over the lazy dog",
+]
+
+
+def _save_encoder(fname, pieces, seed):
+    torch.manual_seed(seed)
+    params = dict(num_embeddings=len(pieces) + 4, padding_idx=1, embed_dim=8,
+                  hidden_size=4, bidirectional=True)
+    torch.save({
+        "params": params,
+        "model": LaserLstmEncoder(**params).state_dict(),
+        "dictionary": {piece: i + 4 for i, piece in enumerate(pieces)},
+    }, fname)
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    # laser2, laser3 of wol_Latn with laser2.spm, of zul_Latn with its own SPM
+    model_dir = tmp_path_factory.mktemp("models")
+    inp = model_dir / "text"
+    inp.write_text("\n".join(TEXT * 20) + "\n", encoding="utf-8")
+    for name, size in (("laser2", 60), ("laser3-zul_Latn.v1", 50)):
+        spm.SentencePieceTrainer.train(input=str(inp), model_prefix=str(model_dir / name),
+                                       vocab_size=size, hard_vocab_limit=False)
+        os.replace(model_dir / f"{name}.model", model_dir / f"{name}.spm")
+    sp = spm.SentencePieceProcessor(model_file=str(model_dir / "laser2.spm"))
+    pieces = [sp.id_to_piece(i) for i in range(sp.get_piece_size())]
+    for seed, name in enumerate(("laser2", "laser3-wol_Latn.v1", "laser3-zul_Latn.v1",
+                                 "laser3-fra_Latn.v1")):
+        _save_encoder(model_dir / f"{name}.pt", pieces, seed)
+    return str(model_dir)
+
+
+def _reference(model_dir, lang):
+    # embed.py --spm-lang en, as embed.sh for all the languages
+    model_file, spm_file = EncoderRegistry(model_dir).paths(lang)
+    encoder = load_model(model_file, spm_file, None, cpu=True)
+    return encoder.encode_sentences(list(SPMApplyLines(TEXT, spm_file, lang="en")))
+
+
+@pytest.mark.parametrize("lang", [None, "wol_Latn", "zul_Latn"])
+def test_registry_matches_embed(model_dir, lang):
+    registry = EncoderRegistry(model_dir, cpu=True)
+    assert np.allclose(registry.encode_sentences(TEXT, lang),
+                       _reference(model_dir, lang), atol=1e-6)
+
+
+def test_registry_shares_and_evicts(model_dir):
+    registry = EncoderRegistry(model_dir, memory_budget=0, cpu=True)
+    for lang in (None, "wol_Latn", None, "zul_Latn", "wol_Latn"):
+        registry.get(lang)
+    metrics = registry.metrics()
+    # the most recently used encoder is kept over the budget
+    assert metrics["languages"] == ["wol_Latn"]
+    assert (metrics["hits"], metrics["misses"], metrics["evictions"]) == (0, 5, 4)
+    assert metrics["spm_models"] == 1
+
+    registry = EncoderRegistry(model_dir, cpu=True)
+    laser2, wol = registry.get(None), registry.get("wol_Latn")
+    assert laser2.spm is wol.spm
+    assert registry.get("zul_Latn").spm is not wol.spm
+    assert registry.metrics()["spm_models"] == 2
+
+
+def test_registry_failed_load(model_dir, tmp_path):
+    # the SPM model of an encoder which failed to load is released
+    for fname in os.listdir(model_dir):
+        os.symlink(os.path.join(model_dir, fname), tmp_path / fname)
+    (tmp_path / "laser3-zul_Latn.v1.pt").unlink()
+    (tmp_path / "laser3-zul_Latn.v1.pt").write_bytes(b"not a checkpoint")
+    registry = EncoderRegistry(str(tmp_path), cpu=True)
+    registry.get(None)
+    with pytest.raises(Exception):
+        registry.get("zul_Latn")
+    assert list(registry.spm_users.values()) == [1]
+    assert registry.metrics()["spm_models"] == 1
+
+
+def test_registry_concurrent(model_dir):
+    # loads and evictions of encoders sharing an SPM model
+    registry = EncoderRegistry(model_dir, memory_budget=0, cpu=True)
+    reference = {lang: _reference(model_dir, lang)
+                 for lang in (None, "wol_Latn", "zul_Latn", "fra_Latn")}
+    errors = []
+
+    def encode(lang):
+        try:
+            for _ in range(5):
+                assert np.allclose(registry.encode_sentences(TEXT, lang),
+                                   reference[lang], atol=1e-6)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=encode, args=(lang,))
+               for lang in list(reference) * 3]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert sum(registry.spm_users.values()) == len(registry.encoders) == 1
+    assert len(registry.spm_models) == len(registry.spm_users)
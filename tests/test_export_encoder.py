@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Encoders exported by export_encoder.py (TorchScript and ONNX) against
+# the original encoder. The encoder is a small random LSTM.
+
+import numpy as np
+import pytest
+
+pytest.importorskip("fairseq")
+
+import torch  # noqa: E402
+
+from embed import (  # noqa: E402
+    CompiledSentenceEncoder,
+    LaserLstmEncoder,
+    SentenceEncoder,
+    load_model,
+)
+from export_encoder import ExportEncoder  # noqa: E402
+
+VOCAB = 64
+
+
+@pytest.fixture(scope="module")
+def encoder(tmp_path_factory):
+    torch.manual_seed(0)
+    params = dict(num_embeddings=VOCAB, padding_idx=1, embed_dim=8,
+                  hidden_size=6, num_layers=2, bidirectional=True)
+    path = tmp_path_factory.mktemp("encoder") / "encoder.pt"
+    torch.save({
+        "params": params,
+        "model": LaserLstmEncoder(**params).state_dict(),
+        "dictionary": {f"w{i}": i for i in range(4, VOCAB)},
+    }, path)
+    return SentenceEncoder(str(path), max_tokens=60, cpu=True)
+
+
+def _lines(n=100, seed=0):
+    # lengths beyond those of the example batch, unknown words and empty lines
+    rs = np.random.RandomState(seed)
+    lines = [
+        " ".join(f"w{w}" for w in rs.randint(4, VOCAB + 8, size=rs.randint(0, 30)))
+        for _ in range(n)
+    ]
+    return lines + ["", "x y"]
+
+
+@pytest.mark.parametrize("fmt", ["torchscript", "onnx"])
+def test_export_matches_encoder(tmp_path, encoder, fmt):
+    if fmt == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    lines = _lines()
+    out = str(tmp_path / f"encoder.{fmt}")
+    ExportEncoder(encoder, out, fmt=fmt)
+    assert CompiledSentenceEncoder.is_compiled(out)
+    for kwargs in ({"max_tokens": 60}, {"max_sentences": 1}, {"max_sentences": 32}):
+        compiled = CompiledSentenceEncoder(out, cpu=True, **kwargs)
+        assert np.allclose(compiled.encode_sentences(lines),
+                           encoder.encode_sentences(lines), atol=1e-5)
+
+    # load_model picks the compiled encoder, with the long line options
+    compiled = load_model(out, None, None, max_tokens=60, cpu=True, max_seq_len=6)
+    assert isinstance(compiled, CompiledSentenceEncoder)
+    truncated = SentenceEncoder(encoder.model_path, max_tokens=60, cpu=True, max_seq_len=6)
+    assert np.allclose(compiled.encode_sentences(lines),
+                       truncated.encode_sentences(lines), atol=1e-5)
@@ -0,0 +1,66 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Vectorized builder of the text index files (IndexTextCreate) against
+# the per line reference, read back with IndexTextOpen
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from lib.indexing import IndexTextCreate, IndexTextOpen, IndexTextQuery  # noqa: E402
+from reference import index_text_reference  # noqa: E402
+
+TEXTS = [
+    b"",
+    b"\n\n\n",
+    b"Hello world\n\n  two  words \nlast line without newline",
+    b"\ttab\x01separated\x1fwords\r\nend\n",
+    "Ça va ?\n日本語 テキスト\n«\xa0oui\xa0»\n".encode("utf-8"),
+    b" ".join([b"w"] * 300) + b"\n" + b"x" * 5000 + b"\n",
+    b"no newline at all",
+]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("block_size", [1, 3, 7, 1 << 20])
+def test_index_text_matches_reference(tmp_path, text, block_size):
+    txt = tmp_path / "corpus.txt"
+    txt.write_bytes(text)
+    nlines = IndexTextCreate(str(txt), block_size=block_size)
+    offsets, words = index_text_reference(text)
+    assert nlines == len(offsets)
+    assert np.array_equal(np.fromfile(tmp_path / "corpus.ref.bin32", dtype=np.uint32), offsets)
+    assert np.array_equal(np.fromfile(tmp_path / "corpus.nw.bin8", dtype=np.uint8), words)
+
+
+def test_index_text_inputs(tmp_path):
+    # inputs without final newline, or empty, are concatenated line by line
+    inputs = [b"one\ntwo", b"", "trois\nquatre\ncinq\n".encode("utf-8")]
+    fnames = []
+    for i, text in enumerate(inputs):
+        fnames.append(str(tmp_path / f"input.{i}"))
+        with open(fnames[-1], "wb") as fp:
+            fp.write(text)
+    txt = str(tmp_path / "corpus.txt")
+    assert IndexTextCreate(txt, inputs=fnames, langs=["en", "de", "fr"], block_size=4) == 5
+    assert (tmp_path / "corpus.txt").read_bytes() == b"one\ntwo\ntrois\nquatre\ncinq\n"
+
+    txt_mmap, ref_mmap, nbw_mmap, meta = IndexTextOpen(txt)
+    assert [IndexTextQuery(txt_mmap, ref_mmap, i) for i in range(5)] == \
+        ["one", "two", "trois", "quatre", "cinq"]
+    assert nbw_mmap.tolist() == [1] * 5
+    assert meta == [{"lang": "en", "n": 2}, {"lang": "de", "n": 2}, {"lang": "fr", "n": 5}]
+
+
+def test_index_text_without_word_counts(tmp_path):
+    txt = tmp_path / "corpus.txt"
+    txt.write_bytes(TEXTS[2])
+    IndexTextCreate(str(txt), word_counts=False)
+    assert not (tmp_path / "corpus.nw.bin8").exists()
+    assert np.array_equal(np.fromfile(tmp_path / "corpus.ref.bin32", dtype=np.uint32),
+                          index_text_reference(TEXTS[2])[0])
@@ -0,0 +1,97 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# In process preprocessing (punctuation normalization, removal of the non
+# printing characters, SPM) against the sequential implementations and
+# the perl scripts
+
+import os
+import sys
+from itertools import islice
+
+import pytest
+
+from lib.normalize_punctuation import normalize_punctuation
+from lib.remove_non_printing_chars import remove_non_printing_chars
+from lib.text_processing import MOSES_BDIR, SPM_ENCODE, SPMApply
+from reference import normalize_punctuation_reference, remove_non_printing_chars_reference
+
+TATOEBA = os.path.join(os.environ["LASER"], "data", "tatoeba", "v1")
+
+LINES = [
+    "",
+    "  Hello (world) !  ",
+    "He said ``yes'' -- and `no'.",
+    "« Bonjour »\xa0! «\xa0oui\xa0» , n'est-ce pas\xa0?",
+    "Il fait 20\xa0ºC , 3\xa0cm et 5 %\xa0; nº\xa01\xa0: ok",
+    "„Gut“, sagte er. „Ja”…",
+    "l‘homme’s ‘quote’ ‚low‘ ´´x´´ it´s",
+    "1 000 000 and 3 . 5 and (a) , (b) .",
+    '"quoted", and "dots"... "x".',
+    "em—dash – en–dash\r\r",
+    "mixed\xa0»\xa0end\xa0»",
+    "Ünïcödé «texte» avec des ‘guillemets’ 12 345",
+]
+
+
+def _tatoeba(fname, n=2000):
+    fname = os.path.join(TATOEBA, fname)
+    if not os.path.isfile(fname):
+        return []
+    with open(fname, encoding="utf-8") as fp:
+        return [line.rstrip("\n") for line in islice(fp, n)]
+
+
+@pytest.mark.parametrize("penn", [0, 1])
+@pytest.mark.parametrize(
+    "lang, fname",
+    [
+        ("en", "tatoeba.fra-eng.eng"),
+        ("fr", "tatoeba.fra-eng.fra"),
+        ("de", "tatoeba.deu-eng.deu"),
+        ("es", "tatoeba.spa-eng.spa"),
+        ("ru", "tatoeba.rus-eng.rus"),
+        ("zh", "tatoeba.cmn-eng.cmn"),
+    ],
+)
+def test_normalize_punctuation_matches_reference(lang, fname, penn):
+    for line in LINES + _tatoeba(fname):
+        assert normalize_punctuation(line, lang, penn) == \
+            normalize_punctuation_reference(line, lang, penn), line
+
+
+def test_remove_non_printing_chars_matches_reference():
+    lines = LINES + [
+        "\x00\x11Hello​World﻿\n",
+        "tab\there\x7f\x85  \U000f0000\udc80",
+        "".join(map(chr, range(0, 0x3000, 7))),
+        "".join(map(chr, range(0xd700, 0xe100, 3))),
+        "".join(map(chr, range(0x10000, sys.maxunicode + 1, 997))),
+    ]
+    for line in lines:
+        assert remove_non_printing_chars(line) == remove_non_printing_chars_reference(line)
+
+
+@pytest.mark.skipif(
+    not (os.path.isfile(SPM_ENCODE) and os.path.isfile(MOSES_BDIR + "tokenizer.perl")),
+    reason="spm_encode or the Moses scripts not installed (install_external_tools.sh)",
+)
+def test_spm_in_process_matches_spm_encode(tmp_path):
+    spm = pytest.importorskip("sentencepiece")
+    lines = _tatoeba("tatoeba.fra-eng.fra") + _tatoeba("tatoeba.fra-eng.eng")
+    assert lines, "Tatoeba is not available"
+    inp = tmp_path / "input"
+    # a lone \r does not end a line
+    inp.write_text("\n".join(lines + LINES) + "\nlone\rcr\n", encoding="utf-8")
+    spm.SentencePieceTrainer.train(
+        input=str(inp), model_prefix=str(tmp_path / "spm"), vocab_size=500
+    )
+    model = str(tmp_path / "spm.model")
+    for in_process in (False, True):
+        SPMApply(str(inp), str(tmp_path / f"out.{in_process}"), model,
+                 lang="fr", in_process=in_process)
+    assert (tmp_path / "out.True").read_text(encoding="utf-8") == \
+        (tmp_path / "out.False").read_text(encoding="utf-8")
@@ -0,0 +1,179 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Python tokenizer (Token(engine="python")) and tokenizer sessions against
+# the Moses perl scripts
+
+import os
+from collections import OrderedDict
+
+import pytest
+
+from lib import text_processing
+from lib.text_processing import (
+    MOSES_BDIR,
+    Token,
+    TokenizerSession,
+    TokenLinePython,
+    TokenSession,
+    TokenVerify,
+)
+
+TATOEBA = os.path.join(os.environ["LASER"], "data", "tatoeba", "v1")
+
+
+@pytest.mark.skipif(
+    not os.path.isfile(MOSES_BDIR + "tokenizer.perl"),
+    reason="Moses scripts not installed (install_external_tools.sh)",
+)
+@pytest.mark.parametrize(
+    "lang, fname",
+    [
+        ("en", "tatoeba.fra-eng.eng"),
+        ("fr", "tatoeba.fra-eng.fra"),
+        ("de", "tatoeba.deu-eng.deu"),
+        ("ru", "tatoeba.rus-eng.rus"),
+        ("zh", "tatoeba.cmn-eng.cmn"),
+    ],
+)
+def test_python_tokenizer_matches_perl(lang, fname):
+    pytest.importorskip("sacremoses")
+    assert TokenVerify(os.path.join(TATOEBA, fname), lang=lang, num_workers=2) == 0
+
+
+def test_python_tokenizer_keeps_lines(tmp_path):
+    # a lone \r does not end a line, as in remove-non-printing-char.perl
+    pytest.importorskip("sacremoses")
+    inp = tmp_path / "input"
+    inp.write_bytes("Hello,\rworld!\nSecond line.\n\nLast\n".encode("utf-8"))
+    for num_workers in (1, 2):
+        out = tmp_path / f"tok.{num_workers}"
+        Token(str(inp), str(out), lang="en", engine="python", num_workers=num_workers)
+        assert out.read_text(encoding="utf-8").split("\n") == [
+            "hello , world !", "second line .", "", "last", ""
+        ]
+
+
+@pytest.mark.skipif(
+    not os.path.isfile(MOSES_BDIR + "tokenizer.perl"),
+    reason="Moses scripts not installed (install_external_tools.sh)",
+)
+@pytest.mark.parametrize(
+    "lang, fname",
+    [("en", "tatoeba.fra-eng.eng"), ("fr", "tatoeba.fra-eng.fra"), ("zh", "tatoeba.cmn-eng.cmn")],
+)
+@pytest.mark.parametrize("descape", [False, True])
+def test_session_matches_token(tmp_path, lang, fname, descape):
+    with open(os.path.join(TATOEBA, fname), encoding="utf-8") as fp:
+        lines = [line.rstrip("\n") for line in fp][:500]
+    lines += ["", "  spaces  ", "&amp; &lt;escaped&gt; &quot;", "« guillemets » ‘quotes’"]
+    inp = tmp_path / "input"
+    inp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    out = tmp_path / "tok"
+    Token(str(inp), str(out), lang=lang, descape=descape)
+    with TokenizerSession(lang=lang, descape=descape, timeout=30) as session:
+        # several batches through the same pipeline
+        tok = session.tokenize_many(lines[:100]) + session.tokenize_many(lines[100:])
+    assert tok == out.read_text(encoding="utf-8").split("\n")[:-1]
+
+
+def _fake_moses(tmp_path, tokenizer):
+    # perl steps which do not flush their output themselves
+    copy = tmp_path / "copy.perl"
+    copy.write_text("while (<STDIN>) { print; }\n")
+    (tmp_path / "tokenizer.perl").write_text(tokenizer)
+    return {
+        "MOSES_BDIR": str(tmp_path) + "/",
+        "REM_NON_PRINT_CHAR": str(copy),
+        "NORM_PUNC": str(copy) + " -l ",
+        "DESCAPE": str(copy),
+    }
+
+
+def test_session_without_moses_flush(tmp_path, monkeypatch):
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    with TokenizerSession(lang="en", timeout=30) as session:
+        assert session.tokenize_many(["Hello World", "", "Second"]) == \
+            ["hello world", "", "second"]
+        assert session.tokenize("Again") == "again"
+
+
+def test_session_timeout(tmp_path, monkeypatch):
+    # the tokenizer never outputs anything
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    session = TokenizerSession(lang="en", timeout=1)
+    with pytest.raises(TimeoutError):
+        session.tokenize_many(["hello"] * 1000)
+    assert session.process is None
+    session.close()
+
+
+def test_session_quotes_lang(tmp_path, monkeypatch):
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    pwned = tmp_path / "pwned"
+    with TokenizerSession(lang=f"en; touch {pwned}", timeout=30) as session:
+        assert session.tokenize_many(["Hello"]) == ["hello"]
+    assert not pwned.exists()
+
+
+def test_token_sessions_are_capped(tmp_path, monkeypatch):
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    monkeypatch.setattr(text_processing, "TOKEN_SESSIONS_MAX", 2)
+    monkeypatch.setattr(text_processing, "_token_sessions", OrderedDict())
+    sessions = [TokenSession(lang) for lang in ("aa", "bb", "aa", "cc")]
+    assert list(text_processing._token_sessions) == [("aa", False, False), ("cc", False, False)]
+    # the least recently used session is closed, and started again if used
+    assert sessions[1].process is None
+    assert sessions[1].tokenize("Hello") == "hello"
+    for session in sessions:
+        session.close()
+
+
+def test_session_sentinel_in_input(tmp_path, monkeypatch):
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    lines = ["a", text_processing.SESSION_SENTINEL, text_processing.SESSION_SENTINEL.upper(), "b"]
+    with TokenizerSession(lang="en", timeout=30) as session:
+        assert session.tokenize_many(lines) == [line.lower() for line in lines]
+        assert session.tokenize_many(["c"]) == ["c"]
+
+
+def test_session_killed_on_line_mismatch(tmp_path, monkeypatch):
+    # the tokenizer outputs each line twice
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    session = TokenizerSession(lang="en", timeout=30)
+    with pytest.raises(AssertionError, match="2 tokenized lines for 1 lines"):
+        session.tokenize_many(["a"])
+    # the rest of the output is not read by the next batch
+    assert session.process is None
+    session.close()
+
+
+def test_session_descape(tmp_path, monkeypatch):
+    # not de-escaped by default, as Token
+    for name, value in _fake_moses(tmp_path, "while (<STDIN>) { print; }\n").items():
+        monkeypatch.setattr(text_processing, name, value)
+    descape = tmp_path / "descape.perl"
+    descape.write_text("while (<STDIN>) { s/&amp;/&/g; print; }\n")
+    monkeypatch.setattr(text_processing, "DESCAPE", str(descape))
+    with TokenizerSession(lang="en", timeout=30) as session:
+        assert session.tokenize("a &amp; b") == "a &amp; b"
+    with TokenizerSession(lang="en", descape=True, timeout=30) as session:
+        assert session.tokenize("a &amp; b") == "a & b"
+
+
+@pytest.mark.parametrize("descape", [False, True])
+def test_python_session_descape(descape):
+    pytest.importorskip("sacremoses")
+    line = "a &amp; b &lt;c&gt;"
+    with TokenizerSession(lang="en", engine="python", descape=descape) as session:
+        assert session.tokenize(line) == TokenLinePython(line, lang="en", descape=descape)
+    assert (session.tokenize(line) == TokenLinePython(line, lang="en")) != descape
@@ -9,20 +9,77 @@
 #
 # This is supposed to be a drop in replacement to moses strip-non-printing-char.perl
 
+import json
+import os
 import sys
+import typing as tp
 import unicodedata
+from functools import lru_cache
+from itertools import chain
 
+# optional directory where the non printing characters are saved, to
+# avoid scanning all the code points in each new process
+CACHE_DIR_ENV = "NON_PRINTING_CHAR_CACHE_DIR"
 
-def get_replacer(replace_by: str = " ") -> str:
-    non_printable_map = {
-        ord(c): replace_by
-        for c in (chr(i) for i in range(sys.maxunicode + 1))
+
+def _scan_non_printing_ranges() -> tp.List[tp.List[int]]:
+    ranges: tp.List[tp.List[int]] = []
+    for i in range(sys.maxunicode + 1):
         # same as \p{C} in perl
         # see https://www.unicode.org/reports/tr44/#General_Category_Values
-        if unicodedata.category(c) in {"C", "Cc", "Cf", "Cs", "Co", "Cn"}
-    }
+        if unicodedata.category(chr(i))[0] == "C":
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+    return ranges
+
+
+@lru_cache(maxsize=None)
+def non_printing_ranges(cache_dir: tp.Optional[str] = None) -> tp.List[tp.List[int]]:
+    """
+    [start, end) ranges of the code points of category C, computed once per
+    process, and saved in cache_dir (default: $NON_PRINTING_CHAR_CACHE_DIR)
+    if given
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return _scan_non_printing_ranges()
+    # the categories depend on the version of the Unicode database
+    fname = os.path.join(
+        cache_dir, f"non_printing_chars.{unicodedata.unidata_version}.json"
+    )
+    if os.path.isfile(fname):
+        with open(fname) as fp:
+            return json.load(fp)
+    ranges = _scan_non_printing_ranges()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(ranges, fp)
+    os.replace(tmp, fname)
+    return ranges
+
+
+@lru_cache(maxsize=None)
+def get_table(replace_by: str = " ") -> tp.Dict[int, str]:
+    """
+    str.translate() table replacing the non printing characters, shared by
+    all the replacers
+    """
+    return dict.fromkeys(
+        chain.from_iterable(range(start, end) for start, end in non_printing_ranges()),
+        replace_by,
+    )
+
+
+def get_replacer(replace_by: str = " ") -> tp.Callable[[str], str]:
+    non_printable_map = get_table(replace_by)
 
     def replace_non_printing_char(line) -> str:
+        # printable strings have no character of category C
+        if line.isprintable():
+            return line
         return line.translate(non_printable_map)
 
     return replace_non_printing_char